@@ -21,5 +21,9 @@ setup(
     ],
     keywords='Database Files Xarray Handler Zarr Store Read Write Append Update Upsert Backup Delete S3',
     packages=find_packages(),
-    install_requires=required
+    install_requires=required,
+    extras_require={
+        # the backups of the tests are made against a local S3 stand-in
+        'test': ['pytest', 'moto[s3]>=5'],
+    }
 )
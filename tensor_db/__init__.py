@@ -1,5 +1,6 @@
 import tensor_db.file_handlers
 import tensor_db.backup_handlers
+import tensor_db.metrics
 
-from tensor_db.core import TensorDB
+from tensor_db.core import TensorDB, AsyncTensorDB
 
@@ -1 +1 @@
-from tensor_db.backup_handlers.s3_handler import S3Handler
+from tensor_db.backup_handlers.s3_handler import S3Handler, S3TransferError, BackupManifest
@@ -1,4 +1,2 @@
-from tensor_db.backup_handlers.s3_handler.s3_handler import S3Handler
-
-
-
+from tensor_db.backup_handlers.s3_handler.s3_handler import S3Handler, S3TransferError
+from tensor_db.backup_handlers.s3_handler.backup_manifest import BackupManifest
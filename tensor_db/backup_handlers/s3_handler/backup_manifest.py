@@ -0,0 +1,94 @@
+import json
+import time
+import threading
+
+from typing import Dict
+
+from tensor_db.backup_handlers.s3_handler.s3_handler import S3Handler
+
+
+class BackupManifest:
+    """
+        BackupManifest
+        ----------
+        Single object of the bucket that contains the version (backup date) of the backup of every tensor,
+        so checking if the local copies of many tensors are equal to their backups only needs one request.
+
+        The manifest is cached in memory during ttl seconds, after that it is read again using a conditional
+        request (If-None-Match), so it is only downloaded if it was modified.
+        The writes use optimistic concurrency (If-Match), if other process modified the manifest at the same
+        time the manifest is read again and the write is retried.
+    """
+
+    def __init__(self,
+                 s3_handler: S3Handler,
+                 bucket_name: str,
+                 s3_path: str = 'zbackup_manifest.json',
+                 ttl: float = 60,
+                 max_retries: int = 10):
+        self.s3_handler = s3_handler
+        self.bucket_name = bucket_name
+        self.s3_path = s3_path
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.stats = {'requests': 0, 'downloads': 0}
+        self._versions: Dict[str, str] = None
+        self._etag: str = None
+        self._read_time: float = None
+        self._lock = threading.Lock()
+
+    def get_versions(self, force: bool = False) -> Dict[str, str]:
+        with self._lock:
+            if force or self._read_time is None or time.monotonic() - self._read_time > self.ttl:
+                self._read()
+            return dict(self._versions)
+
+    def get_version(self, path: str) -> str:
+        """
+        Version of the backup of the tensor, None if the tensor is not on the manifest
+        """
+        return self.get_versions().get(path.replace('\\', '/'))
+
+    def _read(self):
+        self.stats['requests'] += 1
+        try:
+            content, etag = self.s3_handler.get_object_if_none_match(
+                bucket_name=self.bucket_name,
+                s3_path=self.s3_path,
+                etag=self._etag
+            )
+        except S3Handler.botoclient_error as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+                raise
+            content, etag = b'{}', None
+        if content is not None:
+            self.stats['downloads'] += 1
+            self._versions = json.loads(content)
+        self._etag = etag
+        self._read_time = time.monotonic()
+
+    def set_versions(self, versions: Dict[str, str]):
+        """
+        Add or modify the versions of multiple tensors using a single write
+        """
+        versions = {path.replace('\\', '/'): version for path, version in versions.items()}
+        with self._lock:
+            for _ in range(self.max_retries):
+                self._read()
+                new_versions = {**self._versions, **versions}
+                try:
+                    self._etag = self.s3_handler.put_object(
+                        bucket_name=self.bucket_name,
+                        s3_path=self.s3_path,
+                        body=json.dumps(new_versions).encode(),
+                        if_match=self._etag,
+                        if_none_match='*' if self._etag is None else None
+                    )
+                except S3Handler.botoclient_error as e:
+                    if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                        raise
+                    continue
+                self._versions = new_versions
+                self._read_time = time.monotonic()
+                return
+        raise TimeoutError(f"The manifest {self.s3_path} could not be written after {self.max_retries} retries")
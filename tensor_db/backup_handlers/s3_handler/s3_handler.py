@@ -1,16 +1,48 @@
 import boto3
 import os
+import asyncio
+import functools
+import threading
 import pandas as pd
 import time
 
-from typing import Dict, List, Any, Union, Callable, Set
+from typing import Dict, List, Any, Union, Callable, Set, Iterator, Tuple
 from loguru import logger
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+
+from tensor_db import metrics
+
+
+class S3TransferError(Exception):
+    """
+    Raised when one or more files of a batch transfer fail, errors contains the exception of every failed file
+    indexed by its s3_path, the rest of the files of the batch are transferred anyway
+    """
+
+    def __init__(self, errors: Dict[str, Exception]):
+        self.errors = errors
+        super().__init__(
+            f"{len(errors)} files failed to be transferred: " +
+            ", ".join(f"{s3_path} ({error!r})" for s3_path, error in list(errors.items())[:5])
+        )
 
 
 class S3Handler:
+    """
+        S3Handler
+        ----------
+        All the batch transfers of the handler share a single executor, so max_concurrency is the
+        global limit of files transferred at the same time and the connection pool of the client
+        (max_pool_connections) is sized to serve all of them.
+
+        The executor is created the first time that it is used, and close must be called to stop its threads.
+
+        Every request and the bytes transferred are recorded on the metrics of the current action of TensorDB
+        (see tensor_db.metrics), the transfers of the executor use the action of the thread that submitted them.
+    """
 
     botoclient_error = ClientError
 
@@ -18,24 +50,93 @@ class S3Handler:
                  aws_access_key_id: str,
                  aws_secret_access_key: str,
                  region_name: str,
+                 max_concurrency: int = None,
+                 max_pool_connections: int = None,
                  **kwargs):
 
+        self.max_concurrency = os.cpu_count() if max_concurrency is None else max_concurrency
+        # every thread of the executor needs its own connection, the default of botocore is only 10
+        self.max_pool_connections = max(10, self.max_concurrency) if max_pool_connections is None else \
+            max_pool_connections
         self.s3 = boto3.client(
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
             region_name=region_name,
+            config=Config(max_pool_connections=self.max_pool_connections)
         )
-        self.max_concurrency = os.cpu_count()
+        self._executor: ThreadPoolExecutor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix='s3_handler'
+                )
+            return self._executor
+
+    def close(self, wait: bool = True):
+        """
+        Stop the threads of the executor, the handler still can be used after closing it,
+        in that case a new executor is created
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _submit_transfers(self, func: Callable, files_settings: List[Dict[str, Any]]) -> Dict[Future, Dict]:
+        # the executor already use all the concurrency, so every file is transferred using only one thread
+        # (unless the settings of the file say other thing), this avoid having max_concurrency ** 2 threads
+        futures = {}
+        for file_settings in files_settings:
+            max_concurrency = file_settings.get('max_concurrency') or 1
+            future = self.executor.submit(
+                metrics.copy_context_run(func), **{**file_settings, 'max_concurrency': max_concurrency}
+            )
+            futures[future] = file_settings
+        return futures
+
+    def _iter_transfers(self,
+                        func: Callable,
+                        files_settings: List[Dict[str, Any]]) -> Iterator[Tuple[Dict[str, Any], Exception]]:
+        futures = self._submit_transfers(func, files_settings)
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
 
-    def _multi_process_function(self, func: Callable, arguments: List[Dict[str, str]]):
+    def _run_transfers(self,
+                       func: Callable,
+                       files_settings: List[Dict[str, Any]],
+                       raise_errors: bool = True) -> Tuple[List[Any], Dict[str, Exception]]:
         """
-        TODO: Simplify or improve this code, probably would be better to use map
+        Run all the transfers and return their results (in the same order than files_settings) and the errors
+        indexed by the s3_path of the files
         """
-        p = ThreadPool(processes=self.max_concurrency)
-        futures = [p.apply_async(func=func, kwds=kwds) for kwds in arguments]
-        for future in futures:
-            future.get()
+        futures = self._submit_transfers(func, files_settings)
+        errors = {}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                file_settings = futures[future]
+                logger.error(f"Error transferring the file {file_settings.get('s3_path')}: {future.exception()!r}")
+                errors[file_settings.get('s3_path', file_settings.get('local_path'))] = future.exception()
+        if errors and raise_errors:
+            raise S3TransferError(errors)
+        return [None if future.exception() is not None else future.result() for future in futures], errors
+
+    def _transfer_files(self,
+                        func: Callable,
+                        files_settings: List[Dict[str, str]],
+                        raise_errors: bool = True) -> Dict[str, Exception]:
+        return self._run_transfers(func, files_settings, raise_errors=raise_errors)[1]
 
     def download_file(self,
                       bucket_name: str,
@@ -49,18 +150,45 @@ class S3Handler:
 
         max_concurrency = self.max_concurrency if max_concurrency is None else max_concurrency
 
-        self.s3.download_file(
-            bucket_name,
-            s3_path,
-            local_path,
-            Config=TransferConfig(max_concurrency=max_concurrency),
-        )
+        with metrics.timer('s3_download'):
+            self.s3.download_file(
+                bucket_name,
+                s3_path,
+                local_path,
+                Config=TransferConfig(max_concurrency=max_concurrency, use_threads=max_concurrency > 1),
+            )
+        metrics.increment('s3_requests')
+        metrics.increment('s3_bytes_downloaded', os.path.getsize(local_path))
 
-    def download_files(self, files_settings: List[Dict[str, str]]):
-        self._multi_process_function(self.download_file, files_settings)
+    def download_files(self,
+                       files_settings: List[Dict[str, str]],
+                       raise_errors: bool = True) -> Dict[str, Exception]:
+        """
+        Download all the files using the executor of the handler, a failed file does not stop the rest of
+        the downloads, at the end an S3TransferError is raised with the errors of every file, if raise_errors is
+        False the errors are returned instead
+        """
+        return self._transfer_files(self.download_file, files_settings, raise_errors=raise_errors)
 
-    def upload_files(self, files_settings: List[Dict[str, str]]):
-        self._multi_process_function(self.upload_file, files_settings)
+    def upload_files(self,
+                     files_settings: List[Dict[str, str]],
+                     raise_errors: bool = True) -> Dict[str, Exception]:
+        """
+        Same than download_files but uploading the files
+        """
+        return self._transfer_files(self.upload_file, files_settings, raise_errors=raise_errors)
+
+    def iter_download_files(self, files_settings: List[Dict[str, str]]) -> Iterator[Tuple[Dict[str, str], Exception]]:
+        """
+        Yield the settings of every file and its error (None if it was downloaded) as the downloads are completed
+        """
+        return self._iter_transfers(self.download_file, files_settings)
+
+    def iter_upload_files(self, files_settings: List[Dict[str, str]]) -> Iterator[Tuple[Dict[str, str], Exception]]:
+        """
+        Yield the settings of every file and its error (None if it was uploaded) as the uploads are completed
+        """
+        return self._iter_transfers(self.upload_file, files_settings)
 
     def upload_file(self,
                     bucket_name: str,
@@ -70,14 +198,131 @@ class S3Handler:
                     **kwargs):
         s3_path = (os.path.dirname(local_path) if s3_path is None else s3_path).replace("\\", "/")
         max_concurrency = self.max_concurrency if max_concurrency is None else max_concurrency
-        self.s3.upload_file(
-            local_path,
-            bucket_name,
-            s3_path,
-            Config=TransferConfig(max_concurrency=max_concurrency)
+        with metrics.timer('s3_upload'):
+            self.s3.upload_file(
+                local_path,
+                bucket_name,
+                s3_path,
+                Config=TransferConfig(max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+            )
+        metrics.increment('s3_requests')
+        metrics.increment('s3_bytes_uploaded', os.path.getsize(local_path))
+
+    def get_object(self,
+                   bucket_name: str,
+                   s3_path: str,
+                   byte_range: Tuple[int, int] = None,
+                   **kwargs) -> bytes:
+        """
+        Read the content of an object, byte_range is a tuple (start, stop) with the same semantic than a python
+        slice, so only the bytes [start, stop) are downloaded
+        """
+        params = dict(Bucket=bucket_name, Key=s3_path.replace("\\", "/"))
+        if byte_range is not None:
+            params['Range'] = f"bytes={byte_range[0]}-{byte_range[1] - 1}"
+        with metrics.timer('s3_download'):
+            content = self.s3.get_object(**params)['Body'].read()
+        metrics.increment('s3_requests')
+        metrics.increment('s3_bytes_downloaded', len(content))
+        return content
+
+    def get_objects(self,
+                    objects_settings: List[Dict[str, Any]],
+                    raise_errors: bool = True) -> Tuple[List[bytes], Dict[str, Exception]]:
+        """
+        Read multiple objects (or ranges of them) in parallel, the contents are returned in the same order
+        than the settings, None is returned for the objects that failed
+        """
+        return self._run_transfers(self.get_object, objects_settings, raise_errors=raise_errors)
+
+    def list_objects(self, bucket_name: str, prefix: str, **kwargs) -> List[Dict[str, Any]]:
+        """
+        Information (Key, ETag, Size, etc) of all the objects whose path start with prefix
+        """
+        paginator = self.s3.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix.replace("\\", "/")):
+            metrics.increment('s3_requests')
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def get_object_if_none_match(self,
+                                 bucket_name: str,
+                                 s3_path: str,
+                                 etag: str = None,
+                                 **kwargs) -> Tuple[bytes, str]:
+        """
+        Conditional read of an object, if the object was not modified since the etag the content is not
+        downloaded and (None, etag) is returned, in other case the content and the new etag are returned
+        """
+        params = dict(Bucket=bucket_name, Key=s3_path.replace("\\", "/"))
+        if etag is not None:
+            params['IfNoneMatch'] = etag
+        metrics.increment('s3_requests')
+        try:
+            response = self.s3.get_object(**params)
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 304:
+                return None, etag
+            raise
+        content = response['Body'].read()
+        metrics.increment('s3_bytes_downloaded', len(content))
+        return content, response['ETag']
+
+    def put_object(self,
+                   bucket_name: str,
+                   s3_path: str,
+                   body: bytes,
+                   if_match: str = None,
+                   if_none_match: str = None,
+                   **kwargs) -> str:
+        """
+        Write an object and return its etag, if_match and if_none_match allow to write it only if the object was
+        not modified by other process (the S3 error is PreconditionFailed)
+        """
+        params = dict(Bucket=bucket_name, Key=s3_path.replace("\\", "/"), Body=body)
+        if if_match is not None:
+            params['IfMatch'] = if_match
+        if if_none_match is not None:
+            params['IfNoneMatch'] = if_none_match
+        with metrics.timer('s3_upload'):
+            etag = self.s3.put_object(**params)['ETag']
+        metrics.increment('s3_requests')
+        metrics.increment('s3_bytes_uploaded', len(body))
+        return etag
+
+    def delete_objects(self, bucket_name: str, s3_paths: List[str], **kwargs):
+        s3_paths = [s3_path.replace("\\", "/") for s3_path in s3_paths]
+        # S3 only allow to delete 1000 objects per request
+        for i in range(0, len(s3_paths), 1000):
+            metrics.increment('s3_requests')
+            self.s3.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': s3_path} for s3_path in s3_paths[i: i + 1000]], 'Quiet': True}
+            )
+
+    async def _run_async(self, func: Callable, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(metrics.copy_context_run(func), **kwargs))
+
+    async def download_file_async(self, bucket_name: str, local_path: str, s3_path: str = None, **kwargs):
+        return await self._run_async(
+            self.download_file, bucket_name=bucket_name, local_path=local_path, s3_path=s3_path, **kwargs
         )
 
+    async def upload_file_async(self, bucket_name: str, local_path: str, s3_path: str = None, **kwargs):
+        return await self._run_async(
+            self.upload_file, bucket_name=bucket_name, local_path=local_path, s3_path=s3_path, **kwargs
+        )
+
+    async def download_files_async(self, files_settings: List[Dict[str, str]], raise_errors: bool = True):
+        return await self._run_async(self.download_files, files_settings=files_settings, raise_errors=raise_errors)
+
+    async def upload_files_async(self, files_settings: List[Dict[str, str]], raise_errors: bool = True):
+        return await self._run_async(self.upload_files, files_settings=files_settings, raise_errors=raise_errors)
+
     def get_head_object(self, bucket_name: str, s3_path: str, **kwargs) -> Dict[str, Any]:
+        metrics.increment('s3_requests')
         return self.s3.head_object(Bucket=bucket_name, Key=s3_path.replace("\\", "/"))
 
     def get_etag(self, bucket_name: str, s3_path: str, **kwargs) -> str:
@@ -92,14 +337,3 @@ class S3Handler:
         if as_string:
             return date
         return pd.to_datetime(date)
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,88 @@
+"""
+Benchmark of ZarrStorage.append growing multiple dims at the same time, it compares the single pass append
+with the previous append dim by dim.
+
+Usage: python -m tensor_db.benchmarks.benchmark_append
+"""
+
+import xarray
+import numpy as np
+import pandas as pd
+import tempfile
+import time
+
+from typing import Dict, List
+
+from tensor_db.file_handlers import ZarrStorage
+
+
+def create_tensor(sizes: Dict[str, int], offsets: Dict[str, int] = None) -> xarray.DataArray:
+    offsets = {} if offsets is None else offsets
+    coords = {
+        dim: np.arange(offsets.get(dim, 0), offsets.get(dim, 0) + size)
+        for dim, size in sizes.items()
+    }
+    return xarray.DataArray(
+        np.random.rand(*sizes.values()),
+        dims=list(sizes.keys()),
+        coords=coords
+    )
+
+
+def benchmark_append(sizes: Dict[str, int],
+                     sizes_to_append: Dict[str, int],
+                     chunks: Dict[str, int],
+                     n_appends: int = 5) -> Dict[str, float]:
+    results = {}
+    for single_pass in [True, False]:
+        with tempfile.TemporaryDirectory() as base_path:
+            storage = ZarrStorage(base_path=base_path, path='benchmark', chunks=chunks, dims=list(sizes.keys()))
+            storage.store(create_tensor(sizes))
+            act_sizes = dict(sizes)
+            elapsed = 0.
+            for _ in range(n_appends):
+                # every append contains new labels in all the dims and overlap the last labels of the tensor
+                new_data = create_tensor(
+                    {dim: size + sizes_to_append.get(dim, 0) for dim, size in act_sizes.items()},
+                    {dim: 0 for dim in act_sizes}
+                ).isel({dim: slice(-(1 + sizes_to_append.get(dim, 0)), None) for dim in act_sizes})
+                start = time.perf_counter()
+                storage.append(new_data, single_pass=single_pass)
+                elapsed += time.perf_counter() - start
+                act_sizes = {dim: size + sizes_to_append.get(dim, 0) for dim, size in act_sizes.items()}
+
+            assert storage.read().sizes == act_sizes
+        results['single_pass' if single_pass else 'by_dim'] = elapsed / n_appends
+    return results
+
+
+def run(cases: List[Dict] = None):
+    cases = [
+        dict(
+            sizes={'index': 2000, 'columns': 1000},
+            sizes_to_append={'index': 5, 'columns': 10},
+            chunks={'index': 500, 'columns': 250}
+        ),
+        dict(
+            sizes={'index': 500, 'columns': 200, 'fields': 10},
+            sizes_to_append={'index': 5, 'columns': 10, 'fields': 1},
+            chunks={'index': 100, 'columns': 100, 'fields': 5}
+        ),
+    ] if cases is None else cases
+
+    # warm up, this avoid counting the time of the lazy imports of xarray and dask in the first case
+    benchmark_append(sizes={'index': 10, 'columns': 10}, sizes_to_append={'index': 1}, chunks=None, n_appends=1)
+
+    results = []
+    for case in cases:
+        times = benchmark_append(**case)
+        results.append({
+            'shape': 'x'.join(map(str, case['sizes'].values())),
+            **times,
+            'speedup': times['by_dim'] / times['single_pass']
+        })
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    print(run().to_string(index=False))
@@ -0,0 +1,111 @@
+"""
+Benchmark of the compression codecs (compressor and filters of ZarrStorage) using a sample of a stored tensor,
+it reports the compression ratio and the encode/decode throughput of every candidate.
+If the path of a tensor is not provided, a synthetic tensor of slowly changing prices with many NaNs is used.
+
+Usage: python -m tensor_db.benchmarks.benchmark_codecs [--base_path BASE_PATH --path PATH] [--sample 1000]
+"""
+
+import argparse
+import xarray
+import numpy as np
+import pandas as pd
+import time
+import zarr
+
+from typing import Dict, List
+
+from tensor_db.file_handlers import ZarrStorage
+
+
+default_candidates = {
+    'no_compression': dict(compressor=None),
+    'zarr_default': dict(),
+    'blosc_lz4_shuffle': dict(compressor={'id': 'blosc', 'cname': 'lz4', 'clevel': 5, 'shuffle': 1}),
+    'blosc_zstd_shuffle': dict(compressor={'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 1}),
+    'blosc_zstd_bitshuffle': dict(compressor={'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 2}),
+    'delta_blosc_zstd': dict(
+        compressor={'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 1},
+        filters=[{'id': 'delta', 'dtype': '<f8'}]
+    ),
+    'bitround_12_blosc_zstd': dict(
+        compressor={'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 1},
+        filters=[{'id': 'bitround', 'keepbits': 12}]
+    ),
+}
+
+
+def create_prices(sizes: Dict[str, int], nan_ratio: float = 0.5) -> xarray.DataArray:
+    # random walks rounded to cents with many missing values, like the prices of the assets that do not trade every day
+    values = 100 + np.cumsum(np.random.normal(0, 0.5, list(sizes.values())), axis=0)
+    values = np.round(values, 2)
+    values[np.random.rand(*values.shape) < nan_ratio] = np.nan
+    return xarray.DataArray(
+        values,
+        dims=list(sizes.keys()),
+        coords={dim: np.arange(size) for dim, size in sizes.items()}
+    )
+
+
+def read_sample(base_path: str, path: str, name: str = 'data', sample: int = 1000) -> xarray.DataArray:
+    storage = ZarrStorage(base_path=base_path, path=path, name=name)
+    arr = storage.read()
+    return arr.isel({arr.dims[0]: slice(-sample, None)}).compute()
+
+
+def benchmark_codecs(arr: xarray.DataArray,
+                     candidates: Dict[str, Dict] = None,
+                     chunks: List[int] = None,
+                     n_repeats: int = 3) -> pd.DataFrame:
+    candidates = default_candidates if candidates is None else candidates
+    values = arr.values
+    chunks = chunks or True
+    results = []
+    for name, codecs in candidates.items():
+        settings = {}
+        if 'compressor' in codecs:
+            settings['compressor'] = ZarrStorage.get_codec(codecs['compressor'])
+        if codecs.get('filters') is not None:
+            settings['filters'] = [ZarrStorage.get_codec(codec) for codec in codecs['filters']]
+        # the delta filter needs the dtype of the data, so the candidates for other dtypes are skipped
+        if any(getattr(codec, 'dtype', values.dtype) != values.dtype for codec in settings.get('filters', [])):
+            continue
+
+        encode_time, decode_time = 0., 0.
+        for _ in range(n_repeats):
+            store = zarr.storage.MemoryStore()
+            start = time.perf_counter()
+            z = zarr.array(values, chunks=chunks, store=store, **settings)
+            encode_time += time.perf_counter() - start
+            start = time.perf_counter()
+            decoded = z[...]
+            decode_time += time.perf_counter() - start
+
+        lossless = np.array_equal(decoded, values, equal_nan=True)
+        results.append({
+            'codec': name,
+            'ratio': values.nbytes / z.nbytes_stored,
+            'encode_mb_s': values.nbytes * n_repeats / encode_time / 2 ** 20,
+            'decode_mb_s': values.nbytes * n_repeats / decode_time / 2 ** 20,
+            'lossless': lossless,
+            'max_error': 0. if lossless else float(np.nanmax(np.abs(decoded - values))),
+        })
+    return pd.DataFrame(results).sort_values('ratio', ascending=False)
+
+
+def run(base_path: str = None, path: str = None, name: str = 'data', sample: int = 1000):
+    if path is None:
+        arr = create_prices({'index': sample, 'columns': 500})
+    else:
+        arr = read_sample(base_path, path, name=name, sample=sample)
+    return benchmark_codecs(arr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base_path', default=None)
+    parser.add_argument('--path', default=None, help='Path of the tensor inside the base_path')
+    parser.add_argument('--name', default='data', help='Name of the data variable of the tensor')
+    parser.add_argument('--sample', type=int, default=1000, help='Number of labels of the first dim to use')
+    args = parser.parse_args()
+    print(run(args.base_path, args.path, name=args.name, sample=args.sample).to_string(index=False))
@@ -0,0 +1,118 @@
+"""
+Benchmark of the time to open a tensor with many variables using consolidated metadata and reading the metadata
+of every variable, it also simulate the latency of every request of a network file system or S3.
+
+Usage: python -m tensor_db.benchmarks.benchmark_consolidated
+"""
+
+import xarray
+import numpy as np
+import pandas as pd
+import tempfile
+import time
+import zarr
+
+from typing import Dict, List
+
+from tensor_db.file_handlers import ZarrStorage
+
+
+class LatencyStore(zarr.storage.Store):
+    """
+        LatencyStore
+        ----------
+        Read only wrapper of a store that wait latency seconds on every request, like a remote store
+    """
+
+    def __init__(self, store: zarr.storage.BaseStore, latency: float):
+        self.store = store
+        self.latency = latency
+        self.requests = 0
+
+    def _wait(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def __getitem__(self, key):
+        self._wait()
+        return self.store[key]
+
+    def __contains__(self, key):
+        self._wait()
+        return key in self.store
+
+    def __iter__(self):
+        self._wait()
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def listdir(self, path: str = None):
+        self._wait()
+        return self.store.listdir(path)
+
+    def __setitem__(self, key, value):
+        raise zarr.errors.ReadOnlyError()
+
+    def __delitem__(self, key):
+        raise zarr.errors.ReadOnlyError()
+
+
+def create_dataset(n_variables: int, sizes: Dict[str, int]) -> xarray.Dataset:
+    coords = {dim: np.arange(size) for dim, size in sizes.items()}
+    return xarray.Dataset(
+        {
+            f'data_{i}': xarray.DataArray(np.random.rand(*sizes.values()), dims=list(sizes.keys()), coords=coords)
+            for i in range(n_variables)
+        }
+    )
+
+
+def benchmark_open(n_variables: int,
+                   sizes: Dict[str, int],
+                   latency: float = 0.,
+                   n_opens: int = 5) -> Dict[str, float]:
+    results = {}
+    with tempfile.TemporaryDirectory() as base_path:
+        storage = ZarrStorage(base_path=base_path, path='benchmark', name='data_0', dims=list(sizes.keys()))
+        storage.store(create_dataset(n_variables, sizes))
+        store = LatencyStore(zarr.storage.DirectoryStore(storage.local_path), latency)
+        for consolidated in [True, False]:
+            store.requests = 0
+            start = time.perf_counter()
+            for _ in range(n_opens):
+                dataset = xarray.open_zarr(store, consolidated=consolidated)
+            elapsed = time.perf_counter() - start
+            assert len(dataset.data_vars) == n_variables
+            name = 'consolidated' if consolidated else 'not_consolidated'
+            results[name] = elapsed / n_opens
+            results[f'{name}_requests'] = store.requests / n_opens
+    return results
+
+
+def run(cases: List[Dict] = None):
+    cases = [
+        dict(n_variables=10, sizes={'index': 100, 'columns': 10}),
+        dict(n_variables=100, sizes={'index': 100, 'columns': 10}),
+        dict(n_variables=100, sizes={'index': 100, 'columns': 10}, latency=0.002),
+        dict(n_variables=500, sizes={'index': 100, 'columns': 10}, latency=0.002),
+    ] if cases is None else cases
+
+    # warm up, this avoid counting the time of the lazy imports of xarray and dask in the first case
+    benchmark_open(n_variables=1, sizes={'index': 10}, n_opens=1)
+
+    results = []
+    for case in cases:
+        times = benchmark_open(**case)
+        results.append({
+            'n_variables': case['n_variables'],
+            'latency': case.get('latency', 0.),
+            **times,
+            'speedup': times['not_consolidated'] / times['consolidated']
+        })
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    print(run().to_string(index=False))
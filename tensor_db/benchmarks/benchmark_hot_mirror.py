@@ -0,0 +1,66 @@
+"""
+Benchmark of the latency of reading a single row or column of a tensor using zarr and using the hot mirror
+(uncompressed memory mapped copy of the data), the data of both is in the page cache after the first read.
+
+Usage: python -m tensor_db.benchmarks.benchmark_hot_mirror
+"""
+
+import xarray
+import numpy as np
+import pandas as pd
+import tempfile
+import time
+
+from typing import Dict, List
+
+from tensor_db.file_handlers import ZarrStorage
+
+
+def benchmark_reads(sizes: Dict[str, int], chunks: Dict[str, int], n_reads: int = 200) -> List[Dict]:
+    arr = xarray.DataArray(
+        np.random.rand(*sizes.values()),
+        dims=list(sizes.keys()),
+        coords={dim: np.arange(size) for dim, size in sizes.items()}
+    )
+    dims = list(sizes.keys())
+    selections = {
+        'row': lambda i: {dims[0]: [i % sizes[dims[0]]]},
+        'column': lambda i: {dims[1]: [i % sizes[dims[1]]]},
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as base_path:
+        storage = ZarrStorage(base_path=base_path, path='benchmark', dims=dims, chunks=chunks, hot_mirror=True)
+        storage.store(arr)
+        for name, selection in selections.items():
+            times = {}
+            for mode, read in [('zarr', storage.read_as_dataset), ('hot_mirror', storage.read_hot)]:
+                # warm up, the chunks and the mirror are loaded in the page cache
+                np.asarray(read(sel=selection(0))['data'] if mode == 'zarr' else read(sel=selection(0)))
+                start = time.perf_counter()
+                for i in range(n_reads):
+                    data = read(sel=selection(i))
+                    np.asarray(data['data'] if mode == 'zarr' else data)
+                times[mode] = (time.perf_counter() - start) / n_reads * 1000
+            results.append({
+                'sizes': str(sizes),
+                'selection': name,
+                'zarr_ms': times['zarr'],
+                'hot_mirror_ms': times['hot_mirror'],
+                'speedup': times['zarr'] / times['hot_mirror'],
+            })
+    return results
+
+
+def run(cases: List[Dict] = None):
+    cases = [
+        dict(sizes={'index': 1000, 'columns': 1000}, chunks={'index': 100, 'columns': 1000}),
+        dict(sizes={'index': 5000, 'columns': 2000}, chunks={'index': 500, 'columns': 500}),
+    ] if cases is None else cases
+    results = []
+    for case in cases:
+        results.extend(benchmark_reads(**case))
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    print(run().to_string(index=False))
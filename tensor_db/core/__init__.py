@@ -1,2 +1,2 @@
 from tensor_db.core.tensor_db import TensorDB
-
+from tensor_db.core.async_tensor_db import AsyncTensorDB
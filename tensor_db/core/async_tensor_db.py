@@ -0,0 +1,102 @@
+import xarray
+import asyncio
+import functools
+
+from typing import Dict, List, Any, Union
+from concurrent.futures import ThreadPoolExecutor
+
+from tensor_db.core.tensor_db import TensorDB
+
+
+class AsyncTensorDB:
+    """
+        AsyncTensorDB
+        ----------
+        Asyncio facade of TensorDB, every action is executed in a thread pool so the blocking I/O of the handlers
+        (local files and S3 transfers) never blocks the event loop. The tensor definitions are the same
+        used by TensorDB, in fact all the actions are delegated to the tensor_db attribute.
+
+        max_concurrency limit the number of actions executed at the same time and max_concurrency_per_tensor limit
+        the number of actions executed at the same time over the same tensor, by default the actions over a tensor
+        are executed one by one to avoid writing it concurrently.
+
+        Example
+        -------
+            async_tensor_db = AsyncTensorDB(tensors_definition=tensors_definition, base_path=base_path)
+            data = await asyncio.gather(*[async_tensor_db.read(path) for path in paths])
+    """
+
+    def __init__(self,
+                 tensor_db: TensorDB = None,
+                 max_concurrency: int = None,
+                 max_concurrency_per_tensor: int = 1,
+                 **kwargs):
+        self.tensor_db = TensorDB(**kwargs) if tensor_db is None else tensor_db
+        self.max_concurrency_per_tensor = max_concurrency_per_tensor
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._tensors_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def _run(self, action_type: str, path: str, **kwargs) -> Any:
+        semaphore = self._tensors_semaphores.get(path)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency_per_tensor)
+            self._tensors_semaphores[path] = semaphore
+
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(getattr(self.tensor_db, action_type), path=path, **kwargs)
+            )
+
+    async def read(self, path: str, **kwargs) -> xarray.DataArray:
+        return await self._run('read', path=path, **kwargs)
+
+    async def append(self, path: str, **kwargs) -> Any:
+        return await self._run('append', path=path, **kwargs)
+
+    async def update(self, path: str, **kwargs) -> Any:
+        return await self._run('update', path=path, **kwargs)
+
+    async def store(self, path: str, **kwargs) -> Any:
+        return await self._run('store', path=path, **kwargs)
+
+    async def upsert(self, path: str, **kwargs) -> Any:
+        return await self._run('upsert', path=path, **kwargs)
+
+    async def backup(self, path: str, **kwargs) -> Any:
+        return await self._run('backup', path=path, **kwargs)
+
+    async def update_from_backup(self, path: str, **kwargs) -> Any:
+        return await self._run('update_from_backup', path=path, **kwargs)
+
+    async def close(self, path: str, **kwargs) -> Any:
+        return await self._run('close', path=path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> Any:
+        return await self._run('delete', path=path, **kwargs)
+
+    async def exist(self, path: str, **kwargs) -> bool:
+        return await self._run('exist', path=path, **kwargs)
+
+    async def read_coords(self, path: str, **kwargs) -> Dict[str, Any]:
+        return await self._run('read_coords', path=path, **kwargs)
+
+    async def read_many(self,
+                        paths: List[str],
+                        return_exceptions: bool = False,
+                        **kwargs) -> Dict[str, Union[xarray.DataArray, Exception]]:
+        results = await asyncio.gather(
+            *[self.read(path, **kwargs) for path in paths],
+            return_exceptions=return_exceptions
+        )
+        return dict(zip(paths, results))
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
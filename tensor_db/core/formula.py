@@ -0,0 +1,115 @@
+import xarray
+import numpy as np
+import ast
+import re
+
+from typing import Dict, Any, Set
+
+
+class Formula:
+    """
+        Formula
+        ----------
+        Compiled version of the formulas used by TensorDB.read_from_formula, the formula is parsed only once into
+        a python expression tree where every data field (the paths between backticks) is replaced by a variable,
+        so evaluating it only requires the data of the fields.
+
+        If the formula only apply element by element operations (arithmetic, comparisons and the methods in
+        elementwise_methods) the selections are applied over the data fields before evaluating the formula,
+        in other case (rolling, shift, cumsum, etc) the selection is applied over the result.
+
+        The names that the other methods receive as dims (keywords, keys of dicts and strings) are kept in
+        sequential_dims, they are the candidates to be dims where a coord depends on the previous ones.
+    """
+
+    elementwise_methods = {
+        'fillna', 'where', 'notnull', 'isnull', 'abs', 'astype', 'round', 'clip', '__neg__', '__abs__', '__invert__'
+    }
+    # variables that can be used on the formulas apart of the data fields
+    global_variables = {'xarray': xarray, 'np': np, 'nan': np.nan}
+
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.data_fields: Dict[str, str] = {}
+
+        def replace_data_field(match) -> str:
+            variable = self.data_fields.setdefault(match.group(1), f"_data_field_{len(self.data_fields)}")
+            return variable
+
+        expression = re.sub(r'`([^`]+)`', replace_data_field, formula)
+        self.tree = ast.parse(expression.strip(), mode='eval')
+        self.code = compile(self.tree, filename='<formula>', mode='eval')
+        self.is_elementwise = self._is_elementwise(self.tree.body)
+        self.sequential_dims = self._get_sequential_dims(self.tree.body)
+
+    def evaluate(self,
+                 data_fields: Dict[str, xarray.DataArray],
+                 sel: Dict[str, Any] = None) -> xarray.DataArray:
+        """
+        Evaluate the formula, data_fields must contain the data of every path used on the formula,
+        the data is never loaded so if it is dask-backed the result is evaluated lazily.
+
+        The labels of sel that does not exist on the data are ignored
+        """
+        if sel is not None and self.is_elementwise:
+            data_fields = {path: self.select(data, sel) for path, data in data_fields.items()}
+            sel = None
+
+        variables = {variable: data_fields[path] for path, variable in self.data_fields.items()}
+        result = eval(self.code, dict(self.global_variables), variables)
+        if sel is not None:
+            result = self.select(result, sel)
+        return result
+
+    @staticmethod
+    def select(data: xarray.DataArray, sel: Dict[str, Any]) -> xarray.DataArray:
+        sel = {
+            dim: data.indexes[dim][np.asarray(labels(data.indexes[dim].values), dtype=bool)] if callable(labels) else
+            labels if isinstance(labels, slice) or np.ndim(labels) == 0 else
+            np.asarray(labels)[data.indexes[dim].get_indexer(np.asarray(labels)) != -1]
+            for dim, labels in sel.items()
+        }
+        return data.sel(sel)
+
+    def _is_elementwise(self, node: ast.AST) -> bool:
+        if isinstance(node, (ast.Name, ast.Constant)):
+            return True
+        if isinstance(node, ast.BinOp):
+            return self._is_elementwise(node.left) and self._is_elementwise(node.right)
+        if isinstance(node, ast.UnaryOp):
+            return self._is_elementwise(node.operand)
+        if isinstance(node, ast.BoolOp):
+            return all(self._is_elementwise(value) for value in node.values)
+        if isinstance(node, ast.Compare):
+            return self._is_elementwise(node.left) and all(self._is_elementwise(c) for c in node.comparators)
+        if isinstance(node, ast.Call):
+            return (
+                isinstance(node.func, ast.Attribute) and
+                node.func.attr in self.elementwise_methods and
+                self._is_elementwise(node.func.value) and
+                all(self._is_elementwise(arg) for arg in node.args) and
+                all(self._is_elementwise(keyword.value) for keyword in node.keywords)
+            )
+        return False
+
+    def _get_sequential_dims(self, tree: ast.AST) -> Set[str]:
+        dims = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+                continue
+            if node.func.attr in self.elementwise_methods:
+                continue
+            values = list(node.args)
+            for keyword in node.keywords:
+                if keyword.arg in ['dim', 'dims']:
+                    values.append(keyword.value)
+                elif keyword.arg is not None:
+                    dims.add(keyword.arg)
+            for value in values:
+                candidates = value.keys if isinstance(value, ast.Dict) else \
+                    value.elts if isinstance(value, (ast.List, ast.Tuple)) else [value]
+                dims.update(
+                    candidate.value for candidate in candidates
+                    if isinstance(candidate, ast.Constant) and isinstance(candidate.value, str)
+                )
+        return dims
@@ -1,8 +1,13 @@
 import xarray
+import numpy as np
 import os
 import json
+import shutil
+import threading
 
-from typing import Dict, List, Any, Union
+from typing import Dict, List, Any, Union, Tuple, Set, Callable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from numpy import nan
 from pandas import Timestamp
 from loguru import logger
@@ -11,7 +16,11 @@ from tensor_db.file_handlers import (
     ZarrStorage,
     BaseStorage
 )
-from tensor_db.backup_handlers import S3Handler
+from tensor_db.backup_handlers import S3Handler, BackupManifest
+from tensor_db.core.utils import get_dir_size
+from tensor_db.core.formula import Formula
+from tensor_db.metrics import Metrics
+from tensor_db import metrics as metrics_hooks
 
 
 class TensorDB:
@@ -26,11 +35,38 @@ class TensorDB:
 
         Notes
         -----
-        1) This class does not have any kind of concurrency but of course the internal handler could have
+        1) This class does not have any kind of concurrency (apart of the recalculation of the dependants of a tensor)
+        but of course the internal handler could have
 
         2) The actual recommend option to handle the files is using the zarr handler class which allow to write and read
         concurrently
 
+        3) The reads can be cached in memory using the read_cache_bytes option, the cache is bounded by the bytes of
+        the data and evicted in LRU order, every write action on a tensor invalidate its entries. Only the tensors that
+        are read using the handler are cached, the personalized reads (like the formulas) are always recomputed so
+        they never return stale data.
+
+        4) The handlers are cached in open_base_store, max_open_handlers limit the number of handlers and
+        max_files_on_disk and max_disk_bytes limit the number of tensors and the bytes that are kept on the local disk,
+        the handlers are evicted using the eviction_policy ('lru' or 'lfu') and they are always closed (backup) before
+        being dropped, the local files are deleted only if the handler has a backup.
+
+        5) With use_backup_manifest all the tensors of a bucket share a BackupManifest with the versions of their
+        backups, so checking if the tensors are equal to their backups only needs one request (cached during
+        backup_manifest_ttl seconds).
+
+        6) The data methods of a tensor are applied as a single lazy pipeline, new_data is chunked with
+        data_methods_chunks (None disable it) and every method only adds steps to the dask graph, so the whole
+        pipeline is computed once, chunk by chunk in parallel, and the elementwise steps (where, fillna, etc) of
+        every chunk are fused in a single task without materializing the intermediate arrays. The data with
+        object dtype (like strings) is not chunked, because dask can not chunk it automatically.
+
+        7) Every action is tracked by the metrics hook (see tensor_db.metrics), it records the latency of the action
+        and of the operations inside it (handler creation, coords reads, zarr writes, S3 transfers) and the bytes,
+        chunks, S3 requests and read cache hits used, labeled by the tensor and the action. By default the metrics
+        are disabled, InMemoryMetrics aggregate them and PrometheusExporter export them in the text format of
+        Prometheus.
+
         TODO
         ----
         1) Add methods to validate the data, for example should be useful to check the proportion of missing data
@@ -38,28 +74,70 @@ class TensorDB:
         2) Add more methods to modify the data like bfill or other xarray methods that can be improved when
             appending data.
         3) Add other backup methods, currently the class only work with S3Handler
-        4) Enable the max_files_on_disk option, this will allow to establish a maximum number of files that can be
-            save in memory
-        5) The tensors settings must be saved on disk and after that a backup is necessary, probably one solution
+        4) The tensors settings must be saved on disk and after that a backup is necessary, probably one solution
             for this is create a ZarrStorage for saving all the files settings (this has a lot of limitation due to
             the zarr way to save strings which is basically an array of fixed size) or simple use a json and make a
             manual backup and allow check the last modified date from S3 (create an extra class for this would be ideal)
             or simple use the attrs of Zarr and ZarrStorage
     """
 
+    write_actions = ['store', 'update', 'append', 'upsert', 'delete', 'update_from_backup']
+    # arguments that does not modify the data returned by a read (the cached data is always loaded in memory,
+    # so the chunks are irrelevant), they are ignored for the read cache
+    internal_arguments = ['handler', 'tensor_definition', 'action_type', 'new_data', 'chunks']
+    # data methods that can be applied only over the modified coords of a tensor
+    incremental_methods = [
+        'read_from_formula', 'fillna', 'ffill', 'replace_values', 'replace_last_valid_dim', 'reindex', 'last_valid_dim'
+    ]
+    # data methods whose result in a coord only depends on the same coord of the data
+    pointwise_methods = ['read_from_formula', 'fillna', 'replace_values', 'replace_last_valid_dim']
+
     def __init__(self,
                  tensors_definition: Dict[str, Dict[str, Any]],
                  base_path: str,
                  use_env: bool = False,
                  s3_settings: Union[Dict[str, str], S3Handler] = None,
                  max_files_on_disk: int = 0,
+                 max_open_handlers: int = 0,
+                 max_disk_bytes: int = 0,
+                 eviction_policy: str = 'lru',
+                 read_cache_bytes: int = 0,
+                 auto_update_dependants: bool = False,
+                 use_backup_manifest: bool = False,
+                 backup_manifest_ttl: float = 60,
+                 data_methods_chunks: Union[str, Dict[str, int]] = 'auto',
+                 metrics: Metrics = None,
                  **kwargs):
 
         self.env_mode = os.getenv("ENV_MODE") if use_env else ""
         self.base_path = os.path.join(base_path, 'tensors_files_storage', self.env_mode)
         self._tensors_definition = tensors_definition
-        self.open_base_store: Dict[str, Dict[str, Any]] = {}
+        self.open_base_store: Dict[str, Dict[str, Any]] = OrderedDict()
+        self.local_files_usage: Dict[str, Dict[str, Any]] = OrderedDict()
         self.max_files_on_disk = max_files_on_disk
+        self.max_open_handlers = max_open_handlers
+        self.max_disk_bytes = max_disk_bytes
+        if eviction_policy not in ['lru', 'lfu']:
+            raise ValueError(f"{eviction_policy} is not a valid option for the eviction_policy")
+        self.eviction_policy = eviction_policy
+        self.handlers_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        self.read_cache_bytes = read_cache_bytes
+        self.read_cache: Dict[Any, xarray.DataArray] = OrderedDict()
+        self.read_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        # every invalidation increase the version of the path, so a read that was running during a write
+        # does not store its data on the cache
+        self._read_cache_versions: Dict[str, int] = {}
+        self.formulas_cache: Dict[str, Formula] = {}
+        self.auto_update_dependants = auto_update_dependants
+        self.use_backup_manifest = use_backup_manifest
+        self.backup_manifest_ttl = backup_manifest_ttl
+        self.backup_manifests: Dict[str, BackupManifest] = {}
+        self.data_methods_chunks = data_methods_chunks
+        self.metrics = Metrics() if metrics is None else metrics
+        # protect the caches of handlers and data when the actions are executed from multiple threads
+        self._lock = threading.RLock()
+        # the handlers that are being closed by an eviction out of the lock, with the event set after closing them
+        self._closing_handlers: Dict[str, Tuple[threading.Event, Dict[str, Any]]] = {}
 
         if use_env:
             self.base_path = os.path.join(self.base_path, os.getenv("ENV_MODE"))
@@ -79,24 +157,227 @@ class TensorDB:
         return self._tensors_definition[tensor_definition_id]
 
     def _get_handler(self, path: Union[str, List], tensor_definition: Dict = None) -> BaseStorage:
-        handler_settings = self.get_tensor_definition(path) if tensor_definition is None else tensor_definition
-        handler_settings = handler_settings.get('handler', {})
+        tensor_definition = self.get_tensor_definition(path) if tensor_definition is None else tensor_definition
+        handler_settings = tensor_definition.get('handler', {})
         local_path = self._complete_path(tensor_definition=handler_settings, path=path)
-        if local_path not in self.open_base_store:
-            self.open_base_store[local_path] = {
-                'data_handler': handler_settings.get('data_handler', ZarrStorage)(
-                    base_path=self.base_path,
-                    path=self._complete_path(tensor_definition=handler_settings, path=path, omit_base_path=True),
-                    s3_handler=self.s3_handler,
-                    **handler_settings
-                ),
-                'first_read_date': Timestamp.now(),
-                'num_use': 0
-            }
-        self.open_base_store[local_path]['num_use'] += 1
-        return self.open_base_store[local_path]['data_handler']
+        while True:
+            with self._lock:
+                closing = self._closing_handlers.get(local_path)
+                if closing is None:
+                    created = local_path not in self.open_base_store
+                    if created:
+                        self.handlers_stats['misses'] += 1
+                        with metrics_hooks.timer('handler_creation'):
+                            self.open_base_store[local_path] = {
+                                'data_handler': self._create_handler(path, tensor_definition),
+                                'first_read_date': Timestamp.now(),
+                                'num_use': 0
+                            }
+                    else:
+                        self.handlers_stats['hits'] += 1
+
+                    self.open_base_store.move_to_end(local_path)
+                    self.open_base_store[local_path]['num_use'] += 1
+                    self.open_base_store[local_path]['last_read_date'] = Timestamp.now()
+                    handler = self.open_base_store[local_path]['data_handler']
+                    calculate_size = local_path not in self.local_files_usage
+                    break
+            # the previous handler of the tensor is being closed by an eviction, so the new one is created after it
+            closing.wait()
+
+        # the evicted handlers are closed (and backed up) out of the lock, so they do not block the other actions
+        if created:
+            self._evict_handlers(exclude=local_path)
+        if self._limit_disk_usage():
+            self._update_local_files_usage(local_path, calculate_size=calculate_size)
+        return handler
+
+    def _create_handler(self, path: Union[str, List], tensor_definition: Dict) -> BaseStorage:
+        handler_settings = tensor_definition.get('handler', {})
+        extra_settings = {}
+        if self.use_backup_manifest and self.s3_handler is not None and 'bucket_name' in handler_settings:
+            extra_settings['backup_manifest'] = self.get_backup_manifest(handler_settings['bucket_name'])
+        # the tensors calculated with ffill maintain their last valid values, so the appends do not
+        # need to read the stored data
+        data_handler = handler_settings.get('data_handler', ZarrStorage)
+        if 'ffill' in tensor_definition.get('store', {}).get('data_methods', []) and \
+                isinstance(data_handler, type) and issubclass(data_handler, ZarrStorage):
+            extra_settings['last_valid_dim'] = tensor_definition.get('ffill', {}).get('dim')
+        return data_handler(
+            base_path=self.base_path,
+            path=self._complete_path(tensor_definition=handler_settings, path=path, omit_base_path=True),
+            s3_handler=self.s3_handler,
+            **{**extra_settings, **handler_settings}
+        )
+
+    def get_backup_manifest(self, bucket_name: str) -> BackupManifest:
+        with self._lock:
+            if bucket_name not in self.backup_manifests:
+                s3_handler = self.s3_handler
+                if isinstance(s3_handler, dict):
+                    s3_handler = S3Handler(**s3_handler)
+                self.backup_manifests[bucket_name] = BackupManifest(
+                    s3_handler=s3_handler,
+                    bucket_name=bucket_name,
+                    ttl=self.backup_manifest_ttl
+                )
+            return self.backup_manifests[bucket_name]
+
+    def get_handlers_stats(self) -> Dict[str, int]:
+        return {
+            **self.handlers_stats,
+            'open_handlers': len(self.open_base_store),
+            'files_on_disk': len(self.local_files_usage),
+            'disk_bytes': sum(usage['disk_bytes'] for usage in self.local_files_usage.values())
+        }
+
+    def _select_victim(self, entries: Dict[str, Dict[str, Any]], exclude: Set[str], **filters) -> Union[str, None]:
+        candidates = [
+            local_path for local_path, entry in entries.items()
+            if local_path not in exclude and all(entry[k] == v for k, v in filters.items())
+        ]
+        if len(candidates) == 0:
+            return None
+        if self.eviction_policy == 'lfu':
+            # the candidates are sorted from the least to the most recently used, so min keep the LRU order on ties
+            return min(candidates, key=lambda local_path: entries[local_path]['num_use'])
+        return candidates[0]
+
+    def _pop_victim(self, entries: Dict[str, Dict[str, Any]], exceed_limits: Callable[[], bool],
+                    exclude: Set[str], **filters) -> Union[str, None]:
+        """
+        Select a victim and drop its handler from the open handlers, this must be called holding the lock.
+        The tensor is marked as closing until _release_victim is called, so no other handler is created for it
+        """
+        if not exceed_limits():
+            return None
+        local_path = self._select_victim(entries, exclude=exclude | set(self._closing_handlers), **filters)
+        if local_path is not None:
+            self._closing_handlers[local_path] = (threading.Event(), self.open_base_store.pop(local_path, None))
+        return local_path
+
+    def _release_victim(self, local_path: str, keep_open: bool):
+        """
+        If keep_open is True the handler is added again as the least recently used, so a handler that
+        could not be closed is kept open with its modifications, this must be called holding the lock
+        """
+        closing, handler_settings = self._closing_handlers.pop(local_path)
+        if keep_open and handler_settings is not None:
+            self.open_base_store[local_path] = handler_settings
+            self.open_base_store.move_to_end(local_path, last=False)
+        closing.set()
+
+    def _evict_handlers(self, exclude: str = None):
+        # the handlers that can not be closed are kept, the eviction must not fail the action that triggered it
+        excluded = {exclude}
+        while True:
+            with self._lock:
+                local_path = self._pop_victim(
+                    self.open_base_store,
+                    exceed_limits=lambda: 0 < self.max_open_handlers < len(self.open_base_store),
+                    exclude=excluded
+                )
+            if local_path is None:
+                break
+            closed = False
+            try:
+                self._closing_handlers[local_path][1]['data_handler'].close()
+                closed = True
+            except Exception as e:
+                logger.error(f"Error closing the handler of {local_path} during its eviction: {e!r}")
+                excluded.add(local_path)
+            finally:
+                with self._lock:
+                    self._release_victim(local_path, keep_open=not closed)
+                    self.handlers_stats['evictions'] += closed
+
+    def _limit_disk_usage(self) -> bool:
+        return self.max_files_on_disk > 0 or self.max_disk_bytes > 0
+
+    def _update_local_files_usage(self, local_path: str, calculate_size: bool = True):
+        with self._lock:
+            if not os.path.exists(local_path) or local_path not in self.open_base_store:
+                self.local_files_usage.pop(local_path, None)
+                return
+            handler = self.open_base_store[local_path]['data_handler']
+            usage = self.local_files_usage.setdefault(local_path, {'disk_bytes': 0, 'num_use': 0})
+            if calculate_size:
+                usage['disk_bytes'] = get_dir_size(local_path)
+            usage['num_use'] = self.open_base_store[local_path]['num_use']
+            # the s3_handler is sent to all the handlers, so only the tensors with a bucket have a backup
+            usage['has_backup'] = (
+                getattr(handler, 's3_handler', None) is not None and getattr(handler, 'bucket_name', None) is not None
+            )
+            usage['data_handler'] = handler
+            self.local_files_usage.move_to_end(local_path)
+        self._evict_local_files(exclude=local_path)
+
+    def _evict_local_files(self, exclude: str = None):
+        def exceed_limits():
+            return (
+                    0 < self.max_files_on_disk < len(self.local_files_usage) or
+                    0 < self.max_disk_bytes < sum(usage['disk_bytes'] for usage in self.local_files_usage.values())
+            )
+
+        while True:
+            # only the files that can be restored from a backup can be deleted
+            with self._lock:
+                local_path = self._pop_victim(
+                    self.local_files_usage, exceed_limits=exceed_limits, exclude={exclude}, has_backup=True
+                )
+            if local_path is None:
+                break
+            handler_settings = self._closing_handlers[local_path][1]
+            closed = handler_settings is None
+            deleted = False
+            try:
+                if not closed:
+                    handler_settings['data_handler'].close()
+                    closed = True
+            except Exception as e:
+                logger.error(f"Error closing the handler of {local_path} before deleting its files: {e!r}")
+            try:
+                if not getattr(self.local_files_usage[local_path]['data_handler'], 'check_modification', True):
+                    if os.path.exists(local_path):
+                        shutil.rmtree(local_path)
+                    deleted = True
+            finally:
+                with self._lock:
+                    if deleted:
+                        del self.local_files_usage[local_path]
+                        self.handlers_stats['disk_evictions'] += 1
+                    else:
+                        # the backup failed or does not contain all the modifications, so the files are kept and
+                        # the tensor is not a candidate until it is used again
+                        self.local_files_usage[local_path]['has_backup'] = False
+                    self._release_victim(local_path, keep_open=not closed)
 
     def _personalize_handler_action(self, path: str, action_type: str, **kwargs):
+        with self.metrics.track(tensor=path, action=action_type):
+            return self._track_handler_action(path=path, action_type=action_type, **kwargs)
+
+    def _track_handler_action(self, path: str, action_type: str, **kwargs):
+        if action_type not in self.write_actions:
+            return self._apply_handler_action(path=path, action_type=action_type, **kwargs)
+
+        try:
+            result = self._apply_handler_action(path=path, action_type=action_type, **kwargs)
+        finally:
+            self._invalidate_read_cache(path)
+
+        if self.auto_update_dependants and kwargs.get('update_dependants', True):
+            if action_type in ['append', 'update', 'upsert'] and kwargs.get('new_data') is not None:
+                new_data = kwargs['new_data']
+                # the blocks of an iterable were consumed by the write, so the dependants are calculated again
+                coords = None
+                if isinstance(new_data, (xarray.DataArray, xarray.Dataset)):
+                    coords = {dim: new_data.coords[dim].values for dim in new_data.dims}
+                self.update_dependants(path=path, coords=coords, action_type=action_type)
+            elif action_type == 'store':
+                self.update_dependants(path=path)
+        return result
+
+    def _apply_handler_action(self, path: str, action_type: str, **kwargs):
         tensor_definition = self.get_tensor_definition(path)
         kwargs.update({
             'action_type': action_type,
@@ -114,10 +395,69 @@ class TensorDB:
         if 'data_methods' in method_settings:
             kwargs['new_data'] = self._apply_data_methods(data_methods=method_settings['data_methods'], **kwargs)
 
-        return getattr(kwargs['handler'], action_type)(**{**kwargs, **method_settings})
+        result = getattr(kwargs['handler'], action_type)(**{**kwargs, **method_settings})
+        if self._limit_disk_usage():
+            local_path = self._complete_path(tensor_definition=tensor_definition.get('handler', {}), path=path)
+            # any action can restore the files from the backup, so the new files must be tracked too
+            modify_files = action_type in ['store', 'update', 'append', 'upsert', 'update_from_backup']
+            if local_path in self.open_base_store and (modify_files or local_path not in self.local_files_usage):
+                self._update_local_files_usage(local_path)
+        return result
 
     def read(self, path: str, **kwargs) -> xarray.DataArray:
-        return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'read'}})
+        # the hits of the read cache are tracked too, so the latencies of the reads are not biased
+        with self.metrics.track(tensor=path, action='read'):
+            return self._read(path=path, **kwargs)
+
+    def _read(self, path: str, **kwargs) -> xarray.DataArray:
+        key = self._get_read_cache_key(path, **kwargs)
+        if key is None:
+            return self._track_handler_action(path=path, **{**kwargs, **{'action_type': 'read'}})
+
+        with self._lock:
+            if key in self.read_cache:
+                self.read_cache_stats['hits'] += 1
+                metrics_hooks.increment('read_cache_hits')
+                self.read_cache.move_to_end(key)
+                return self.read_cache[key].copy()
+            self.read_cache_stats['misses'] += 1
+            version = self._read_cache_versions.get(path, 0)
+        metrics_hooks.increment('read_cache_misses')
+
+        data = self._track_handler_action(path=path, **{**kwargs, **{'action_type': 'read'}})
+        # the size of lazy data is known without computing it, so the data that does not fit is kept lazy
+        if data.nbytes <= self.read_cache_bytes:
+            data = data.load()
+            with self._lock:
+                if self._read_cache_versions.get(path, 0) == version:
+                    self.read_cache[key] = data
+                    self._evict_read_cache()
+            return data.copy()
+        return data
+
+    def _get_read_cache_key(self, path: str, **kwargs):
+        if self.read_cache_bytes <= 0:
+            return None
+        if 'personalized_method' in self.get_tensor_definition(path).get('read', {}):
+            return None
+        key = (path, tuple(sorted((k, v) for k, v in kwargs.items() if k not in self.internal_arguments)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _evict_read_cache(self):
+        while sum(data.nbytes for data in self.read_cache.values()) > self.read_cache_bytes:
+            self.read_cache.popitem(last=False)
+            self.read_cache_stats['evictions'] += 1
+
+    def _invalidate_read_cache(self, path: str):
+        with self._lock:
+            self._read_cache_versions[path] = self._read_cache_versions.get(path, 0) + 1
+            for key in [key for key in self.read_cache.keys() if key[0] == path]:
+                del self.read_cache[key]
+                self.read_cache_stats['invalidations'] += 1
 
     def append(self, path: str, **kwargs) -> xarray.DataArray:
         return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'append'}})
@@ -128,6 +468,9 @@ class TensorDB:
     def store(self, path: str, **kwargs) -> xarray.DataArray:
         return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'store'}})
 
+    def upsert(self, path: str, **kwargs) -> xarray.DataArray:
+        return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'upsert'}})
+
     def backup(self, path: str, **kwargs) -> xarray.DataArray:
         return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'backup'}})
 
@@ -140,6 +483,152 @@ class TensorDB:
     def delete(self, path: str, **kwargs) -> xarray.DataArray:
         return self._personalize_handler_action(path=path, **{**kwargs, **{'action_type': 'delete'}})
 
+    def read_many(self,
+                  paths: List[str],
+                  max_workers: int = None,
+                  **kwargs) -> Tuple[Dict[str, xarray.DataArray], Dict[str, Exception]]:
+        return self._apply_many('read', {path: kwargs for path in paths}, max_workers=max_workers)
+
+    def store_many(self,
+                   new_data: Dict[str, xarray.DataArray],
+                   max_workers: int = None,
+                   backup: bool = False,
+                   **kwargs) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        """
+        Store multiple tensors in parallel, new_data maps every path to its data (it can be None for the tensors
+        that are calculated using data methods)
+        """
+        arguments = {path: {'new_data': data, **kwargs} for path, data in new_data.items()}
+        return self._apply_many('store', arguments, max_workers=max_workers, backup=backup)
+
+    def append_many(self,
+                    new_data: Dict[str, xarray.DataArray],
+                    max_workers: int = None,
+                    backup: bool = False,
+                    **kwargs) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        arguments = {path: {'new_data': data, **kwargs} for path, data in new_data.items()}
+        return self._apply_many('append', arguments, max_workers=max_workers, backup=backup)
+
+    def update_many(self,
+                    new_data: Dict[str, xarray.DataArray],
+                    max_workers: int = None,
+                    backup: bool = False,
+                    **kwargs) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        arguments = {path: {'new_data': data, **kwargs} for path, data in new_data.items()}
+        return self._apply_many('update', arguments, max_workers=max_workers, backup=backup)
+
+    def upsert_many(self,
+                    new_data: Dict[str, xarray.DataArray],
+                    max_workers: int = None,
+                    backup: bool = False,
+                    **kwargs) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        arguments = {path: {'new_data': data, **kwargs} for path, data in new_data.items()}
+        return self._apply_many('upsert', arguments, max_workers=max_workers, backup=backup)
+
+    def backup_many(self, paths: List[str], **kwargs) -> Tuple[Dict[str, bool], Dict[str, Exception]]:
+        """
+        Backup multiple tensors uploading all their files in a single batch for every S3 handler,
+        the result of every path indicates if any file was uploaded
+        """
+        results, errors = {}, {}
+        batches = {}
+        for path in paths:
+            try:
+                with self.metrics.track(tensor=path, action='backup'):
+                    handler = self._get_handler(path)
+                    files = handler.get_backup_files(**kwargs)
+            except Exception as e:
+                errors[path] = e
+                continue
+            results[path] = len(files) > 0
+            if len(files) > 0:
+                batch = batches.setdefault(id(handler.s3_handler), {'s3_handler': handler.s3_handler, 'handlers': {}})
+                batch['handlers'][path] = handler
+                batch.setdefault('files', []).extend(files)
+
+        for batch in batches.values():
+            try:
+                # the files of all the tensors of the batch are uploaded together, so they are not labeled by tensor
+                with self.metrics.track(tensor=None, action='backup'):
+                    batch['s3_handler'].upload_files(batch['files'])
+            except Exception as e:
+                errors.update({path: e for path in batch['handlers']})
+                continue
+            # the manifests are updated with a single write per batch
+            manifests = {}
+            for path, handler in batch['handlers'].items():
+                with self.metrics.track(tensor=path, action='backup'):
+                    handler.complete_backup(update_manifest=False)
+                manifest = getattr(handler, 'backup_manifest', None)
+                if manifest is not None:
+                    manifests.setdefault(id(manifest), {'manifest': manifest, 'paths': {}})['paths'][path] = handler
+            for manifest in manifests.values():
+                try:
+                    manifest['manifest'].set_versions({
+                        handler.path: handler.get_backup_version() for handler in manifest['paths'].values()
+                    })
+                except Exception as e:
+                    errors.update({path: e for path in manifest['paths']})
+
+        return {path: result for path, result in results.items() if path not in errors}, errors
+
+    def _apply_many(self,
+                    action_type: str,
+                    arguments: Dict[str, Dict[str, Any]],
+                    max_workers: int = None,
+                    backup: bool = False) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        """
+        Apply the action over multiple tensors using a thread pool, the errors are collected per path
+        so a failure in a tensor does not stop the others
+        """
+        is_write_action = action_type in self.write_actions
+        results, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                path: executor.submit(
+                    getattr(self, action_type),
+                    path=path,
+                    **{**path_kwargs, **({'update_dependants': False} if is_write_action else {})}
+                )
+                for path, path_kwargs in arguments.items()
+            }
+            for path, future in futures.items():
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    errors[path] = e
+
+        if is_write_action and self.auto_update_dependants:
+            # the dependants are updated after all the actions to avoid updating the same tensor in parallel
+            for path in list(results.keys()):
+                new_data = arguments[path].get('new_data')
+                coords = None
+                if action_type != 'store' and new_data is not None:
+                    coords = {dim: new_data.coords[dim].values for dim in new_data.dims}
+                try:
+                    self.update_dependants(path=path, coords=coords, action_type=action_type)
+                except Exception as e:
+                    errors[path] = e
+                    del results[path]
+
+        if backup:
+            _, backup_errors = self.backup_many([path for path in results if path not in errors])
+            for path, error in backup_errors.items():
+                errors[path] = error
+                del results[path]
+
+        return results, errors
+
+    def read_coords(self, path: str, **kwargs) -> Dict[str, Any]:
+        """
+        Read only the coords of the tensor, for the tensors that are not read using a personalized method
+        this is done using the coords index of the handler, so the data is never opened
+        """
+        if 'personalized_method' in self.get_tensor_definition(path).get('read', {}):
+            return {dim: coord.values for dim, coord in self.read(path=path, **kwargs).coords.items()}
+        with self.metrics.track(tensor=path, action='read_coords'):
+            return self._get_handler(path).read_coords(**kwargs)
+
     def exist(self,
               path: str,
               **kwargs):
@@ -150,6 +639,168 @@ class TensorDB:
             **kwargs
         )
 
+    def get_dependencies(self, path: str) -> List[str]:
+        """
+        Paths of the tensors used to calculate the tensor, they are extracted from the formula and from
+        the reindex_path and replace_path settings of the data methods
+        """
+        tensor_definition = self.get_tensor_definition(path)
+        dependencies = []
+        if 'read_from_formula' in tensor_definition:
+            dependencies.extend(self.get_formula(tensor_definition['read_from_formula']['formula']).data_fields)
+        for method_settings in tensor_definition.values():
+            if not isinstance(method_settings, dict):
+                continue
+            for key in ['reindex_path', 'replace_path']:
+                if key in method_settings:
+                    dependencies.append(method_settings[key])
+        return list(dict.fromkeys(dependencies))
+
+    def get_dependency_graph(self) -> Dict[str, List[str]]:
+        return {path: self.get_dependencies(path) for path in self._tensors_definition}
+
+    def get_dependants_levels(self, path: str) -> List[List[str]]:
+        """
+        Tensors that depend directly or indirectly on path sorted in topological order, every level only
+        depends on the previous levels so the tensors of a level can be calculated in parallel
+        """
+        graph = self.get_dependency_graph()
+        dependants = {}
+        for tensor, dependencies in graph.items():
+            for dependency in dependencies:
+                dependants.setdefault(dependency, []).append(tensor)
+
+        affected, pending = set(), [path]
+        while pending:
+            for dependant in dependants.get(pending.pop(), []):
+                if dependant not in affected:
+                    affected.add(dependant)
+                    pending.append(dependant)
+
+        levels, calculated = [], {path}
+        while affected:
+            level = [
+                tensor for tensor in graph
+                if tensor in affected and all(d in calculated or d not in affected for d in graph[tensor])
+            ]
+            if len(level) == 0:
+                raise ValueError(f"There is a circular dependency between the tensors {sorted(affected)}")
+            levels.append(level)
+            calculated.update(level)
+            affected.difference_update(level)
+        return levels
+
+    def update_dependants(self,
+                          path: str,
+                          coords: Dict[str, Any] = None,
+                          action_type: str = 'update',
+                          max_workers: int = None):
+        """
+        Recalculate the tensors that depend on path after modifying it, the tensors are calculated in topological
+        order and the tensors of the same level are calculated in parallel.
+
+        coords are the coords modified on path (for example the coords of the new data appended or updated), if
+        they are sent only those coords of the dependants are recalculated using the data methods of the store
+        definition and an upsert, in other case the dependants are stored again.
+        """
+        modified_coords = {path: coords}
+        for level in self.get_dependants_levels(path):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    tensor: executor.submit(
+                        self._update_dependant,
+                        path=tensor,
+                        modified_coords=modified_coords,
+                        action_type=action_type
+                    )
+                    for tensor in level
+                }
+            modified_coords.update({tensor: future.result() for tensor, future in futures.items()})
+
+    def _update_dependant(self,
+                          path: str,
+                          modified_coords: Dict[str, Dict[str, Any]],
+                          action_type: str) -> Union[Dict[str, Any], None]:
+        tensor_definition = self.get_tensor_definition(path)
+        data_methods = tensor_definition.get('store', {}).get('data_methods', [])
+        if len(data_methods) == 0:
+            # the tensor is not stored (for example a formula that is calculated on every read),
+            # so only the tensors that depend on it must be recalculated
+            return self._merge_modified_coords(self.get_dependencies(path), modified_coords)
+
+        formula_fields = []
+        if 'read_from_formula' in tensor_definition:
+            formula_fields = list(self.get_formula(tensor_definition['read_from_formula']['formula']).data_fields)
+        modified_dependencies = [d for d in self.get_dependencies(path) if d in modified_coords]
+        coords = self._merge_modified_coords(modified_dependencies, modified_coords)
+
+        incremental = (
+            tensor_definition.get('incremental', True) and
+            coords is not None and
+            all(d in formula_fields for d in modified_dependencies) and
+            all(method in self.incremental_methods for method in data_methods) and
+            self.exist(path)
+        )
+        if not incremental:
+            self.store(path=path, update_dependants=False)
+            return None
+
+        pointwise = all(method in self.pointwise_methods for method in data_methods) and (
+            'read_from_formula' not in tensor_definition or
+            self.get_formula(tensor_definition['read_from_formula']['formula']).is_elementwise
+        )
+        if action_type != 'append' and not pointwise:
+            # a modification in the middle of the data also modify the next coords of the tensor on the dims
+            # of the ffill, rolling, etc, so all the coords after the first modified label are recalculated on them,
+            # if those dims are unknown all the dims are extended
+            act_coords = self.read_coords(path)
+            sequential_dims = self._get_sequential_dims(tensor_definition, data_methods) & set(coords)
+            sequential_dims = sequential_dims or set(coords)
+            coords = {
+                dim: np.union1d(labels, act_coords[dim][act_coords[dim] >= np.min(labels)])
+                if dim in act_coords and dim in sequential_dims else labels
+                for dim, labels in coords.items()
+            }
+
+        new_data = self._apply_data_methods(
+            data_methods=data_methods,
+            tensor_definition=tensor_definition,
+            handler=self._get_handler(path=path, tensor_definition=tensor_definition),
+            action_type='upsert',
+            sel=coords
+        )
+        self.upsert(path=path, new_data=new_data, update_dependants=False)
+        return {dim: new_data.coords[dim].values for dim in new_data.dims}
+
+    def _get_sequential_dims(self, tensor_definition: Dict, data_methods: List[str]) -> Set[str]:
+        """
+        Dims where the value of a coord depends on the previous coords of the tensor
+        """
+        dims = set()
+        if 'read_from_formula' in data_methods:
+            formula = self.get_formula(tensor_definition['read_from_formula']['formula'])
+            if not formula.is_elementwise:
+                dims.update(formula.sequential_dims)
+        for method in ['ffill', 'last_valid_dim']:
+            if method in data_methods and 'dim' in tensor_definition.get(method, {}):
+                dims.add(tensor_definition[method]['dim'])
+        if 'reindex' in data_methods:
+            dims.update(tensor_definition.get('reindex', {}).get('coords_to_reindex', []))
+        return dims
+
+    @staticmethod
+    def _merge_modified_coords(paths: List[str],
+                               modified_coords: Dict[str, Dict[str, Any]]) -> Union[Dict[str, Any], None]:
+        coords = {}
+        for path in paths:
+            if path not in modified_coords:
+                continue
+            if modified_coords[path] is None:
+                return None
+            for dim, labels in modified_coords[path].items():
+                coords[dim] = np.union1d(coords[dim], labels) if dim in coords else np.asarray(labels)
+        return coords
+
     def _complete_path(self,
                        tensor_definition: Dict,
                        path: Union[List[str], str],
@@ -161,7 +812,21 @@ class TensorDB:
         return os.path.join(tensor_definition.get('extra_path', ''), *path)
 
     def _apply_data_methods(self, data_methods: List[str], tensor_definition: Dict, **kwargs):
+        """
+        The methods are applied over a dask-backed new_data, so they only build the graph of the pipeline,
+        which is computed at the end (in parallel by chunks) if new_data was chunked by the pipeline,
+        the data that was already lazy (like the formulas) is returned lazy, so the handler can write it by chunks
+        """
         results = {**{'new_data': None}, **kwargs}
+        chunked = False
+        new_data = results['new_data']
+        if self.data_methods_chunks is not None and isinstance(new_data, (xarray.DataArray, xarray.Dataset)):
+            variables = new_data.data_vars.values() if isinstance(new_data, xarray.Dataset) else [new_data]
+            # the methods are applied eagerly over the object dtype, dask can not chunk it automatically
+            chunked = not new_data.chunks and all(variable.dtype != object for variable in variables)
+            if chunked:
+                results['new_data'] = new_data.chunk(self.data_methods_chunks)
+
         for method in data_methods:
             result = getattr(self, method)(
                 **{**tensor_definition.get(method, {}), **results},
@@ -169,18 +834,34 @@ class TensorDB:
             )
             result = result if isinstance(result, dict) else {'new_data': result}
             results.update(result)
-        return results['new_data']
-
-    def read_from_formula(self, tensor_definition, new_data: xarray.DataArray = None, **kwargs):
-        formula = tensor_definition['read_from_formula']['formula']
-        data_fields = {}
-        data_fields_intervals = [i for i, c in enumerate(formula) if c == '`']
-        for i in range(0, len(data_fields_intervals), 2):
-            name_data_field = formula[data_fields_intervals[i] + 1: data_fields_intervals[i + 1]]
-            data_fields[name_data_field] = self.read(name_data_field)
-        for name, dataset in data_fields.items():
-            formula = formula.replace(f"`{name}`", f"data_fields['{name}']")
-        return eval(formula)
+
+        new_data = results['new_data']
+        if chunked and isinstance(new_data, (xarray.DataArray, xarray.Dataset)):
+            # the blockwise steps are fused by the optimization of the graph, so every chunk is calculated
+            # in a single pass over its memory
+            new_data = new_data.compute()
+        return new_data
+
+    def read_from_formula(self,
+                          tensor_definition: Dict,
+                          new_data: xarray.DataArray = None,
+                          sel: Dict[str, Any] = None,
+                          **kwargs) -> xarray.DataArray:
+        """
+        Evaluate the formula of the tensor definition, the formula is compiled only once and the result is lazy
+        if the data fields are dask-backed, the sel parameter allow to evaluate only a subset of the coords
+        """
+        formula = self.get_formula(tensor_definition['read_from_formula']['formula'])
+        # the data fields are read using dask, so the formula is evaluated chunk by chunk, and the selection
+        # of an elementwise formula is pushed down to the reads, so only the selected chunks are read
+        read_kwargs = {'sel': sel} if sel is not None and formula.is_elementwise else {}
+        data_fields = {path: self.read(path, chunks='auto', **read_kwargs) for path in formula.data_fields}
+        return formula.evaluate(data_fields, sel=sel)
+
+    def get_formula(self, formula: str) -> Formula:
+        if formula not in self.formulas_cache:
+            self.formulas_cache[formula] = Formula(formula)
+        return self.formulas_cache[formula]
 
     def reindex(self,
                 new_data: xarray.DataArray,
@@ -191,12 +872,12 @@ class TensorDB:
                 **kwargs) -> Union[xarray.DataArray, None]:
         if new_data is None:
             return None
-        data_reindex = self.read(path=reindex_path, **kwargs)
+        reindex_coords = self.read_coords(path=reindex_path)
         if action_type == 'store' or any(size == 0 for size in new_data.sizes.values()):
-            coords_to_reindex = {coord: data_reindex.coords[coord] for coord in coords_to_reindex}
+            coords_to_reindex = {coord: reindex_coords[coord] for coord in coords_to_reindex}
         else:
             coords_to_reindex = {
-                coord: data_reindex.coords[coord][data_reindex.coords[coord] >= new_data.coords[coord]]
+                coord: reindex_coords[coord][reindex_coords[coord] >= new_data.coords[coord].values.min()]
                 for coord in coords_to_reindex
             }
         return new_data.reindex(coords_to_reindex, method=method_fill_value)
@@ -204,12 +885,68 @@ class TensorDB:
     def last_valid_dim(self,
                        new_data: xarray.DataArray,
                        dim: str,
+                       action_type: str = 'store',
+                       handler: BaseStorage = None,
                        **kwargs) -> Union[xarray.DataArray, None]:
+        """
+        Label of the last valid value of every series along dim, on the modifications new_data only contains
+        the modified labels, so the series are combined with their stored labels keeping the last one.
+        If the stored label is one of the labels of new_data and it is not valid anymore, the series is
+        calculated again with all its labels (see _recalculate_last_valid_dim)
+        """
         if new_data is None:
             return None
-        if new_data.dtype == 'bool':
-            return new_data.cumsum(dim=dim).idxmax(dim=dim)
-        return new_data.notnull().cumsum(dim=dim).idxmax(dim=dim)
+        valid = new_data if new_data.dtype == 'bool' else new_data.notnull()
+        last_valid = valid.cumsum(dim=dim).idxmax(dim=dim)
+        if action_type == 'store' or handler is None or not handler.exist():
+            return last_valid
+
+        series = {d: last_valid.coords[d].values for d in last_valid.dims}
+        stored = handler.read(sel=series).reindex(series)
+        has_valid = valid.any(dim=dim)
+        # the value of the stored label is only known if the label is part of new_data
+        modified = stored.notnull() & stored.isin(new_data.coords[dim].values)
+        removed = modified & ~has_valid
+        recalculated = None
+        if bool(removed.any()):
+            recalculated = self._recalculate_last_valid_dim(
+                removed=removed, dim=dim, handler=handler, **kwargs
+            )
+        keep_stored = stored.notnull() & ~modified & (~has_valid | (stored > last_valid))
+        if recalculated is None:
+            keep_stored = keep_stored | removed
+        else:
+            last_valid = last_valid.where(~removed, recalculated.reindex(series))
+        return last_valid.where(~keep_stored, stored).astype(last_valid.dtype)
+
+    def _recalculate_last_valid_dim(self,
+                                    removed: xarray.DataArray,
+                                    dim: str,
+                                    tensor_definition: Dict = None,
+                                    **kwargs) -> Union[xarray.DataArray, None]:
+        """
+        Calculate the last valid label of the removed series using all their labels, the data is calculated
+        again using the data methods of the store definition that are before last_valid_dim, so this is only
+        possible if they read the data from a formula (None is returned in other case)
+        """
+        data_methods = (tensor_definition or {}).get('store', {}).get('data_methods', [])
+        if 'last_valid_dim' not in data_methods:
+            return None
+        data_methods = data_methods[:data_methods.index('last_valid_dim')]
+        if 'read_from_formula' not in data_methods:
+            return None
+        sel = {
+            d: removed.coords[d].values[removed.any(dim=[o for o in removed.dims if o != d]).values]
+            for d in removed.dims
+        }
+        new_data = self._apply_data_methods(
+            data_methods=data_methods,
+            tensor_definition=tensor_definition,
+            handler=kwargs.get('handler'),
+            action_type='store',
+            sel=sel
+        )
+        return self.last_valid_dim(new_data=new_data, dim=dim)
 
     def replace_values(self,
                        new_data: xarray.DataArray,
@@ -218,7 +955,8 @@ class TensorDB:
                        **kwargs) -> Union[xarray.DataArray, None]:
         if new_data is None:
             return new_data
-        replace_data_array = self.read(path=replace_path, **kwargs)
+        sel = {dim: new_data.coords[dim].values for dim in new_data.dims}
+        replace_data_array = self.read(path=replace_path, **{**kwargs, 'sel': sel})
         return new_data.where(replace_data_array.sel(new_data.coords), value)
 
     def fillna(self,
@@ -240,14 +978,72 @@ class TensorDB:
 
         if new_data is None:
             return new_data
-        data_concat = new_data
-        if action_type != 'store':
-            data = handler.read()
-            data = data.sel({dim: data.coords[dim] < new_data.coords[dim][0]})
-            if data.sizes[dim] > 0:
-                data_concat = xarray.concat([data.isel({dim: [-1]}), new_data], dim=dim)
+        data = new_data.ffill(dim=dim, limit=limit)
+        if action_type == 'store':
+            return data
+        previous = self._read_last_valid_before(handler, new_data, dim, limit)
+        if previous is None:
+            return data
+
+        # the missing values before the first valid value of every series are filled with the previous value,
+        # the limit is counted from the position of the previous value, not from the first label of new_data
+        series = {d: new_data.coords[d].values for d in previous.dims}
+        previous = previous.reindex(series)
+        fill = new_data.notnull().cumsum(dim=dim) == 0
+        if limit is not None:
+            steps = xarray.DataArray(
+                np.arange(1, new_data.sizes[dim] + 1), dims=[dim], coords={dim: new_data.coords[dim]}
+            )
+            fill = fill & (previous['gap'] + steps <= limit)
+        return data.where(~fill, previous['value'])
+
+    @staticmethod
+    def _read_last_valid_before(handler: BaseStorage,
+                                new_data: xarray.DataArray,
+                                dim: str,
+                                limit: int = None) -> Union[xarray.Dataset, None]:
+        """
+        Last valid value of every series of new_data before its first label of dim (value) and the number of
+        stored labels between it and the first label (gap), the gap is only calculated if there is a limit.
+        Without limit the state of the last valid values of the handler is used if all its labels are before
+        new_data (appends), in other case the stored data is read.
+
+        With limit the stored data is expected to be filled with the same limit, so the stored value can be
+        a filled one, the valid value is taken as the first one of the run of equal values at the end of the
+        stored data and it is only searched on the last limit + 1 stored labels (a valid value before them
+        could not fill the last stored label). If the last stored value is missing nothing is filled.
+        """
+        first_label = new_data.coords[dim].values[0]
+        if limit is None and getattr(handler, 'last_valid_dim', None) == dim:
+            state = handler.read_last_valid()
+            series = {d: new_data.coords[d].values for d in new_data.dims if d != dim and d in state.dims}
+            state = state.reindex(series)
+            if not bool((state['label'] >= first_label).any()):
+                if bool(state['label'].isnull().all()):
+                    return None
+                return xarray.Dataset({'value': state['value'], 'gap': xarray.zeros_like(state['value'], dtype=int)})
+
+        sel = {d: new_data.coords[d].values for d in new_data.dims if d != dim}
+        if limit is None:
+            data = handler.read(sel={**sel, dim: lambda labels: labels < first_label})
+        else:
+            labels = handler.read_coords()[dim]
+            labels = labels[labels < first_label][-(limit + 1):]
+            if len(labels) == 0:
+                return None
+            data = handler.read(sel={**sel, dim: labels})
+        if data.sizes[dim] == 0:
+            return None
+
+        positions = xarray.DataArray(np.arange(data.sizes[dim]), dims=[dim])
+        if limit is None:
+            # the last label could have missing values, so the last valid value of every series is used
+            value = data.ffill(dim=dim).isel({dim: -1}, drop=True)
+            return xarray.Dataset({'value': value, 'gap': xarray.zeros_like(value, dtype=int)})
 
-        return data_concat.ffill(dim=dim, limit=limit).sel(new_data.coords)
+        value = data.isel({dim: -1}, drop=True)
+        start = positions.where(data != value).max(dim=dim).fillna(-1) + 1
+        return xarray.Dataset({'value': value, 'gap': (data.sizes[dim] - 1 - start).astype(int)})
 
     def replace_last_valid_dim(self,
                                new_data: xarray.DataArray,
@@ -258,6 +1054,9 @@ class TensorDB:
         if new_data is None:
             return new_data
 
-        last_valid = self.read(path=replace_path, **kwargs)
+        # only the series of new_data are read and compared, so the cost is proportional to new_data
+        sel = {d: new_data.coords[d].values for d in new_data.dims if d != dim}
+        last_valid = self.read(path=replace_path, **{**kwargs, 'sel': sel})
+        last_valid = last_valid.sel({d: new_data.coords[d] for d in last_valid.dims})
         last_valid = new_data.coords[dim] <= last_valid.fillna(new_data.coords[dim][-1])
         return new_data.where(last_valid.sel(new_data.coords), value)
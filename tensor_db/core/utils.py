@@ -1,6 +1,7 @@
 import xarray
 import numpy as np
 import pandas as pd
+import os
 
 from loguru import logger
 
@@ -76,4 +77,8 @@ def compare_dataset(a, b):
     return equals
 
 
-
+def get_dir_size(path: str) -> int:
+    total_size = 0
+    for root, _, files in os.walk(path):
+        total_size += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return total_size
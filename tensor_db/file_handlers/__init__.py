@@ -1,2 +1,2 @@
 from tensor_db.file_handlers.base_handler import BaseStorage
-from tensor_db.file_handlers.zarr_handler import ZarrStorage
+from tensor_db.file_handlers.zarr_handler import ZarrStorage, S3ZarrStorage, ChunkPlanner
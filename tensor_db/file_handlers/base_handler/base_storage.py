@@ -1,17 +1,25 @@
 import xarray
 import os
+import asyncio
+import functools
 
 from abc import abstractmethod
+from concurrent.futures import Executor
 from typing import Dict, List, Any, Union, Callable, Generic
 
+from tensor_db import metrics
+
 
 class BaseStorage:
     def __init__(self,
                  path: str,
                  base_path: str = None,
+                 executor: Executor = None,
                  **kwargs):
         self.path = path
         self.base_path = base_path
+        # executor of the async methods, by default the default executor of the event loop is used
+        self.executor = executor
         self.__dict__.update(kwargs)
 
     @abstractmethod
@@ -34,6 +42,9 @@ class BaseStorage:
     def read(self, **kwargs) -> xarray.DataArray:
         pass
 
+    def read_coords(self, **kwargs) -> Dict[str, Any]:
+        return {dim: coord.values for dim, coord in self.read(**kwargs).coords.items()}
+
     @abstractmethod
     def update_from_backup(self, **kwargs):
         pass
@@ -42,6 +53,17 @@ class BaseStorage:
     def backup(self, **kwargs):
         pass
 
+    def get_backup_files(self, **kwargs) -> List[Dict]:
+        """
+        Files that must be uploaded to complete the backup, the handlers that can not split the backup in
+        multiple steps make the backup directly and return an empty list
+        """
+        self.backup(**kwargs)
+        return []
+
+    def complete_backup(self, **kwargs):
+        pass
+
     @abstractmethod
     def close(self, **kwargs):
         pass
@@ -50,6 +72,41 @@ class BaseStorage:
     def exist(self, **kwargs):
         pass
 
+    async def _run_async(self, func: Callable, **kwargs) -> Any:
+        """
+        Run a blocking method in the executor of the handler, the method is executed using the current action
+        of the metrics (see tensor_db.metrics)
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(metrics.copy_context_run(func), **kwargs))
+
+    async def append_async(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        return await self._run_async(self.append, new_data=new_data, **kwargs)
+
+    async def update_async(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        return await self._run_async(self.update, new_data=new_data, **kwargs)
+
+    async def store_async(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        return await self._run_async(self.store, new_data=new_data, **kwargs)
+
+    async def upsert_async(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        return await self._run_async(self.upsert, new_data=new_data, **kwargs)
+
+    async def read_async(self, **kwargs) -> xarray.DataArray:
+        return await self._run_async(self.read, **kwargs)
+
+    async def update_from_backup_async(self, **kwargs):
+        return await self._run_async(self.update_from_backup, **kwargs)
+
+    async def backup_async(self, **kwargs):
+        return await self._run_async(self.backup, **kwargs)
+
+    async def close_async(self, **kwargs):
+        return await self._run_async(self.close, **kwargs)
+
+    async def exist_async(self, **kwargs):
+        return await self._run_async(self.exist, **kwargs)
+
     @property
     def local_path(self):
         return os.path.join("" if self.base_path is None else self.base_path, self.path)
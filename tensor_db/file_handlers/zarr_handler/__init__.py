@@ -1 +1,11 @@
+from tensor_db.file_handlers.zarr_handler.coords_index import CoordsIndex
+from tensor_db.file_handlers.zarr_handler.journal_store import JournalStore
+from tensor_db.file_handlers.zarr_handler.tensor_locks import TensorLocks
+from tensor_db.file_handlers.zarr_handler.last_valid_state import LastValidState
+from tensor_db.file_handlers.zarr_handler.hot_mirror import HotMirror
+from tensor_db.file_handlers.zarr_handler.lazy_store import LazyRestoreStore
+from tensor_db.file_handlers.zarr_handler.chunk_bundles import ChunkBundles
+from tensor_db.file_handlers.zarr_handler.chunk_planner import ChunkPlanner
 from tensor_db.file_handlers.zarr_handler.zarr_storage import ZarrStorage
+from tensor_db.file_handlers.zarr_handler.s3_chunk_store import S3ChunkStore
+from tensor_db.file_handlers.zarr_handler.s3_zarr_storage import S3ZarrStorage
@@ -0,0 +1,248 @@
+import os
+import json
+import uuid
+import shutil
+import tempfile
+import pandas as pd
+
+from typing import Dict, List, Tuple, Any, Iterable, Callable
+
+
+class ChunkBundles:
+    """
+        ChunkBundles
+        ----------
+        Backup format that pack the chunks of a store in a few big objects (bundles) instead of uploading every
+        chunk as an independent object, this reduce a lot the number of requests when the chunks are small.
+
+        Every backup write the modified chunks in new bundles and an index with the position of every chunk,
+        {'keys': {key: [bundle, offset, size]}, 'bundles': {bundle: size}}, is uploaded after them
+        (so the readers never see an index pointing to a bundle that does not exist), the bundles that are
+        not referenced anymore by the index are deleted.
+
+        A store rewrite all the keys of the tensor, so reset mark their prefix on the local index and the next
+        pack remove from the backup all the keys of the prefix that were not written again.
+
+        The restore only download the chunks whose position changed compared with the local copy of the index,
+        the chunks of every bundle are downloaded using range requests merging the chunks that are close,
+        or downloading the whole bundle if most of it is needed.
+    """
+
+    index_name = 'zbundles_index.json'
+
+    def __init__(self,
+                 local_path: str,
+                 s3_path: str,
+                 bundle_size: int = 64 * 2 ** 20,
+                 max_range_gap: int = 2 ** 18,
+                 full_bundle_ratio: float = 0.5):
+        self.local_path = local_path
+        self.s3_path = s3_path.replace('\\', '/')
+        self.bundle_size = bundle_size
+        self.max_range_gap = max_range_gap
+        self.full_bundle_ratio = full_bundle_ratio
+        self._pending: Dict[str, Any] = None
+
+    @property
+    def local_index_path(self) -> str:
+        return os.path.join(self.local_path, self.index_name)
+
+    @property
+    def s3_index_path(self) -> str:
+        return f"{self.s3_path}/{self.index_name}"
+
+    def get_bundle_s3_path(self, bundle: str) -> str:
+        return f"{self.s3_path}/zbundles/{bundle}"
+
+    def read_local_index(self) -> Dict:
+        if not os.path.exists(self.local_index_path):
+            return {'keys': {}, 'bundles': {}}
+        with open(self.local_index_path, mode='r') as json_file:
+            return json.load(json_file)
+
+    def write_local_index(self, index: Dict):
+        os.makedirs(self.local_path, exist_ok=True)
+        tmp_path = self.local_index_path + '.tmp'
+        with open(tmp_path, mode='w') as json_file:
+            json.dump(index, json_file)
+        os.replace(tmp_path, self.local_index_path)
+
+    def read_s3_index(self, s3_handler, bucket_name: str) -> Dict:
+        try:
+            return json.loads(s3_handler.get_object(bucket_name=bucket_name, s3_path=self.s3_index_path))
+        except s3_handler.botoclient_error:
+            return None
+
+    def reset(self, prefix: str = None):
+        """
+        Remove the keys of prefix (all the keys if it is None) from the local index and mark the prefix,
+        so the next pack also remove them from the backup index, the mark is cleared by commit
+        """
+        prefix = '' if not prefix else prefix.strip('/') + '/'
+        index = self.read_local_index()
+        index['keys'] = {key: entry for key, entry in index['keys'].items() if not key.startswith(prefix)}
+        index['reset_prefixes'] = sorted(set(index.get('reset_prefixes', [])) | {prefix})
+        self.write_local_index(index)
+
+    def pack(self, s3_handler, bucket_name: str, keys: Iterable[str], **kwargs) -> List[Dict]:
+        """
+        Write the keys in bundles inside a temporal directory and return the settings of the files that must be
+        uploaded, after uploading them commit must be called to publish the new index.
+        The keys that does not exist anymore on the local store and the keys of the prefixes marked by reset
+        that were not written again are removed from the index
+        """
+        self.discard()
+        index = self.read_s3_index(s3_handler, bucket_name) or {'keys': {}, 'bundles': {}}
+        reset_prefixes = tuple(self.read_local_index().get('reset_prefixes', []))
+        index['keys'] = {key: entry for key, entry in index['keys'].items() if not key.startswith(reset_prefixes)}
+        staging_path = tempfile.mkdtemp(prefix='zbundles_')
+        bundle_prefix = f"{pd.Timestamp.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        bundles = {}
+        bundle_file, bundle, offset = None, None, 0
+
+        for key in sorted(keys):
+            total_path = os.path.join(self.local_path, key)
+            if not os.path.exists(total_path):
+                index['keys'].pop(key, None)
+                continue
+            with open(total_path, mode='rb') as chunk_file:
+                value = chunk_file.read()
+
+            if bundle_file is None or offset >= self.bundle_size:
+                if bundle_file is not None:
+                    bundle_file.close()
+                bundle = f"{bundle_prefix}-{len(bundles)}.bin"
+                bundle_file = open(os.path.join(staging_path, bundle), mode='wb')
+                offset = 0
+
+            bundle_file.write(value)
+            index['keys'][key] = [bundle, offset, len(value)]
+            offset += len(value)
+            bundles[bundle] = offset
+
+        if bundle_file is not None:
+            bundle_file.close()
+
+        index['bundles'].update(bundles)
+        used_bundles = {entry[0] for entry in index['keys'].values()}
+        obsolete_bundles = [bundle for bundle in index['bundles'] if bundle not in used_bundles]
+        index['bundles'] = {bundle: size for bundle, size in index['bundles'].items() if bundle in used_bundles}
+
+        self._pending = {'index': index, 'staging_path': staging_path, 'obsolete_bundles': obsolete_bundles}
+        return [
+            dict(
+                local_path=os.path.join(staging_path, bundle),
+                s3_path=self.get_bundle_s3_path(bundle),
+                bucket_name=bucket_name,
+                **kwargs
+            )
+            for bundle in bundles
+        ]
+
+    def commit(self, s3_handler, bucket_name: str):
+        """
+        Publish the index of the last pack and delete the bundles that are not used anymore
+        """
+        if self._pending is None:
+            return
+        index = self._pending['index']
+        s3_handler.put_object(bucket_name=bucket_name, s3_path=self.s3_index_path, body=json.dumps(index).encode())
+        if self._pending['obsolete_bundles']:
+            s3_handler.delete_objects(
+                bucket_name=bucket_name,
+                s3_paths=[self.get_bundle_s3_path(bundle) for bundle in self._pending['obsolete_bundles']]
+            )
+        # the local data is equal to the backup, so the index is also the local index
+        self.write_local_index(index)
+        self.discard()
+
+    def discard(self):
+        if self._pending is not None:
+            shutil.rmtree(self._pending['staging_path'], ignore_errors=True)
+        self._pending = None
+
+    def restore(self,
+                s3_handler,
+                bucket_name: str,
+                force: bool = False,
+                on_lazy_key: Callable[[str, List], bool] = None) -> bool:
+        """
+        Download the chunks that are different from the local copy, return False if there is not backup or
+        nothing was modified.
+
+        on_lazy_key is called with every modified key and its entry, if it returns True the key is not
+        downloaded, this allow to download it later using fetch_entry
+        """
+        s3_index = self.read_s3_index(s3_handler, bucket_name)
+        if s3_index is None:
+            return False
+        modified = False
+        local_index = {'keys': {}, 'bundles': {}} if force else self.read_local_index()
+
+        entries_by_bundle = {}
+        for key, entry in s3_index['keys'].items():
+            if not force and local_index['keys'].get(key) == entry:
+                continue
+            if on_lazy_key is not None and on_lazy_key(key, entry):
+                modified = True
+            else:
+                entries_by_bundle.setdefault(entry[0], []).append((key, entry[1], entry[2]))
+
+        removed_keys = [key for key in local_index['keys'] if key not in s3_index['keys']]
+        for key in removed_keys:
+            if os.path.exists(os.path.join(self.local_path, key)):
+                os.remove(os.path.join(self.local_path, key))
+
+        requests = []
+        for bundle, entries in entries_by_bundle.items():
+            for byte_range, range_entries in self.plan_ranges(entries, s3_index['bundles'][bundle]):
+                requests.append((byte_range, range_entries, dict(
+                    bucket_name=bucket_name,
+                    s3_path=self.get_bundle_s3_path(bundle),
+                    byte_range=byte_range
+                )))
+
+        contents, _ = s3_handler.get_objects([settings for _, _, settings in requests])
+        for (byte_range, range_entries, _), content in zip(requests, contents):
+            start = 0 if byte_range is None else byte_range[0]
+            for key, offset, size in range_entries:
+                self._write_key(key, content[offset - start: offset - start + size])
+
+        self.write_local_index(s3_index)
+        return modified or len(requests) > 0 or len(removed_keys) > 0
+
+    def fetch_entry(self, s3_handler, bucket_name: str, entry: List) -> bytes:
+        bundle, offset, size = entry
+        return s3_handler.get_object(
+            bucket_name=bucket_name,
+            s3_path=self.get_bundle_s3_path(bundle),
+            byte_range=(offset, offset + size)
+        )
+
+    def plan_ranges(self,
+                    entries: List[Tuple[str, int, int]],
+                    bundle_size: int) -> List[Tuple[Tuple[int, int], List[Tuple[str, int, int]]]]:
+        """
+        Group the entries (key, offset, size) of a bundle in the byte ranges that must be downloaded,
+        the entries separated by less than max_range_gap bytes are downloaded in the same range,
+        a range of None means that the whole bundle is downloaded
+        """
+        entries = sorted(entries, key=lambda entry: entry[1])
+        if sum(entry[2] for entry in entries) >= self.full_bundle_ratio * bundle_size:
+            return [(None, entries)]
+
+        ranges = []
+        for key, offset, size in entries:
+            if ranges and offset - ranges[-1][0][1] <= self.max_range_gap:
+                ranges[-1][0][1] = max(ranges[-1][0][1], offset + size)
+                ranges[-1][1].append((key, offset, size))
+            else:
+                ranges.append(([offset, offset + size], [(key, offset, size)]))
+        return [(tuple(byte_range), range_entries) for byte_range, range_entries in ranges]
+
+    def _write_key(self, key: str, value: bytes):
+        total_path = os.path.join(self.local_path, key)
+        os.makedirs(os.path.dirname(total_path), exist_ok=True)
+        with open(total_path + '.tmp', mode='wb') as chunk_file:
+            chunk_file.write(value)
+        os.replace(total_path + '.tmp', total_path)
@@ -0,0 +1,77 @@
+import numpy as np
+
+from typing import Dict, List, Union
+
+
+class ChunkPlanner:
+    """
+        ChunkPlanner
+        ----------
+        Choose the shape of the chunks of a tensor using the size of its dtype, the target size of every
+        chunk (target_chunk_bytes) and the expected access pattern:
+
+        - 'append': the data grows along append_dim (by default the first dim, usually the time), the chunks
+          span as much as possible of the other dims, so every append only touches the last chunks of append_dim.
+        - 'read_by_column': every read takes the complete series of a few columns, the chunks span
+          as much as possible of append_dim and contain few labels of the other dims.
+        - 'read_by_date': every read takes all the columns of a few dates, this is the same layout of 'append'.
+        - 'balanced': the chunks have a similar number of labels on every dim.
+
+        The dims that grow (append_dim) use expected_sizes if they are provided, so the chunks are not limited
+        by the size of the first write.
+    """
+
+    access_patterns = ['append', 'read_by_column', 'read_by_date', 'balanced']
+
+    def __init__(self,
+                 target_chunk_bytes: int = 2 ** 22,
+                 access_pattern: str = 'append',
+                 append_dim: str = None,
+                 expected_sizes: Dict[str, int] = None):
+        if access_pattern not in self.access_patterns:
+            raise ValueError(f"{access_pattern} is not a valid option for the access_pattern")
+        self.target_chunk_bytes = target_chunk_bytes
+        self.access_pattern = access_pattern
+        self.append_dim = append_dim
+        self.expected_sizes = expected_sizes or {}
+
+    def plan(self, sizes: Dict[str, int], dtype: Union[np.dtype, str]) -> Dict[str, int]:
+        """
+        Chunks of every dim of sizes (ordered like the dims of the tensor)
+        """
+        dims = list(sizes)
+        if len(dims) == 0:
+            return {}
+        sizes = {dim: max(int(max(sizes[dim], self.expected_sizes.get(dim, 0))), 1) for dim in dims}
+        target_elements = max(self.target_chunk_bytes // np.dtype(dtype).itemsize, 1)
+        append_dim = dims[0] if self.append_dim is None else self.append_dim
+        other_dims = [dim for dim in dims if dim != append_dim]
+
+        if self.access_pattern == 'balanced':
+            return self._plan_balanced(sizes, target_elements)
+        if self.access_pattern == 'read_by_column':
+            return self._plan_by_priority(sizes, [append_dim] + other_dims, target_elements)
+        return self._plan_by_priority(sizes, other_dims + [append_dim], target_elements)
+
+    @staticmethod
+    def _plan_by_priority(sizes: Dict[str, int], priority: List[str], target_elements: int) -> Dict[str, int]:
+        # every dim takes as many labels as possible of the elements that were not used by the previous dims
+        chunks = {}
+        for dim in priority:
+            if dim not in sizes:
+                continue
+            chunks[dim] = int(max(min(sizes[dim], target_elements), 1))
+            target_elements = max(target_elements // chunks[dim], 1)
+        return {dim: chunks[dim] for dim in sizes}
+
+    @staticmethod
+    def _plan_balanced(sizes: Dict[str, int], target_elements: int) -> Dict[str, int]:
+        # the small dims are completely used and the rest of the elements are shared by the big dims
+        chunks = {}
+        remaining = sorted(sizes, key=lambda dim: sizes[dim])
+        while remaining:
+            side = max(int(target_elements ** (1 / len(remaining))), 1)
+            dim = remaining.pop(0)
+            chunks[dim] = min(sizes[dim], side)
+            target_elements = max(target_elements // chunks[dim], 1)
+        return {dim: chunks[dim] for dim in sizes}
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import os
+import threading
+
+from typing import Dict, Callable, Any, Union
+
+
+class CoordsIndex:
+    """
+        CoordsIndex
+        ----------
+        Map every label of the coords of a tensor to its integer position on the stored data, the lookups are
+        done using the hash tables of pandas so they are O(1) and never touch the chunks of the data.
+
+        The labels are persisted in a npz file next to the store and loaded lazily the first time that
+        they are used, if the file does not exist or its sizes are different from the stored coords the
+        index is rebuilt reading only the coords of the store.
+
+        The selections of labels of the reads are resolved to integer positions using the index
+        (see resolve_selection), so the data is never opened to find them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._indexes: Dict[str, pd.Index] = None
+        self._modified_date = None
+
+    def load(self,
+             read_coords: Callable[[], Dict[str, np.ndarray]],
+             read_sizes: Callable[[], Dict[str, int]] = None):
+        """
+        If read_sizes is not sent the persisted index is always used
+        """
+        if self._indexes is not None and self._modified_date == self._get_modified_date():
+            return
+
+        if os.path.exists(self.path):
+            with np.load(self.path) as coords:
+                indexes = {dim: pd.Index(coords[dim]) for dim in coords.files}
+            if read_sizes is None or {dim: len(index) for dim, index in indexes.items()} == read_sizes():
+                self._indexes = indexes
+                self._modified_date = self._get_modified_date()
+                return
+
+        self.reset(read_coords())
+
+    def reset(self, coords: Dict[str, np.ndarray]):
+        self._indexes = {dim: pd.Index(np.asarray(coord)) for dim, coord in coords.items()}
+        self.save()
+
+    def drop(self):
+        self._indexes = None
+        self._modified_date = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # the file is written first in a temporal file to avoid leaving a corrupted index if the process fail,
+        # the name is unique because multiple writers can rebuild the index at the same time
+        tmp_path = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, **{
+            dim: index.values.astype(str) if index.dtype == object else index.values
+            for dim, index in self._indexes.items()
+        })
+        os.replace(tmp_path, self.path)
+        self._modified_date = self._get_modified_date()
+
+    def append(self, dim: str, labels: np.ndarray):
+        self._indexes[dim] = self._indexes[dim].append(pd.Index(np.asarray(labels)))
+
+    def get_positions(self, dim: str, labels: np.ndarray) -> np.ndarray:
+        """
+        Integer position of every label on the stored coord, -1 if the label does not exist
+        """
+        return self._indexes[dim].get_indexer(labels)
+
+    def isin(self, dim: str, labels: np.ndarray) -> np.ndarray:
+        return self.get_positions(dim, labels) != -1
+
+    def get_selection(self, dim: str, selection: Any) -> Union[int, slice, np.ndarray]:
+        return self.resolve_selection(self._indexes[dim], selection)
+
+    @staticmethod
+    def resolve_selection(index: pd.Index, selection: Any) -> Union[int, slice, np.ndarray]:
+        """
+        Integer positions on index of a selection of labels, the selection can be a slice of labels (both ends
+        included like xarray), a single label, a list of labels (the missing ones are ignored) or a predicate
+        that receive the labels and return a boolean mask.
+        The contiguous positions are returned as a slice, so the store read them as a single block
+        """
+        if isinstance(selection, slice):
+            return index.slice_indexer(selection.start, selection.stop, selection.step)
+        if callable(selection):
+            positions = np.flatnonzero(np.asarray(selection(index.values), dtype=bool))
+        elif np.ndim(selection) == 0:
+            return index.get_loc(selection)
+        else:
+            positions = index.get_indexer(np.asarray(selection))
+            positions = positions[positions != -1]
+
+        if len(positions) > 0 and positions[-1] - positions[0] + 1 == len(positions) and \
+                np.all(np.diff(positions) == 1):
+            return slice(int(positions[0]), int(positions[-1]) + 1)
+        return positions
+
+    @property
+    def indexes(self) -> Dict[str, pd.Index]:
+        return self._indexes
+
+    @property
+    def coords(self) -> Dict[str, np.ndarray]:
+        return {dim: index.values for dim, index in self._indexes.items()}
+
+    @property
+    def sizes(self) -> Dict[str, int]:
+        return {dim: len(index) for dim, index in self._indexes.items()}
+
+    def _get_modified_date(self):
+        return os.path.getmtime(self.path) if os.path.exists(self.path) else None
@@ -0,0 +1,191 @@
+import xarray
+import numpy as np
+import os
+import json
+import threading
+import pandas as pd
+
+from typing import Dict, List, Any
+
+from tensor_db.file_handlers.zarr_handler.coords_index import CoordsIndex
+
+
+class HotMirror:
+    """
+        HotMirror
+        ----------
+        Uncompressed copy of a data variable of a tensor saved as a single npy file that is read using a memory map,
+        so the reads of rows and columns are views over the page cache of the OS without decoding any chunk
+        and without using dask.
+
+        The mirror has its own coords index (the labels of the written data), the file can have more space than
+        the labels (capacity) so the appends only write the new data, when the capacity is exceeded the file is
+        copied to a new one with twice the capacity on the grown dims.
+        The labels are saved after writing the data, so a reader never see labels without their data.
+    """
+
+    data_file = 'zhot_data.npy'
+    dims_file = 'zhot_dims.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.coords_index = CoordsIndex(os.path.join(path, 'zcoords_index.npz'))
+        self._dims: List[str] = None
+        # the maps are cached by the inode of the file, a new file is created every time that the capacity grows
+        self._maps: Dict[str, Any] = {}
+        self._maps_lock = threading.Lock()
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.path, self.data_file)
+
+    @property
+    def dims_path(self) -> str:
+        return os.path.join(self.path, self.dims_file)
+
+    def exist(self) -> bool:
+        return os.path.exists(self.dims_path) and os.path.exists(self.coords_index.path)
+
+    def drop(self):
+        for path in [self.dims_path, self.coords_index.path, self.data_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.coords_index.drop()
+        self._dims = None
+        with self._maps_lock:
+            self._maps = {}
+
+    @property
+    def dims(self) -> List[str]:
+        if self._dims is None:
+            with open(self.dims_path, mode='r') as json_file:
+                self._dims = json.load(json_file)
+        return self._dims
+
+    def _load_coords_index(self) -> CoordsIndex:
+        self.coords_index.load(read_coords=self._missing_coords_index)
+        return self.coords_index
+
+    def _missing_coords_index(self):
+        raise FileNotFoundError(f"The hot mirror {self.path} does not have a coords index")
+
+    def _get_map(self, mode: str) -> np.memmap:
+        inode = os.stat(self.data_path).st_ino
+        with self._maps_lock:
+            if mode not in self._maps or self._maps[mode][0] != inode:
+                self._maps[mode] = (inode, np.load(self.data_path, mmap_mode=mode))
+            return self._maps[mode][1]
+
+    @staticmethod
+    def _get_fill_value(dtype: np.dtype):
+        if dtype.kind in 'fc':
+            return np.nan
+        if dtype.kind in 'mM':
+            return np.array('NaT', dtype=dtype)
+        return np.zeros((), dtype=dtype)
+
+    def rebuild(self, data: xarray.DataArray, block_size: int = None):
+        """
+        Copy all the data, it is read by blocks of the first dim (block_size labels), so the memory used is
+        proportional to the size of a block
+        """
+        self.drop()
+        os.makedirs(self.path, exist_ok=True)
+        dims = list(data.dims)
+        tmp_path = f"{self.data_path}.{os.getpid()}-{threading.get_ident()}.tmp.npy"
+        mirror = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=data.dtype, shape=data.shape)
+        block_size = block_size or max(data.shape[0], 1)
+        for start in range(0, data.shape[0], block_size):
+            mirror[start: start + block_size] = data.isel({dims[0]: slice(start, start + block_size)}).values
+        mirror.flush()
+        del mirror
+        os.replace(tmp_path, self.data_path)
+
+        with open(self.dims_path, mode='w') as json_file:
+            json.dump(dims, json_file)
+        self._dims = dims
+        self.coords_index.reset({dim: data.indexes[dim].values for dim in dims})
+
+    def write(self, new_data: xarray.DataArray, coords: Dict[str, np.ndarray], block_size: int = None):
+        """
+        Write the values of new_data, coords are all the labels of the tensor after the write,
+        the labels that are not on the mirror are appended at the end of every dim (like the appends of zarr)
+        and the labels of new_data that are not on coords are ignored.
+
+        new_data is read by blocks of the first dim (block_size labels, by default its dask chunks),
+        so a lazy new_data is never loaded completely in memory
+        """
+        coords_index = self._load_coords_index()
+        sizes = coords_index.sizes
+        coords_to_append = {
+            dim: np.asarray(coords[dim])[sizes[dim]:] for dim in self.dims if len(coords[dim]) > sizes[dim]
+        }
+        if coords_to_append:
+            self._require_capacity({dim: len(coords[dim]) for dim in self.dims})
+
+        # the positions of the new labels are calculated without modifying the index used by the readers
+        indexes = {dim: coords_index.indexes[dim] for dim in self.dims}
+        for dim, labels in coords_to_append.items():
+            indexes[dim] = indexes[dim].append(pd.Index(labels))
+
+        new_data = new_data.transpose(*self.dims)
+        selection, new_data_selection = [], []
+        for dim in self.dims:
+            positions = indexes[dim].get_indexer(new_data.coords[dim].values)
+            valid = np.flatnonzero(positions != -1)
+            selection.append(positions[valid])
+            new_data_selection.append(valid)
+
+        mirror = self._get_map('r+')
+        if all(len(positions) > 0 for positions in selection):
+            if block_size is None:
+                block_size = new_data.chunks[0][0] if new_data.chunks else len(selection[0])
+            block_size = max(block_size, 1)
+            other_selection = dict(zip(self.dims[1:], new_data_selection[1:]))
+            for start in range(0, len(selection[0]), block_size):
+                block = slice(start, start + block_size)
+                values = new_data.isel({self.dims[0]: new_data_selection[0][block], **other_selection}).values
+                mirror[np.ix_(selection[0][block], *selection[1:])] = values.astype(mirror.dtype, copy=False)
+            mirror.flush()
+
+        if coords_to_append:
+            for dim, labels in coords_to_append.items():
+                coords_index.append(dim, labels)
+            coords_index.save()
+
+    def _require_capacity(self, sizes: Dict[str, int]):
+        mirror = self._get_map('r+')
+        capacity = dict(zip(self.dims, mirror.shape))
+        if all(sizes[dim] <= capacity[dim] for dim in self.dims):
+            return
+        new_capacity = tuple(
+            max(sizes[dim], 2 * capacity[dim]) if sizes[dim] > capacity[dim] else capacity[dim]
+            for dim in self.dims
+        )
+        tmp_path = f"{self.data_path}.{os.getpid()}-{threading.get_ident()}.tmp.npy"
+        new_mirror = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=mirror.dtype, shape=new_capacity)
+        new_mirror[...] = self._get_fill_value(mirror.dtype)
+        region = tuple(slice(0, size) for size in mirror.shape)
+        new_mirror[region] = mirror
+        new_mirror.flush()
+        del new_mirror
+        os.replace(tmp_path, self.data_path)
+
+    def read(self, name: str = None, sel: Dict[str, Any] = None) -> xarray.DataArray:
+        """
+        The data is a read only view of the memory map, only the selections of lists of labels or predicates
+        that are not contiguous copy the data
+        """
+        coords_index = self._load_coords_index()
+        sizes = coords_index.sizes
+        mirror = self._get_map('r')
+        values = mirror[tuple(slice(0, sizes[dim]) for dim in self.dims)]
+        data = xarray.DataArray(
+            values,
+            dims=self.dims,
+            coords={dim: coords_index.indexes[dim] for dim in self.dims},
+            name=name
+        )
+        if sel:
+            data = data.isel({dim: coords_index.get_selection(dim, selection) for dim, selection in sel.items()})
+        return data
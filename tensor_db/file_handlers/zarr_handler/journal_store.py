@@ -0,0 +1,176 @@
+import zarr
+import os
+import json
+import threading
+
+from contextlib import nullcontext
+from typing import Set, Iterable, Dict, Tuple
+
+from tensor_db import metrics
+
+
+class JournalStore(zarr.storage.DirectoryStore):
+    """
+        JournalStore
+        ----------
+        DirectoryStore that records the keys that are written or deleted, the keys are persisted in a journal
+        file inside the store, so the backup can upload exactly the modified chunks without walking
+        all the files of the store (even if the modifications were done by a previous process).
+
+        The journal is written every time that flush is called, the handlers call it after every write action.
+        If the locks of the tensor are sent (see TensorLocks), the journal is merged and written holding the lock
+        of its key, so the keys of multiple writer processes are never lost.
+        Every flush of new keys increases the generation of the journal and the keys store the generation in
+        which they were recorded, so a backup can clear only the keys that were not modified again during the upload.
+
+        The keys and the bytes read and written are recorded on the metrics of the current action
+        (see tensor_db.metrics), the metadata keys (.zarray, .zattrs, etc) are not counted as chunks.
+    """
+
+    def __init__(self, path: str, journal_name: str = 'zdirty_keys.json', locks=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.locks = locks
+        self.journal_name = journal_name
+        self.journal_path = os.path.join(self.path, journal_name)
+        self._dirty_keys: Dict[str, int] = None
+        self._pending_keys: Set[str] = set()
+        self._generation: int = 0
+        self._journal_lock = threading.Lock()
+
+    @property
+    def dirty_keys(self) -> Set[str]:
+        with self._journal_lock:
+            if self._dirty_keys is None:
+                self._dirty_keys, self._generation = self._read_journal()
+            return set(self._dirty_keys) | self._pending_keys
+
+    def _read_journal(self) -> Tuple[Dict[str, int], int]:
+        if not os.path.exists(self.journal_path):
+            return {}, 0
+        with open(self.journal_path, mode='r') as json_file:
+            journal = json.load(json_file)
+        dirty_keys = journal['dirty_keys']
+        # the old journals only have a list of keys, they are considered part of the first generation
+        if isinstance(dirty_keys, list):
+            dirty_keys = dict.fromkeys(dirty_keys, 0)
+        return dirty_keys, journal.get('generation', 0)
+
+    def _journal_file_lock(self):
+        return nullcontext() if self.locks is None else self.locks.chunk_lock(self.journal_name)
+
+    def _write_journal(self):
+        if not os.path.exists(self.path):
+            return
+        tmp_path = f"{self.journal_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, mode='w') as json_file:
+            json.dump({'dirty_keys': dict(sorted(self._dirty_keys.items())), 'generation': self._generation}, json_file)
+        os.replace(tmp_path, self.journal_path)
+
+    def _merge_journal(self):
+        # must be called holding both locks, the keys of the file and the memory are merged keeping the
+        # greatest generation, and the pending keys receive a new generation
+        dirty_keys, generation = self._read_journal()
+        if self._dirty_keys is not None:
+            for key, key_generation in self._dirty_keys.items():
+                dirty_keys[key] = max(key_generation, dirty_keys.get(key, key_generation))
+            generation = max(generation, self._generation)
+        if self._pending_keys:
+            generation += 1
+            dirty_keys.update(dict.fromkeys(self._pending_keys, generation))
+            self._pending_keys = set()
+        self._dirty_keys, self._generation = dirty_keys, generation
+
+    def _add_dirty_key(self, key: str):
+        with self._journal_lock:
+            self._pending_keys.add(key)
+
+    @staticmethod
+    def _record_io(direction: str, key: str, value):
+        # zarr can send arrays or memoryviews, so their size in bytes is used instead of their length
+        metrics.increment(f'bytes_{direction}', value.nbytes if hasattr(value, 'nbytes') else len(value))
+        if not key.rsplit('/', 1)[-1].startswith('.z'):
+            metrics.increment(f'chunks_{direction}')
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._record_io('read', key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._add_dirty_key(key)
+        self._record_io('written', key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._add_dirty_key(key)
+
+    def replace_dir(self, path: str, new_dir: str, old_dir: str):
+        """
+        Replace the directory of path by new_dir (a directory out of the store) using renames, so the keys
+        of path are never partially written, the old directory is moved to old_dir and it is restored if
+        new_dir can not be moved. The keys of both directories are recorded on the journal
+        """
+        path = zarr.storage.normalize_storage_path(path)
+        dir_path = os.path.join(self.path, path)
+        keys = {
+            f'{path}/{key}'
+            for directory in [dir_path, new_dir]
+            for key in zarr.storage.DirectoryStore(directory).keys()
+        }
+        os.rename(dir_path, old_dir)
+        try:
+            os.rename(new_dir, dir_path)
+        except Exception:
+            os.rename(old_dir, dir_path)
+            raise
+        for key in keys:
+            self._add_dirty_key(key)
+
+    def rmdir(self, path: str = None):
+        """
+        Remove the directory of path (the whole store if it is empty) recording all its keys on the journal,
+        the journal is loaded before removing the directory because the journal file could be inside of it
+        """
+        path = zarr.storage.normalize_storage_path(path)
+        prefix = f'{path}/' if path else ''
+        keys = {
+            f'{prefix}{key}'
+            for key in zarr.storage.DirectoryStore(os.path.join(self.path, path)).keys()
+        }
+        keys.discard(self.journal_name)
+        with self._journal_lock, self._journal_file_lock():
+            self._merge_journal()
+        super().rmdir(path)
+        for key in keys:
+            self._add_dirty_key(key)
+
+    def flush(self):
+        """
+        Persist the dirty keys, the keys of the journal file are merged because other process could add keys
+        """
+        with self._journal_lock, self._journal_file_lock():
+            self._merge_journal()
+            self._write_journal()
+
+    def checkpoint(self) -> Tuple[Set[str], int]:
+        """
+        Flush the journal and return its dirty keys and its generation, the keys recorded after the checkpoint
+        receive a greater generation, so they are kept by clear_journal
+        """
+        with self._journal_lock, self._journal_file_lock():
+            self._merge_journal()
+            self._write_journal()
+            return set(self._dirty_keys), self._generation
+
+    def clear_journal(self, keys: Iterable[str], generation: int = None):
+        """
+        Remove the keys from the journal, this must be called after uploading them.
+        If the generation of a checkpoint is sent, the keys recorded again after it are not removed
+        """
+        with self._journal_lock, self._journal_file_lock():
+            self._merge_journal()
+            for key in keys:
+                if generation is None or self._dirty_keys.get(key, generation) <= generation:
+                    self._dirty_keys.pop(key, None)
+            self._write_journal()
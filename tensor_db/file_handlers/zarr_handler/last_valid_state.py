@@ -0,0 +1,176 @@
+import numpy as np
+import zarr
+
+from typing import List, Tuple
+
+
+class LastValidState:
+    """
+        LastValidState
+        ----------
+        Companion state of an array with the last valid (not missing) value of every series along a dim,
+        a series is every combination of labels of the other dims.
+
+        The state is a small zarr group next to the array (group_name) with two arrays of the shape of the series:
+        position, the position on dim of the last valid value (-1 if the series does not have any) and value,
+        its raw value (with the same encoding of the array).
+        After every write only the region that was written is read to update the state, if the value of the
+        state was overwritten with a missing value the series is scanned backwards from that position
+        chunk by chunk until a valid value is found, so the complete array is read only when the state is built.
+    """
+
+    group_name = 'zlast_valid'
+    # name of the dim of the state of an array that only has the dim of the series
+    single_series_dim = 'zseries'
+
+    def __init__(self, dim: str):
+        self.dim = dim
+
+    def exist(self, group: zarr.Group) -> bool:
+        return self.group_name in group
+
+    def _get_series_dims(self, arr: zarr.Array) -> List[str]:
+        return [dim for dim in arr.attrs['_ARRAY_DIMENSIONS'] if dim != self.dim]
+
+    def _get_series_shape(self, arr: zarr.Array) -> Tuple[int, ...]:
+        dims = arr.attrs['_ARRAY_DIMENSIONS']
+        shape = tuple(size for dim, size in zip(dims, arr.shape) if dim != self.dim)
+        return shape or (1,)
+
+    def require(self, group: zarr.Group, name: str) -> bool:
+        """
+        Create or resize the arrays of the state to the shape of the series, return True if the metadata
+        of the state was modified
+        """
+        arr = group[name]
+        shape = self._get_series_shape(arr)
+        if self.exist(group):
+            state = group[self.group_name]
+            if state['position'].shape == shape:
+                return False
+            state['position'].resize(*shape)
+            state['value'].resize(*shape)
+            return True
+
+        state = group.create_group(self.group_name)
+        dims = self._get_series_dims(arr) or [self.single_series_dim]
+        position = state.create_dataset('position', shape=shape, dtype='int64', fill_value=-1)
+        position.attrs['_ARRAY_DIMENSIONS'] = dims
+        value = state.create_dataset(
+            'value', shape=shape, dtype=arr.dtype, fill_value=arr.fill_value, compressor=arr.compressor
+        )
+        value.attrs.update({**arr.attrs, '_ARRAY_DIMENSIONS': dims})
+        return True
+
+    def rebuild(self, group: zarr.Group, name: str):
+        arr = group[name]
+        shape = self._get_series_shape(arr)
+        series = tuple(np.indices(shape).reshape(len(shape), -1))
+        size = arr.shape[arr.attrs['_ARRAY_DIMENSIONS'].index(self.dim)]
+        positions, values = self._scan(arr, series, np.full(len(series[0]), size - 1))
+        self._write(group, series, positions, values)
+
+    def update(self, group: zarr.Group, name: str, dim_positions: np.ndarray, series_positions: List[np.ndarray]):
+        """
+        Update the state after writing the region formed by the positions of dim and the positions of
+        every dim of the series (in the order of the array)
+        """
+        arr = group[name]
+        dim_positions = np.unique(dim_positions)
+        series_positions = [np.unique(positions) for positions in series_positions] or [np.zeros(1, dtype=int)]
+        if len(dim_positions) == 0 or any(len(positions) == 0 for positions in series_positions):
+            return
+
+        region = self._read_region(arr, dim_positions, series_positions).reshape(len(dim_positions), -1)
+        region_positions, region_values = self._last_valid(arr, region, dim_positions)
+
+        series = tuple(p.ravel() for p in np.meshgrid(*series_positions, indexing='ij'))
+        state = group[self.group_name]
+        state_positions = state['position'].get_coordinate_selection(series)
+        modified = (region_positions >= 0) & (region_positions >= state_positions)
+        # the last valid value was overwritten with a missing value, so the previous one must be found
+        overwritten = ~modified & (state_positions >= 0) & np.isin(state_positions, dim_positions)
+
+        positions = np.where(modified, region_positions, state_positions)
+        values = np.where(modified, region_values, state['value'].get_coordinate_selection(series))
+        if overwritten.any():
+            overwritten_series = tuple(p[overwritten] for p in series)
+            positions[overwritten], values[overwritten] = self._scan(
+                arr, overwritten_series, state_positions[overwritten]
+            )
+        changed = modified | overwritten
+        if changed.any():
+            self._write(group, tuple(p[changed] for p in series), positions[changed], values[changed])
+
+    def read(self, group: zarr.Group) -> Tuple[np.ndarray, np.ndarray]:
+        state = group[self.group_name]
+        return state['position'][...], state['value'][...]
+
+    def _write(self, group: zarr.Group, series: Tuple[np.ndarray, ...], positions: np.ndarray, values: np.ndarray):
+        state = group[self.group_name]
+        state['position'].set_coordinate_selection(series, positions)
+        state['value'].set_coordinate_selection(series, values)
+
+    def _read_region(self, arr: zarr.Array, dim_positions: np.ndarray, series_positions: List[np.ndarray]):
+        # the values are returned with the dim first and the dims of the series in the order of the array
+        axis = arr.attrs['_ARRAY_DIMENSIONS'].index(self.dim)
+        selection = list(series_positions) if arr.ndim > 1 else []
+        selection.insert(axis, dim_positions)
+        if all(len(p) > 0 and p[-1] - p[0] + 1 == len(p) for p in selection):
+            values = arr[tuple(slice(int(p[0]), int(p[-1]) + 1) for p in selection)]
+        else:
+            values = arr.get_orthogonal_selection(tuple(selection))
+        return np.moveaxis(values, axis, 0)
+
+    @staticmethod
+    def _is_valid(arr: zarr.Array, values: np.ndarray) -> np.ndarray:
+        valid = np.ones(values.shape, dtype=bool)
+        if values.dtype.kind in 'fc':
+            valid &= ~np.isnan(values)
+        if arr.fill_value is not None and not (isinstance(arr.fill_value, float) and np.isnan(arr.fill_value)):
+            valid &= values != arr.fill_value
+        return valid
+
+    def _last_valid(self,
+                    arr: zarr.Array,
+                    region: np.ndarray,
+                    dim_positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        valid = self._is_valid(arr, region)
+        last = len(dim_positions) - 1 - np.argmax(valid[::-1], axis=0)
+        has_valid = valid.any(axis=0)
+        positions = np.where(has_valid, dim_positions[last], -1)
+        values = region[last, np.arange(region.shape[1])]
+        return positions, values
+
+    def _scan(self,
+              arr: zarr.Array,
+              series: Tuple[np.ndarray, ...],
+              starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Last valid value of every series on the positions lower or equal than its start,
+        the array is read backwards by chunks of dim
+        """
+        axis = arr.attrs['_ARRAY_DIMENSIONS'].index(self.dim)
+        step = arr.chunks[axis]
+        positions = np.full(len(starts), -1, dtype='int64')
+        values = np.full(len(starts), arr.fill_value if arr.fill_value is not None else 0, dtype=arr.dtype)
+        pending = np.flatnonzero(starts >= 0)
+        end = int(starts.max()) + 1 if len(starts) else 0
+        while len(pending) > 0 and end > 0:
+            start = ((end - 1) // step) * step
+            series_positions = [np.unique(p[pending]) for p in series]
+            region = self._read_region(arr, np.arange(start, end), series_positions)
+            # select the pending series of the orthogonal region
+            region = region[(slice(None),) + tuple(
+                np.searchsorted(unique, p[pending]) for unique, p in zip(series_positions, series)
+            )] if arr.ndim > 1 else region.reshape(end - start, -1)
+            region_positions = np.arange(start, end)
+            in_range = region_positions[:, None] <= starts[pending][None, :]
+            valid = self._is_valid(arr, region) & in_range
+            last = end - start - 1 - np.argmax(valid[::-1], axis=0)
+            found = valid.any(axis=0)
+            positions[pending[found]] = region_positions[last[found]]
+            values[pending[found]] = region[last[found], np.flatnonzero(found)]
+            pending = pending[~found]
+            end = start
+        return positions, values
@@ -0,0 +1,191 @@
+import os
+import json
+import threading
+import zarr
+
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Tuple
+
+from tensor_db.file_handlers.zarr_handler.journal_store import JournalStore
+
+
+class LazyRestoreStore(JournalStore):
+    """
+        LazyRestoreStore
+        ----------
+        JournalStore that download the chunks of the backup the first time that they are used, the pending keys
+        (keys that exist on the backup but not on the local store) are downloaded calling fetch_key,
+        so reading a subset of the data only download the chunks that contain the subset.
+
+        The downloaded chunks are cached on the local store, if cache_bytes is bigger than 0 the least
+        recently used chunks are deleted (and marked as pending again) when the size of the cache exceed it,
+        the modified chunks are never deleted because they are not on the backup.
+    """
+
+    def __init__(self,
+                 path: str,
+                 fetch_key: Callable[[str, Any], bytes],
+                 cache_bytes: int = 0,
+                 state_name: str = 'zlazy_keys.json',
+                 **kwargs):
+        super().__init__(path, **kwargs)
+        self.fetch_key = fetch_key
+        self.cache_bytes = cache_bytes
+        self.state_path = os.path.join(self.path, state_name)
+        self._pending: Dict[str, Any] = None
+        # size and entry of every downloaded key, the entry is needed to download it again after evicting it
+        self._cached: Dict[str, Tuple[int, Any]] = None
+        self._cached_total = 0
+
+    def _load_state(self):
+        if self._pending is not None:
+            return
+        state = {'pending': {}, 'cached': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, mode='r') as json_file:
+                state = json.load(json_file)
+        self._pending = state['pending']
+        self._cached = OrderedDict(state['cached'])
+        self._cached_total = sum(size for size, _ in self._cached.values())
+
+    def save_state(self):
+        with self._journal_lock:
+            self._load_state()
+            if not os.path.exists(self.path):
+                return
+            tmp_path = f"{self.state_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, mode='w') as json_file:
+                json.dump({'pending': self._pending, 'cached': self._cached}, json_file)
+            os.replace(tmp_path, self.state_path)
+
+    @property
+    def pending_keys(self) -> Dict[str, Any]:
+        with self._journal_lock:
+            self._load_state()
+            return dict(self._pending)
+
+    @property
+    def cached_bytes(self) -> int:
+        with self._journal_lock:
+            self._load_state()
+            return self._cached_total
+
+    def add_pending_keys(self, keys: Dict[str, Any]):
+        """
+        Mark the keys as pending, the local copies of the keys are deleted because they are outdated,
+        keys must be a dict with the information needed by fetch_key to download every key
+        """
+        with self._journal_lock:
+            self._load_state()
+            for key, entry in keys.items():
+                self._pending[key] = entry
+                self._pop_cached(key)
+                if zarr.storage.DirectoryStore.__contains__(self, key):
+                    zarr.storage.DirectoryStore.__delitem__(self, key)
+        self.save_state()
+
+    def clear_pending_keys(self):
+        with self._journal_lock:
+            self._pending, self._cached, self._cached_total = {}, OrderedDict(), 0
+        self.save_state()
+
+    def __getitem__(self, key):
+        try:
+            value = super().__getitem__(key)
+        except KeyError:
+            with self._journal_lock:
+                self._load_state()
+                if key not in self._pending:
+                    raise
+                entry = self._pending[key]
+            value = self.fetch_key(key, entry)
+            self._record_io('read', key, value)
+            self._add_cached_key(key, value)
+            return value
+
+        with self._journal_lock:
+            if self._cached is not None and key in self._cached:
+                self._cached.move_to_end(key)
+        return value
+
+    def __contains__(self, key):
+        if super().__contains__(key):
+            return True
+        with self._journal_lock:
+            self._load_state()
+            return key in self._pending
+
+    def _pop_cached(self, key: str) -> Any:
+        size, entry = self._cached.pop(key, (0, None))
+        self._cached_total -= size
+        return entry
+
+    def _add_cached_key(self, key: str, value: bytes):
+        with self._journal_lock:
+            if key not in self._pending:
+                # the key was written while it was being downloaded
+                return
+            zarr.storage.DirectoryStore.__setitem__(self, key, value)
+            self._cached[key] = (len(value), self._pending.pop(key))
+            self._cached_total += len(value)
+            evicted = self._evict(exclude=key)
+        # the state must be saved before anyone try to read an evicted key
+        if evicted:
+            self.save_state()
+
+    def _evict(self, exclude: str) -> bool:
+        evicted = False
+        while 0 < self.cache_bytes < self._cached_total and len(self._cached) > 1:
+            key = next(k for k in self._cached if k != exclude)
+            self._pending[key] = self._pop_cached(key)
+            if zarr.storage.DirectoryStore.__contains__(self, key):
+                zarr.storage.DirectoryStore.__delitem__(self, key)
+            evicted = True
+        return evicted
+
+    def _forget_key(self, key: str):
+        with self._journal_lock:
+            self._load_state()
+            self._pending.pop(key, None)
+            self._pop_cached(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._forget_key(key)
+
+    def __delitem__(self, key):
+        try:
+            super().__delitem__(key)
+        except KeyError:
+            if key not in self:
+                raise
+            self._add_dirty_key(key)
+        self._forget_key(key)
+
+    def rmdir(self, path: str = None):
+        super().rmdir(path)
+        # the pending keys of the deleted directory does not exist anymore
+        prefix = '' if not path else zarr.storage.normalize_storage_path(path) + '/'
+        with self._journal_lock:
+            self._load_state()
+            for key in [key for key in list(self._pending) + list(self._cached) if key.startswith(prefix)]:
+                self._pending.pop(key, None)
+                self._pop_cached(key)
+
+    def replace_dir(self, path: str, new_dir: str, old_dir: str):
+        super().replace_dir(path, new_dir, old_dir)
+        # the keys that were not downloaded does not exist anymore, so they are also deleted from the backup
+        prefix = zarr.storage.normalize_storage_path(path) + '/'
+        with self._journal_lock:
+            self._load_state()
+            old_keys = [key for key in list(self._pending) + list(self._cached) if key.startswith(prefix)]
+            for key in old_keys:
+                self._pending.pop(key, None)
+                self._pop_cached(key)
+        for key in old_keys:
+            self._add_dirty_key(key)
+        self.save_state()
+
+    def flush(self):
+        super().flush()
+        self.save_state()
@@ -0,0 +1,261 @@
+import os
+import re
+import zarr
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, Any, Sequence, Mapping, Tuple
+
+from tensor_db.file_handlers.zarr_handler.chunk_bundles import ChunkBundles
+from tensor_db.backup_handlers import S3TransferError
+
+
+class S3ChunkStore(zarr.storage.Store):
+    """
+        S3ChunkStore
+        ----------
+        Read only zarr store over the backup of a ZarrStorage (any of its formats), the keys are read directly
+        from S3 without restoring the tensor, all the keys requested by zarr at the same time are downloaded
+        in parallel (bundles are read using range requests).
+
+        The downloaded keys are saved in a LRU cache in memory (cache_bytes) and optionally in a LRU cache
+        on disk (disk_cache_bytes), the files of the disk cache contain the version of the key
+        (ETag or position in the bundle), so an outdated key is never read from the cache.
+
+        Every time that a chunk is read, the next prefetch chunks of the first dim are downloaded
+        in the same batch, so reading the data sequentially does not wait for every chunk.
+    """
+
+    _writeable = False
+    _erasable = False
+
+    def __init__(self,
+                 s3_handler,
+                 bucket_name: str,
+                 s3_path: str,
+                 backup_format: str = 'files',
+                 cache_bytes: int = 2 ** 28,
+                 disk_cache_path: str = None,
+                 disk_cache_bytes: int = 0,
+                 prefetch: int = 1,
+                 ignore_keys: List[str] = None):
+        self.s3_handler = s3_handler
+        self.bucket_name = bucket_name
+        self.s3_path = s3_path.replace('\\', '/')
+        self.backup_format = backup_format
+        self.cache_bytes = cache_bytes
+        self.disk_cache_path = disk_cache_path
+        self.disk_cache_bytes = disk_cache_bytes
+        self.prefetch = prefetch
+        self.ignore_keys = set(ignore_keys or [])
+        self.chunk_bundles = ChunkBundles(disk_cache_path or '', s3_path=s3_path)
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'prefetched': 0, 'evictions': 0}
+        self._catalog: Dict[str, Any] = None
+        self._cache: Dict[Tuple[str, str], bytes] = OrderedDict()
+        self._cache_total = 0
+        self._disk_cache: Dict[str, int] = OrderedDict()
+        self._disk_cache_total = 0
+        self._lock = threading.RLock()
+        if self.disk_cache_path is not None and self.disk_cache_bytes > 0:
+            self._load_disk_cache()
+
+    @property
+    def catalog(self) -> Dict[str, Any]:
+        """
+        Version and location of every key of the backup, {key: (version, entry)}
+        """
+        with self._lock:
+            if self._catalog is None:
+                self._catalog = self._read_catalog()
+            return self._catalog
+
+    def _read_catalog(self) -> Dict[str, Any]:
+        if self.backup_format == 'bundles':
+            index = self.chunk_bundles.read_s3_index(self.s3_handler, self.bucket_name) or {'keys': {}}
+            return {
+                key: (f"{entry[0]}-{entry[1]}", entry)
+                for key, entry in index['keys'].items()
+                if key not in self.ignore_keys
+            }
+
+        catalog = {}
+        for obj in self.s3_handler.list_objects(self.bucket_name, prefix=self.s3_path + '/'):
+            key = obj['Key'][len(self.s3_path) + 1:]
+            if key in self.ignore_keys or key.startswith('zbundles'):
+                continue
+            catalog[key] = (obj['ETag'].strip('"'), None)
+        return catalog
+
+    def refresh(self) -> bool:
+        """
+        Read again the catalog of the backup, return True if any key was modified
+        """
+        with self._lock:
+            old_catalog, self._catalog = self._catalog, None
+        return old_catalog != self.catalog
+
+    def __getitem__(self, key: str) -> bytes:
+        values = self.getitems([key], contexts={})
+        if key not in values:
+            raise KeyError(key)
+        return values[key]
+
+    def getitems(self, keys: Sequence[str], *, contexts: Mapping[str, Any] = None) -> Mapping[str, Any]:
+        catalog = self.catalog
+        values, missing = {}, []
+        for key in keys:
+            if key not in catalog:
+                continue
+            value = self._get_cached(key, catalog[key][0])
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+
+        if len(missing) == 0:
+            return values
+
+        with self._lock:
+            prefetch_keys = [
+                key for key in self._get_prefetch_keys(missing) if (key, catalog[key][0]) not in self._cache
+            ]
+        fetch_keys = missing + prefetch_keys
+        contents, errors = self.s3_handler.get_objects(
+            [self._get_object_settings(key) for key in fetch_keys],
+            raise_errors=False
+        )
+        # the errors of the prefetched keys are ignored, they are downloaded again when they are requested
+        if any(content is None for content in contents[:len(missing)]):
+            raise S3TransferError(errors)
+        with self._lock:
+            self.stats['misses'] += len(missing)
+            self.stats['prefetched'] += len(prefetch_keys)
+            for key, content in zip(fetch_keys, contents):
+                self._add_cached(key, catalog[key][0], content)
+        values.update({key: content for key, content in zip(missing, contents)})
+        return values
+
+    def _get_object_settings(self, key: str) -> Dict[str, Any]:
+        version, entry = self.catalog[key]
+        if entry is not None:
+            bundle, offset, size = entry
+            return dict(
+                bucket_name=self.bucket_name,
+                s3_path=self.chunk_bundles.get_bundle_s3_path(bundle),
+                byte_range=(offset, offset + size)
+            )
+        return dict(bucket_name=self.bucket_name, s3_path=f"{self.s3_path}/{key}")
+
+    def _get_prefetch_keys(self, keys: List[str]) -> List[str]:
+        """
+        The next chunks of the first dim of every key, only the keys with the default format of zarr
+        (array/i.j.k) are prefetched
+        """
+        if self.prefetch <= 0:
+            return []
+        catalog = self.catalog
+        prefetch_keys = []
+        requested = set(keys)
+        for key in keys:
+            match = re.fullmatch(r'(.*/)?(\d+)((?:\.\d+)*)', key)
+            if match is None:
+                continue
+            prefix, first, rest = match.group(1) or '', int(match.group(2)), match.group(3)
+            for i in range(1, self.prefetch + 1):
+                next_key = f"{prefix}{first + i}{rest}"
+                if next_key in catalog and next_key not in requested:
+                    requested.add(next_key)
+                    prefetch_keys.append(next_key)
+        return prefetch_keys
+
+    def _get_cached(self, key: str, version: str) -> bytes:
+        with self._lock:
+            value = self._cache.get((key, version))
+            if value is not None:
+                self._cache.move_to_end((key, version))
+                self.stats['hits'] += 1
+                return value
+
+            disk_path = self._get_disk_path(key, version)
+            if disk_path is None or disk_path not in self._disk_cache:
+                return None
+            with open(disk_path, mode='rb') as chunk_file:
+                value = chunk_file.read()
+            self._disk_cache.move_to_end(disk_path)
+            self.stats['disk_hits'] += 1
+            self._add_memory_cached(key, version, value)
+            return value
+
+    def _add_cached(self, key: str, version: str, value: bytes):
+        if value is None:
+            return
+        self._add_memory_cached(key, version, value)
+        disk_path = self._get_disk_path(key, version)
+        if disk_path is None or disk_path in self._disk_cache:
+            return
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        with open(disk_path + '.tmp', mode='wb') as chunk_file:
+            chunk_file.write(value)
+        os.replace(disk_path + '.tmp', disk_path)
+        self._disk_cache[disk_path] = len(value)
+        self._disk_cache_total += len(value)
+        while self._disk_cache_total > self.disk_cache_bytes and len(self._disk_cache) > 1:
+            evicted_path, size = self._disk_cache.popitem(last=False)
+            self._disk_cache_total -= size
+            if os.path.exists(evicted_path):
+                os.remove(evicted_path)
+
+    def _add_memory_cached(self, key: str, version: str, value: bytes):
+        if self.cache_bytes <= 0:
+            return
+        if (key, version) not in self._cache:
+            self._cache_total += len(value)
+        self._cache[(key, version)] = value
+        self._cache.move_to_end((key, version))
+        while self._cache_total > self.cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_total -= len(evicted)
+            self.stats['evictions'] += 1
+
+    def _get_disk_path(self, key: str, version: str) -> str:
+        if self.disk_cache_path is None or self.disk_cache_bytes <= 0:
+            return None
+        return os.path.join(self.disk_cache_path, f"{key}.{re.sub(r'[^a-zA-Z0-9_-]', '_', version)}")
+
+    def _load_disk_cache(self):
+        # the files of previous executions are reused, they are ordered by their modification date
+        if not os.path.exists(self.disk_cache_path):
+            return
+        files = []
+        for root, _, names in os.walk(self.disk_cache_path):
+            files.extend(os.path.join(root, name) for name in names if not name.endswith('.tmp'))
+        for disk_path in sorted(files, key=os.path.getmtime):
+            self._disk_cache[disk_path] = os.path.getsize(disk_path)
+            self._disk_cache_total += self._disk_cache[disk_path]
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_total = 0
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._cache_total
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.catalog
+
+    def __iter__(self):
+        return iter(list(self.catalog))
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def keys(self):
+        return list(self.catalog)
+
+    def __setitem__(self, key, value):
+        raise zarr.errors.ReadOnlyError()
+
+    def __delitem__(self, key):
+        raise zarr.errors.ReadOnlyError()
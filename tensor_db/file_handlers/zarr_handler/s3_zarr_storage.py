@@ -0,0 +1,132 @@
+import xarray
+import numpy as np
+import os
+import pandas as pd
+
+from typing import Dict, List, Union, Any
+
+from tensor_db.file_handlers import BaseStorage
+from tensor_db.file_handlers.zarr_handler.s3_chunk_store import S3ChunkStore
+from tensor_db.file_handlers.zarr_handler.coords_index import CoordsIndex
+from tensor_db.file_handlers.zarr_handler.zarr_storage import ZarrStorage
+from tensor_db.backup_handlers import S3Handler
+
+
+class S3ZarrStorage(BaseStorage):
+    """
+        S3ZarrStorage
+        ----------
+        Read only storage that read the tensors directly from the backups of ZarrStorage, so the workers that only
+        need to read the data do not need to restore the complete tensors on their disks (see S3ChunkStore).
+
+        The local_path is only used for the disk cache of the chunks (when disk_cache_bytes is bigger than 0).
+    """
+
+    def __init__(self,
+                 name: str = "data",
+                 group: str = None,
+                 s3_handler: Union[S3Handler, Dict] = None,
+                 bucket_name: str = None,
+                 backup_format: str = 'files',
+                 cache_bytes: int = 2 ** 28,
+                 disk_cache_bytes: int = 0,
+                 prefetch: int = 1,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.group = group
+        self.bucket_name = bucket_name
+        self.s3_handler = s3_handler
+        if backup_format not in ['files', 'bundles']:
+            raise ValueError(f"{backup_format} is not a valid option for the backup_format")
+        self.backup_format = backup_format
+
+        self._own_s3_handler = isinstance(s3_handler, Dict)
+        if isinstance(s3_handler, Dict):
+            self.s3_handler = S3Handler(**s3_handler)
+
+        self.chunk_store = S3ChunkStore(
+            s3_handler=self.s3_handler,
+            bucket_name=bucket_name,
+            s3_path=self.path,
+            backup_format=backup_format,
+            cache_bytes=cache_bytes,
+            disk_cache_path=self.local_path,
+            disk_cache_bytes=disk_cache_bytes,
+            prefetch=prefetch,
+            ignore_keys=ZarrStorage.local_only_files + ['zbackup_date.json']
+        )
+
+    def _raise_read_only(self, **kwargs):
+        raise PermissionError(f"{type(self).__name__} is read only, the data must be written using ZarrStorage")
+
+    def store(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        self._raise_read_only()
+
+    def append(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        self._raise_read_only()
+
+    def update(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        self._raise_read_only()
+
+    def upsert(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
+        self._raise_read_only()
+
+    def read_as_dataset(self,
+                        consolidated: bool = None,
+                        chunks: Dict = None,
+                        sel: Dict[str, Any] = None,
+                        **kwargs) -> xarray.Dataset:
+        self.exist(raise_error_missing_backup=True, **kwargs)
+        isel = None
+        if sel:
+            # only the coords are downloaded to resolve the selection, the chunks out of it are never requested
+            coords = self.read_coords()
+            isel = {
+                dim: CoordsIndex.resolve_selection(pd.Index(coords[dim]), selection)
+                for dim, selection in sel.items()
+            }
+        if consolidated is None:
+            # the consolidated metadata avoid one request for the .zarray and .zattrs of every variable
+            consolidated = os.path.join(self.group or '', '.zmetadata').lstrip('/') in self.chunk_store
+        dataset = xarray.open_zarr(
+            self.chunk_store,
+            group=self.group,
+            consolidated=consolidated,
+            chunks=chunks,
+        )
+        return dataset if isel is None else dataset.isel(isel)
+
+    def read(self, **kwargs) -> xarray.DataArray:
+        dataset = self.read_as_dataset(**kwargs)
+        return dataset[self.name]
+
+    def read_coords(self, **kwargs) -> Dict[str, np.ndarray]:
+        # the coords are decoded by xarray (dates, units, etc) and the data is lazy, so only the coords are downloaded
+        return {dim: index.values for dim, index in self.read_as_dataset(**kwargs).indexes.items()}
+
+    def update_from_backup(self, **kwargs) -> bool:
+        """
+        Read again the keys of the backup, the cached chunks that were modified are not used anymore
+        """
+        return self.chunk_store.refresh()
+
+    def backup(self, **kwargs) -> bool:
+        # the data is never modified, so there is nothing to backup
+        return False
+
+    def get_backup_files(self, **kwargs) -> List[Dict]:
+        return []
+
+    def exist(self, raise_error_missing_backup: bool = False, **kwargs) -> bool:
+        exist = os.path.join(self.group or '', '.zgroup').lstrip('/') in self.chunk_store
+        if raise_error_missing_backup and not exist:
+            raise FileNotFoundError(
+                f"There is not backup of the tensor {self.path} in the bucket {self.bucket_name}"
+            )
+        return exist
+
+    def close(self, **kwargs):
+        self.chunk_store.clear_cache()
+        if self._own_s3_handler:
+            self.s3_handler.close()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import time
+import threading
+import zlib
+import fasteners
+
+from contextlib import contextmanager
+from typing import Dict
+
+
+class TensorLocks:
+    """
+        TensorLocks
+        ----------
+        Locks of a tensor that can be shared by the threads and the processes that write on it:
+
+        - A tensor lock (reader-writer), the actions that modify the metadata (store, resizes, rechunk, backups
+          and restores) use it in exclusive mode and the writes of chunks (update) use it in shared mode,
+          so multiple writers can update the tensor in parallel.
+        - Locks for the chunks, they are used by zarr as synchronizer, so two writers never modify the same chunk
+          at the same time. The keys of the chunks are hashed into a fixed number of stripes, so the number of
+          lock files and thread locks does not grow with the number of chunks written (two chunks of the same
+          stripe are never written in parallel, which is only a loss of concurrency).
+        - Named locks (chunk_lock) for the shared files of the tensor, like the journal or the last valid state.
+
+        The lock files are written in a sibling directory of the data, so they never end on the store or the backup.
+        With inter_process=False only the threads of the process are synchronized.
+
+        The time waiting for the locks is accumulated on stats.
+    """
+
+    # the locks of fasteners only exclude other processes, so every lock also has a thread lock
+    # shared by all the instances of the process
+    _thread_locks: Dict[str, threading.Lock] = {}
+    _thread_rw_locks: Dict[str, fasteners.ReaderWriterLock] = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path: str, inter_process: bool = True, stripes: int = 64):
+        if stripes < 1:
+            raise ValueError(f"The number of stripes must be positive, {stripes} was sent")
+        self.path = path
+        self.inter_process = inter_process
+        self.stripes = stripes
+        self.stats = {
+            'tensor_wait_time': 0.,
+            'tensor_acquisitions': 0,
+            'chunk_wait_time': 0.,
+            'chunk_acquisitions': 0,
+        }
+        self._stats_lock = threading.Lock()
+        self._held = threading.local()
+
+    @property
+    def tensor_lock_path(self) -> str:
+        return os.path.join(self.path, 'ztensor.lock')
+
+    def _get_thread_lock(self, path: str) -> threading.Lock:
+        with self._thread_locks_lock:
+            if path not in self._thread_locks:
+                self._thread_locks[path] = threading.Lock()
+            return self._thread_locks[path]
+
+    def _get_thread_rw_lock(self, path: str) -> fasteners.ReaderWriterLock:
+        with self._thread_locks_lock:
+            if path not in self._thread_rw_locks:
+                self._thread_rw_locks[path] = fasteners.ReaderWriterLock()
+            return self._thread_rw_locks[path]
+
+    def _add_wait(self, name: str, start: float):
+        with self._stats_lock:
+            self.stats[f'{name}_wait_time'] += time.perf_counter() - start
+            self.stats[f'{name}_acquisitions'] += 1
+
+    @contextmanager
+    def tensor_lock(self, exclusive: bool = True):
+        """
+        The lock is reentrant for the same thread, but a thread that has the lock in shared mode
+        can not acquire it in exclusive mode
+        """
+        held = getattr(self._held, 'mode', None)
+        if held == 'exclusive' or (held == 'shared' and not exclusive):
+            yield
+            return
+        if held == 'shared':
+            raise RuntimeError(f"The lock of the tensor {self.path} can not be upgraded to exclusive mode")
+
+        start = time.perf_counter()
+        thread_lock = self._get_thread_rw_lock(self.tensor_lock_path)
+        with thread_lock.write_lock() if exclusive else thread_lock.read_lock():
+            process_lock = None
+            if self.inter_process:
+                os.makedirs(self.path, exist_ok=True)
+                process_lock = fasteners.InterProcessReaderWriterLock(self.tensor_lock_path)
+                if exclusive:
+                    process_lock.acquire_write_lock()
+                else:
+                    process_lock.acquire_read_lock()
+            self._add_wait('tensor', start)
+            self._held.mode = 'exclusive' if exclusive else 'shared'
+            try:
+                yield
+            finally:
+                self._held.mode = None
+                if process_lock is not None:
+                    if exclusive:
+                        process_lock.release_write_lock()
+                    else:
+                        process_lock.release_read_lock()
+
+    @contextmanager
+    def chunk_lock(self, key: str):
+        start = time.perf_counter()
+        lock_path = os.path.join(self.path, 'chunks', key.replace('/', os.sep) + '.lock')
+        with self._get_thread_lock(lock_path):
+            process_lock = fasteners.InterProcessLock(lock_path) if self.inter_process else None
+            if process_lock is not None:
+                process_lock.acquire()
+            self._add_wait('chunk', start)
+            try:
+                yield
+            finally:
+                if process_lock is not None:
+                    process_lock.release()
+
+    def get_stripe(self, key: str) -> str:
+        # the hash of python is randomized on every process, so crc32 is used to share the stripes between them
+        return f'zstripes/{zlib.crc32(key.encode()) % self.stripes}'
+
+    def clear(self):
+        """
+        Delete the lock files of the stripes, this must be called holding the tensor lock in exclusive mode,
+        so no other writer is holding them. The named locks are not deleted because they can be used
+        without the tensor lock
+        """
+        shutil.rmtree(os.path.join(self.path, 'chunks', 'zstripes'), ignore_errors=True)
+
+    def __getitem__(self, key: str):
+        # zarr use the synchronizer as a mapping of locks, one for every key that is written, the keys
+        # are striped, so they never share a lock with the named locks
+        return self.chunk_lock(self.get_stripe(key))
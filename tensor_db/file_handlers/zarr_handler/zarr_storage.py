@@ -4,21 +4,40 @@ import zarr
 import os
 import pandas as pd
 import json
+import shutil
+import numcodecs
 
-from typing import Dict, List, Union
-from datetime import datetime
+from typing import Dict, List, Union, Iterable, Any
+from contextlib import nullcontext
 
 from tensor_db.file_handlers import BaseStorage
-from tensor_db.backup_handlers import S3Handler
+from tensor_db.file_handlers.zarr_handler.coords_index import CoordsIndex
+from tensor_db.file_handlers.zarr_handler.journal_store import JournalStore
+from tensor_db.file_handlers.zarr_handler.lazy_store import LazyRestoreStore
+from tensor_db.file_handlers.zarr_handler.chunk_bundles import ChunkBundles
+from tensor_db.file_handlers.zarr_handler.chunk_planner import ChunkPlanner
+from tensor_db.file_handlers.zarr_handler.tensor_locks import TensorLocks
+from tensor_db.file_handlers.zarr_handler.last_valid_state import LastValidState
+from tensor_db.file_handlers.zarr_handler.hot_mirror import HotMirror
+from tensor_db.backup_handlers import S3Handler, BackupManifest
+from tensor_db import metrics
 
 
 class ZarrStorage(BaseStorage):
     """
-    TODO:
-        1) The next versions of zarr will add support for the modification dates of the chunks, that will simplify
-            the code of backup, so It is a good idea modify the code after the modification being published
+        ZarrStorage
+        ----------
+        Store the tensor as a zarr group, every write is done through a JournalStore that records the modified
+        keys, so the backups only upload the keys of the journal instead of comparing the modification dates
+        of all the files. The optional features (backup formats, lazy restores, locks, hot mirror, etc)
+        are described on the arguments of __init__.
     """
 
+    # files that are only useful for the local copy of the data, so they are never uploaded to the backup
+    local_only_files = ['zcoords_index.npz', 'zdirty_keys.json', 'zbundles_index.json', 'zlazy_keys.json']
+    # files that are modified by the backup itself, so on the files format they are always uploaded at the end
+    backup_metadata_files = ['zbackup_date.json', '.zattrs', '.zmetadata']
+
     def __init__(self,
                  dims: List[str] = None,
                  name: str = "data",
@@ -27,65 +46,229 @@ class ZarrStorage(BaseStorage):
                  s3_handler: Union[S3Handler, Dict] = None,
                  bucket_name: str = None,
                  synchronizer: str = None,
+                 backup_format: str = 'files',
+                 bundle_size: int = 64 * 2 ** 20,
+                 lazy_restore: bool = False,
+                 lazy_cache_bytes: int = 0,
+                 backup_manifest: BackupManifest = None,
+                 chunk_planner: Union[ChunkPlanner, Dict] = None,
+                 compressor: Union[numcodecs.abc.Codec, Dict] = None,
+                 filters: List[Union[numcodecs.abc.Codec, Dict]] = None,
+                 lock_stripes: int = 64,
+                 last_valid_dim: str = None,
+                 hot_mirror: bool = False,
                  **kwargs):
+        """
+        backup_format: 'files' upload every chunk as an independent object and 'bundles' pack the chunks
+            in objects of bundle_size bytes (see ChunkBundles), which is a lot faster when the chunks are small.
+        lazy_restore: The restores only download the metadata and the coords, the chunks are downloaded the first
+            time that they are read (see LazyRestoreStore), lazy_cache_bytes bound the bytes of the downloaded chunks.
+        backup_manifest: The version of the backup is read from the manifest shared by all the tensors
+            of the bucket, instead of downloading the zbackup_date.json of every tensor.
+        chunk_planner: Choose the chunks using the dtype and the access pattern when they are not provided
+            (see ChunkPlanner), it is also used by rechunk.
+        compressor, filters: Codecs of the data variables, they can be the config of the numcodecs codecs, for
+            example {'id': 'blosc', 'cname': 'zstd', 'clevel': 5, 'shuffle': 1} or [{'id': 'bitround', 'keepbits': 12}].
+        synchronizer: 'process' or 'thread' enable the locks of the tensor (see TensorLocks), the actions that
+            modify the metadata, the backups and the restores lock the whole tensor and the updates only lock
+            the chunks that they write, the chunks are locked by stripes (lock_stripes).
+        last_valid_dim: The last valid value of every series along this dim is maintained on every write
+            (see LastValidState), so it can be read without reading the data.
+        hot_mirror: Keep the data variable as an uncompressed memory mapped file (see HotMirror), the reads without
+            chunks use it, so they are views over the page cache without decoding chunks.
+        """
         super().__init__(**kwargs)
         self.dims = dims
         self.name = name
         self.chunks = chunks
+        self.chunk_planner = ChunkPlanner(**chunk_planner) if isinstance(chunk_planner, dict) else chunk_planner
+        self.compressor = self.get_codec(compressor)
+        self.filters = None if filters is None else [self.get_codec(codec) for codec in filters]
+        self.last_valid_dim = last_valid_dim
+        self.last_valid_state = None if last_valid_dim is None else LastValidState(last_valid_dim)
+        # the mirror is a sibling of the data, so it is never part of the store or the backup
+        self.hot_mirror = HotMirror(self.local_path + '_hot') if hot_mirror else None
         self.group = group
         self.bucket_name = bucket_name
         self.s3_handler = s3_handler
-        self.synchronizer = None
+        self.locks = None
         if synchronizer is not None:
-            if synchronizer == 'process':
-                self.synchronizer = zarr.sync.ProcessSynchronizer(self.local_path)
-            elif synchronizer == 'thread':
-                self.synchronizer = zarr.sync.ThreadSynchronizer()
-            else:
+            if synchronizer not in ['process', 'thread']:
                 raise ValueError(f"{synchronizer} is not a valid option for the synchronizer")
+            self.locks = TensorLocks(
+                self.local_path + '_locks',
+                inter_process=synchronizer == 'process',
+                stripes=lock_stripes
+            )
+        # zarr use the locks of the chunks as synchronizer
+        self.synchronizer = self.locks
+
+        if backup_format not in ['files', 'bundles']:
+            raise ValueError(f"{backup_format} is not a valid option for the backup_format")
+        self.backup_format = backup_format
+        self.chunk_bundles = ChunkBundles(self.local_path, s3_path=self.path, bundle_size=bundle_size)
 
+        # the handlers created from settings are owned by the storage, so they are closed with it
+        self._own_s3_handler = isinstance(s3_handler, Dict)
         if isinstance(s3_handler, Dict):
             self.s3_handler = S3Handler(**s3_handler) if isinstance(s3_handler, dict) else s3_handler
 
-        self.chunks_modified_dates = self.get_chunks_modified_dates()
-        self.check_modification = False
+        self.coords_index = CoordsIndex(os.path.join(self.local_path, 'zcoords_index.npz'))
+        self.backup_manifest = backup_manifest
+        self.lazy_restore = lazy_restore
+        if lazy_restore:
+            self.journal_store = LazyRestoreStore(
+                self.local_path,
+                fetch_key=self._fetch_backup_key,
+                cache_bytes=lazy_cache_bytes,
+                journal_name='zdirty_keys.json',
+                locks=self.locks
+            )
+        else:
+            self.journal_store = JournalStore(self.local_path, journal_name='zdirty_keys.json', locks=self.locks)
+        # keys uploaded by the last backup, they are removed from the journal by complete_backup
+        self._backup_keys: List[str] = []
+        self._backup_generation: int = None
+
+    def tensor_lock(self, exclusive: bool = True):
+        if self.locks is None:
+            return nullcontext()
+        return self.locks.tensor_lock(exclusive=exclusive)
+
+    @property
+    def lock_stats(self) -> Dict[str, float]:
+        """
+        Time waiting for the locks of the tensor and the chunks and the number of times that they were acquired
+        """
+        return {} if self.locks is None else dict(self.locks.stats)
+
+    @property
+    def check_modification(self) -> bool:
+        return len(self.journal_store.dirty_keys) > 0
 
     def store(self,
               new_data: Union[xarray.DataArray, xarray.Dataset],
               encoding: Dict = None,
               compute: bool = True,
-              consolidated: bool = False,
+              consolidated: bool = True,
               **kwargs):
 
-        new_data = self._transform_to_dataset(new_data)
-        self.check_modification = True
-        return new_data.to_zarr(
-            self.local_path,
-            group=self.group,
-            mode='w',
-            encoding=encoding,
-            compute=compute,
-            consolidated=consolidated,
-            synchronizer=self.synchronizer
-        )
+        with self.tensor_lock():
+            if self.locks is not None:
+                # the store rewrite all the chunks, so the lock files of the previous ones are not needed
+                self.locks.clear()
+            if self.hot_mirror is not None:
+                # the mirror is built again after the write or by the next read if the write is not computed
+                self.hot_mirror.drop()
+            if self.chunks is None and self.chunk_planner is not None:
+                data = new_data if isinstance(new_data, xarray.DataArray) else new_data[self.name]
+                self.chunks = self.chunk_planner.plan(dict(data.sizes), data.dtype)
+            new_data = self._transform_to_dataset(new_data)
+            with metrics.timer('zarr_write'):
+                delayed = new_data.to_zarr(
+                    self.journal_store,
+                    group=self.group,
+                    mode='w',
+                    encoding=self._get_encoding(new_data, encoding),
+                    compute=compute,
+                    consolidated=consolidated,
+                    synchronizer=self.synchronizer
+                )
+            self.journal_store.flush()
+            if self.backup_format == 'bundles':
+                # the previous keys of the bundles are not valid anymore, even the ones that are not on the journal
+                self.chunk_bundles.reset(self.group)
+            self.coords_index.reset({dim: index.values for dim, index in new_data.indexes.items()})
+            if compute:
+                self._update_last_valid()
+                self._update_hot_mirror()
+            return delayed
+
+    @staticmethod
+    def get_codec(codec: Union[numcodecs.abc.Codec, Dict]) -> numcodecs.abc.Codec:
+        if isinstance(codec, dict):
+            # get_codec modify the config
+            return numcodecs.get_codec(dict(codec))
+        return codec
+
+    def _get_encoding(self, new_data: xarray.Dataset, encoding: Dict = None) -> Dict:
+        """
+        Add the compressor and the filters of the storage to the encoding of every data variable,
+        the encoding sent by the user has priority
+        """
+        encoding = {} if encoding is None else dict(encoding)
+        codecs = {}
+        if self.compressor is not None:
+            codecs['compressor'] = self.compressor
+        if self.filters is not None:
+            codecs['filters'] = self.filters
+        if not codecs:
+            return encoding or None
+        for name in new_data.data_vars:
+            encoding[name] = {**codecs, **encoding.get(name, {})}
+        return encoding
 
     def append(self,
                new_data: Union[xarray.DataArray, xarray.Dataset],
+               single_pass: bool = True,
                **kwargs):
+        """
+        Append the coords of new_data that are not stored, by default all the dims are grown at the same time
+        (single_pass=True), the arrays are resized only once and after that only the new slabs of the data are
+        written, so appending new labels in multiple dims at the same time does not rewrite the metadata
+        or the data multiple times. The single_pass=False option append dim by dim using xarray.
+        """
 
         exist = self.exist(raise_error_missing_backup=False, **kwargs)
         if not exist:
             return self.store(new_data=new_data, **kwargs)
 
-        new_data = self._transform_to_dataset(new_data)
-        act_coords = {k: coord.values for k, coord in self.read().coords.items()}
+        # the arrays are resized, so no other process can write on the tensor at the same time
+        with self.tensor_lock():
+            self._append(self._transform_to_dataset(new_data), single_pass)
 
-        for dim, new_coord in new_data.coords.items():
-            new_coord = new_coord.values
-            coord_to_append = new_coord[~np.isin(new_coord, act_coords[dim])]
-            if len(coord_to_append) == 0:
-                continue
+    def _append(self, new_data: xarray.Dataset, single_pass: bool):
+        coords_index = self.get_coords_index()
+
+        coords_to_append = {}
+        for dim in new_data.dims:
+            new_coord = new_data.coords[dim].values
+            coord_to_append = new_coord[~coords_index.isin(dim, new_coord)]
+            if len(coord_to_append) > 0:
+                coords_to_append[dim] = coord_to_append
+
+        if len(coords_to_append) == 0:
+            return
 
+        act_coords = coords_index.coords
+        try:
+            with metrics.timer('zarr_write'):
+                if single_pass:
+                    self._append_single_pass(new_data, coords_to_append)
+                else:
+                    self._append_by_dim(new_data, coords_to_append)
+            # the shapes of the arrays changed, so the consolidated metadata must be rewritten
+            self._consolidate_metadata(self.journal_store)
+        finally:
+            self.journal_store.flush()
+
+        for dim, coord_to_append in coords_to_append.items():
+            coords_index.append(dim, coord_to_append)
+        coords_index.save()
+        self._update_last_valid({dim: new_data.coords[dim].values for dim in new_data.dims})
+        # only the new labels are written on the store, so the mirror receives the same slabs and the values
+        # of new_data on the labels that already existed are ignored
+        variable = new_data[self.name]
+        self._update_hot_mirror([
+            variable.reindex(slab_coords)
+            for _, slab_coords in self._get_append_slabs(
+                list(variable.dims), act_coords, coords_index.coords, coords_to_append
+            )
+        ])
+
+    def _append_by_dim(self, new_data: xarray.Dataset, coords_to_append: Dict[str, np.ndarray]):
+        act_coords = self.coords_index.coords
+        for dim, coord_to_append in coords_to_append.items():
             reindex_coords = {
                 k: coord_to_append if k == dim else act_coord
                 for k, act_coord in act_coords.items()
@@ -93,76 +276,462 @@ class ZarrStorage(BaseStorage):
             data_to_append = new_data.reindex(reindex_coords)
             act_coords[dim] = np.concatenate([act_coords[dim], coord_to_append])
             data_to_append.to_zarr(
-                self.local_path,
+                self.journal_store,
                 append_dim=dim,
                 compute=True,
                 group=self.group,
                 synchronizer=self.synchronizer
             )
 
-            self.check_modification = True
+    def _grow_arrays(self, group: zarr.Group, dims: List[str], coords_to_append: Dict[str, np.ndarray]):
+        """
+        Resize all the arrays only once and write the new labels of the coords, the new part of the data
+        contains the fill value until it is written
+        """
+        act_sizes = self.coords_index.sizes
+        total_sizes = {dim: act_sizes[dim] + len(coords_to_append.get(dim, [])) for dim in dims}
+        for _, arr in group.arrays():
+            arr.resize(*[total_sizes.get(dim, size) for dim, size in zip(arr.attrs['_ARRAY_DIMENSIONS'], arr.shape)])
+
+        for dim, coord_to_append in coords_to_append.items():
+            group[dim][act_sizes[dim]:] = self._encode_values(group[dim], coord_to_append)
+
+    def _append_single_pass(self, new_data: xarray.Dataset, coords_to_append: Dict[str, np.ndarray]):
+        act_coords = self.coords_index.coords
+        group = zarr.open_group(self.journal_store, path=self.group, mode='a', synchronizer=self.synchronizer)
+        # the data variables can have different dims, so all the dims of the tensor are grown
+        self._grow_arrays(group, list(act_coords), coords_to_append)
+
+        total_coords = {
+            dim: np.concatenate([act_coords[dim], coords_to_append.get(dim, [])]).astype(act_coords[dim].dtype)
+            for dim in act_coords
+        }
+        for name, variable in new_data.data_vars.items():
+            self._write_append_slabs(group[name], variable, act_coords, total_coords, coords_to_append)
+
+    def _write_append_slabs(self,
+                            arr: zarr.Array,
+                            variable: xarray.DataArray,
+                            act_coords: Dict[str, np.ndarray],
+                            total_coords: Dict[str, np.ndarray],
+                            coords_to_append: Dict[str, np.ndarray]):
+        """
+        Write the new part of the array slab by slab (see _get_append_slabs), the slabs are reindexed
+        from the lazy data, so only one slab is computed at the same time
+        """
+        dims = arr.attrs['_ARRAY_DIMENSIONS']
+        for region, slab_coords in self._get_append_slabs(dims, act_coords, total_coords, coords_to_append):
+            slab = variable.reindex(slab_coords).transpose(*dims)
+            arr[region] = self._encode_values(arr, slab.values)
+
+    @staticmethod
+    def _get_append_slabs(dims: List[str],
+                          act_coords: Dict[str, np.ndarray],
+                          total_coords: Dict[str, np.ndarray],
+                          coords_to_append: Dict[str, np.ndarray]):
+        """
+        Every slab contains the old labels of the previous dims, the new labels of the dim and all the labels
+        of the next dims, so the union of the slabs is the new part of the array (including the corners).
+        The region (positions) and the labels of every slab are generated, so the slabs can be reindexed
+        from the lazy data one at a time
+        """
+        for i, dim in enumerate(dims):
+            if dim not in coords_to_append:
+                continue
+            slab_coords = {
+                **{prev_dim: act_coords[prev_dim] for prev_dim in dims[:i]},
+                dim: coords_to_append[dim],
+                **{next_dim: total_coords[next_dim] for next_dim in dims[i + 1:]}
+            }
+            region = tuple(
+                [slice(0, len(act_coords[prev_dim])) for prev_dim in dims[:i]] +
+                [slice(len(act_coords[dim]), len(total_coords[dim]))] +
+                [slice(0, len(total_coords[next_dim])) for next_dim in dims[i + 1:]]
+            )
+            yield region, slab_coords
+
+    @staticmethod
+    def _encode_values(arr: zarr.Array, values: np.ndarray) -> np.ndarray:
+        """
+        Encode the values using the same encoding that xarray used to write the array (units, fill value, etc)
+        """
+        encoding = {k: v for k, v in arr.attrs.items() if k != '_ARRAY_DIMENSIONS'}
+        if arr.fill_value is not None and np.issubdtype(arr.dtype, np.number):
+            encoding['_FillValue'] = arr.fill_value
+        variable = xarray.Variable(
+            arr.attrs['_ARRAY_DIMENSIONS'],
+            values,
+            encoding={**encoding, 'dtype': arr.dtype}
+        )
+        return xarray.conventions.encode_cf_variable(variable).values
 
     def update(self,
                new_data: Union[xarray.DataArray, xarray.Dataset],
                **kwargs):
         """
-        TODO: Avoid loading the entire new data in memory
-              Using the to_zarr method of xarray and updating in blocks with the region parameter is
-              probably a good solution, the only problem is the time that could take to update,
-              but I suppose that the block updating is ideal only when the new_data represent a big % of the entire data
+        Update the values of the coords that already exist on the stored data, the coords that are not
+        stored are ignored.
+
+        The new coords are mapped to integer positions and the data is written by blocks aligned to the
+        chunks of the first dim, this allow to touch only the chunks that really contain the new data and
+        the memory used is proportional to the size of the block and not the size of the stored data.
+        Every block is written using slices if the positions are contiguous (dense and sparse updates),
+        in other case an orthogonal selection is used (scattered updates).
         """
         self.exist(raise_error_missing_backup=True, **kwargs)
 
         if isinstance(new_data, xarray.Dataset):
-            new_data = new_data.to_array()
-        act_coords = {k: coord.values for k, coord in self.read().coords.items()}
+            new_data = new_data[self.name]
 
-        coords_names = list(act_coords.keys())
-        bitmask = np.isin(act_coords[coords_names[0]], new_data.coords[coords_names[0]].values)
-        for coord_name in coords_names[1:]:
-            bitmask = bitmask & np.isin(act_coords[coord_name], new_data.coords[coord_name].values)[:, None]
+        # the update only needs the locks of the chunks that it writes
+        with self.tensor_lock(exclusive=False):
+            group = zarr.open_group(self.journal_store, path=self.group, mode='a', synchronizer=self.synchronizer)
+            arr = group[self.name]
+            dims = arr.attrs['_ARRAY_DIMENSIONS']
+            new_data = new_data.transpose(*dims)
 
-        arr = zarr.open(
-            os.path.join(self.local_path, self.name),
-            mode='a',
-            synchronizer=self.synchronizer
-        )
-        arr.set_mask_selection(bitmask, new_data.values.ravel())
-        self.check_modification = True
+            positions = self._get_positions(new_data, dims)
+            if positions is None:
+                return
+
+            # the update only write chunks, the metadata is not modified so there is no need to consolidate it again
+            try:
+                with metrics.timer('zarr_write'):
+                    self._update_blocks(arr, new_data, dims, positions)
+            finally:
+                self.journal_store.flush()
+            self._update_last_valid({dim: new_data.coords[dim].values for dim in dims})
+            self._update_hot_mirror(new_data)
+
+    def _get_positions(self, new_data: xarray.DataArray, dims: List[str]) -> Dict[str, tuple]:
+        """
+        Sorted positions of the labels of new_data that are stored and their positions on new_data,
+        None if some dim does not have any stored label
+        """
+        coords_index = self.get_coords_index()
+        positions = {}
+        for dim in dims:
+            dim_positions = coords_index.get_positions(dim, new_data.coords[dim].values)
+            new_data_positions = np.flatnonzero(dim_positions != -1)
+            if len(new_data_positions) == 0:
+                return None
+            sorter = np.argsort(dim_positions[new_data_positions], kind='stable')
+            positions[dim] = (dim_positions[new_data_positions][sorter], new_data_positions[sorter])
+        return positions
+
+    def _update_blocks(self,
+                       arr: zarr.Array,
+                       new_data: xarray.DataArray,
+                       dims: List[str],
+                       positions: Dict[str, tuple]):
+        first_positions, first_new_data_positions = positions[dims[0]]
+        blocks = np.flatnonzero(np.diff(first_positions // arr.chunks[0])) + 1
+        for block in np.split(np.arange(len(first_positions)), blocks):
+            block_positions = {**positions, dims[0]: (first_positions[block], first_new_data_positions[block])}
+            arr_selection = tuple(
+                self._positions_to_selection(block_positions[dim][0])
+                for dim in dims
+            )
+            values = new_data.isel({
+                dim: self._positions_to_selection(block_positions[dim][1])
+                for dim in dims
+            }).values
+
+            if all(isinstance(dim_selection, slice) for dim_selection in arr_selection):
+                arr[arr_selection] = values
+            else:
+                arr.set_orthogonal_selection(arr_selection, values)
 
-    def upsert(self, new_data: Union[xarray.DataArray, xarray.Dataset], **kwargs):
-        self.update(new_data, **kwargs)
-        self.append(new_data, **kwargs)
+    @staticmethod
+    def _positions_to_selection(positions: np.ndarray) -> Union[slice, np.ndarray]:
+        if positions[-1] - positions[0] + 1 == len(positions) and np.all(np.diff(positions) == 1):
+            return slice(int(positions[0]), int(positions[-1]) + 1)
+        return positions
+
+    def upsert(self,
+               new_data: Union[xarray.DataArray, xarray.Dataset, Iterable[Union[xarray.DataArray, xarray.Dataset]]],
+               **kwargs):
+        """
+        Update the coords that are stored and append the new ones in a single pass, the arrays are grown first
+        (like the single pass append) and after that all the labels of new_data exist on the store, so the
+        overlap and the new region are written together by blocks aligned to the chunks of the first dim.
+
+        new_data can be backed by dask, only the block that is being written is computed, or it can be
+        an iterable of blocks (DataArray or Dataset) that is consumed writing every block when it is produced,
+        in both cases the memory used is bounded by the size of a block.
+        All the data variables of a Dataset are written.
+        """
+        if not isinstance(new_data, (xarray.DataArray, xarray.Dataset)):
+            for block in new_data:
+                self.upsert(block, **kwargs)
+            return
+
+        if not self.exist(raise_error_missing_backup=False, **kwargs):
+            return self.store(new_data=new_data, **kwargs)
+
+        if isinstance(new_data, xarray.DataArray):
+            new_data = new_data.to_dataset(name=self.name)
+
+        # the tensor is locked in exclusive mode only if the arrays must grow
+        with self.tensor_lock(exclusive=False):
+            if self._upsert(new_data, grow=False):
+                return
+        with self.tensor_lock():
+            self._upsert(new_data, grow=True)
+
+    def _upsert(self, new_data: xarray.Dataset, grow: bool) -> bool:
+        """
+        Return False without writing anything if new_data has new labels and grow is False
+        """
+        group = zarr.open_group(self.journal_store, path=self.group, mode='a', synchronizer=self.synchronizer)
+        coords_index = self.get_coords_index()
+
+        coords_to_append = {}
+        for dim in new_data.dims:
+            new_coord = new_data.coords[dim].values
+            coord_to_append = new_coord[~coords_index.isin(dim, new_coord)]
+            if len(coord_to_append) > 0:
+                coords_to_append[dim] = coord_to_append
+        if coords_to_append and not grow:
+            return False
+
+        try:
+            with metrics.timer('zarr_write'):
+                if coords_to_append:
+                    # the data variables can have different dims, so all the dims of the tensor are grown
+                    self._grow_arrays(group, list(coords_index.coords), coords_to_append)
+                    self._consolidate_metadata(self.journal_store)
+                    for dim, coord_to_append in coords_to_append.items():
+                        coords_index.append(dim, coord_to_append)
+                    coords_index.save()
+
+                for name, variable in new_data.data_vars.items():
+                    dims = group[name].attrs['_ARRAY_DIMENSIONS']
+                    variable = variable.transpose(*dims)
+                    positions = self._get_positions(variable, dims)
+                    if positions is not None:
+                        self._update_blocks(group[name], variable, dims, positions)
+        finally:
+            self.journal_store.flush()
+        self._update_last_valid({dim: new_data.coords[dim].values for dim in new_data.dims})
+        self._update_hot_mirror(new_data[self.name])
+        return True
+
+    def rechunk(self, chunks: Dict[str, int] = None, **kwargs):
+        """
+        Rewrite the data variables using new chunks, if they are not provided the chunk_planner is used.
+        The data is streamed using dask, so only some chunks of the old and new layout are in memory at the
+        same time. The new arrays are written in a temporal directory next to the store and after that they are
+        swapped with the old ones using renames (see JournalStore.replace_dir), so the old chunks are deleted
+        only when the new arrays are complete and an array is never a mix of both layouts.
+        If the swap fails the old arrays are restored and the temporal directory is kept, so the new arrays
+        can be recovered.
+        """
+        self.exist(raise_error_missing_backup=True, **kwargs)
+        with self.tensor_lock():
+            dataset = self.read_as_dataset(**kwargs)
+            if chunks is None:
+                if self.chunk_planner is None:
+                    raise ValueError("The chunks or a chunk_planner must be provided to rechunk the data")
+                chunks = self.chunk_planner.plan(
+                    {dim: dataset.sizes[dim] for dim in dataset[self.name].dims},
+                    dataset[self.name].dtype
+                )
+
+            for variable in dataset.data_vars.values():
+                # only the chunks are modified, the rest of the stored encoding (compressor, filters, fill value,
+                # etc) is kept, an encoding sent to to_zarr would replace all of it
+                variable.encoding.pop('preferred_chunks', None)
+                variable.encoding['chunks'] = tuple(chunks.get(dim, dataset.sizes[dim]) for dim in variable.dims)
+            dataset = dataset.chunk({dim: size for dim, size in chunks.items() if dim in dataset.dims})
+
+            tmp_path = self.local_path + '_rechunk'
+            old_path = self.local_path + '_rechunk_old'
+            for path in [tmp_path, old_path]:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            try:
+                dataset[list(dataset.data_vars)].to_zarr(tmp_path, mode='w', consolidated=False, compute=True)
+            except Exception:
+                # the old arrays were not modified, so the incomplete copy is useless
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+            os.makedirs(old_path)
+            try:
+                for name in dataset.data_vars:
+                    self.journal_store.replace_dir(
+                        os.path.join(self.group or '', name).replace('\\', '/'),
+                        new_dir=os.path.join(tmp_path, name),
+                        old_dir=os.path.join(old_path, name)
+                    )
+            finally:
+                # some arrays could be swapped before a failure, so the metadata is always consolidated again
+                self._consolidate_metadata(self.journal_store)
+                self.journal_store.flush()
+            shutil.rmtree(tmp_path)
+            shutil.rmtree(old_path)
+            self.chunks = chunks
 
     def read_as_dataset(self,
-                        consolidated: bool = False,
+                        consolidated: bool = None,
                         chunks: Dict = None,
+                        sel: Dict[str, Any] = None,
                         **kwargs) -> xarray.Dataset:
+        """
+        By default the consolidated metadata is used if it exists, so opening the data only read one file
+        instead of the .zarray and .zattrs of every variable.
+
+        sel is a selection of labels for every dim (see CoordsIndex.resolve_selection), it is resolved
+        to integer positions using the coords index before opening the data and the data is lazy,
+        so only the chunks that contain the selected positions are read and decoded
+        """
         self.exist(raise_error_missing_backup=True, **kwargs)
-        return xarray.open_zarr(
-            self.local_path,
+        isel = None
+        if sel:
+            coords_index = self.get_coords_index()
+            isel = {dim: coords_index.get_selection(dim, selection) for dim, selection in sel.items()}
+        if consolidated is None:
+            consolidated = self._has_consolidated_metadata(self.journal_store)
+        dataset = xarray.open_zarr(
+            self.journal_store,
             group=self.group,
             consolidated=consolidated,
             chunks=chunks,
             synchronizer=self.synchronizer
         )
+        return dataset if isel is None else dataset.isel(isel)
 
     def read(self, **kwargs) -> xarray.DataArray:
+        if self.hot_mirror is not None and kwargs.get('chunks') is None:
+            return self.read_hot(**kwargs)
         dataset = self.read_as_dataset(**kwargs)
         return dataset[self.name]
 
-    def get_chunks_modified_dates(self):
-        if not self.exist():
-            return {}
+    def read_hot(self, sel: Dict[str, Any] = None, **kwargs) -> xarray.DataArray:
+        """
+        Read the data variable from the hot mirror, the mirror is built the first time if it does not exist.
+        The mirror is written after every store, append, update and upsert, so all the writers of the tensor must
+        enable it, the writes of a handler without the mirror are not reflected on it
+        """
+        if self.hot_mirror is None:
+            raise ValueError(f"The tensor {self.path} does not have a hot mirror, use hot_mirror")
+        self.exist(raise_error_missing_backup=True, **kwargs)
+        if not self.hot_mirror.exist():
+            with self.tensor_lock(exclusive=False):
+                self._update_hot_mirror()
+        return self.hot_mirror.read(name=self.name, sel=sel)
+
+    def read_coords(self, **kwargs) -> Dict[str, np.ndarray]:
+        self.exist(raise_error_missing_backup=True, **kwargs)
+        return self.get_coords_index().coords
 
-        arr_store = zarr.open(self.local_path, mode='r')
-        chunks_dates = {
-            os.path.join(self.local_path, chunk_name): pd.to_datetime(
-                datetime.fromtimestamp(os.path.getmtime(os.path.join(self.local_path, chunk_name)))
+    def get_coords_index(self) -> CoordsIndex:
+        with metrics.timer('coords_read'):
+            self.coords_index.load(
+                read_coords=lambda: {dim: index.values for dim, index in self.read_as_dataset().indexes.items()},
+                read_sizes=self._read_coords_sizes
             )
-            for chunk_name in arr_store.chunk_store.keys()
-        }
-        return chunks_dates
+        return self.coords_index
+
+    def _read_coords_sizes(self) -> Dict[str, int]:
+        group = zarr.open_group(self.journal_store, path=self.group, mode='r')
+        return {dim: group[dim].shape[0] for dim in group[self.name].attrs['_ARRAY_DIMENSIONS']}
+
+    def _update_last_valid(self, coords: Dict[str, np.ndarray] = None):
+        """
+        Update the state of the last valid values after writing the coords, the state is built again if
+        the coords are not sent or if it does not exist
+        """
+        if self.last_valid_state is None:
+            return
+        # the state is shared by all the writers, so it is modified by only one of them at the same time
+        with nullcontext() if self.locks is None else self.locks.chunk_lock(LastValidState.group_name):
+            try:
+                group = zarr.open_group(self.journal_store, path=self.group, mode='a')
+                exist = self.last_valid_state.exist(group)
+                if self.last_valid_state.require(group, self.name):
+                    self._consolidate_metadata(self.journal_store)
+                if coords is None or not exist:
+                    self.last_valid_state.rebuild(group, self.name)
+                    return
+                coords_index = self.get_coords_index()
+                positions = {}
+                for dim in group[self.name].attrs['_ARRAY_DIMENSIONS']:
+                    dim_positions = coords_index.get_positions(dim, np.asarray(coords[dim]))
+                    positions[dim] = dim_positions[dim_positions != -1]
+                self.last_valid_state.update(
+                    group,
+                    self.name,
+                    positions.pop(self.last_valid_dim),
+                    list(positions.values())
+                )
+            finally:
+                self.journal_store.flush()
+
+    def _update_hot_mirror(self, new_data: Union[xarray.DataArray, List[xarray.DataArray]] = None):
+        """
+        Write new_data (or every part of a list of them) on the hot mirror after writing it on the store,
+        the mirror is built again reading the store if new_data is not sent or if the mirror does not exist
+        """
+        if self.hot_mirror is None:
+            return
+        # the mirror is shared by all the writers, so it is modified by only one of them at the same time
+        with nullcontext() if self.locks is None else self.locks.chunk_lock('zhot_mirror'):
+            if new_data is None or not self.hot_mirror.exist():
+                data = self.read_as_dataset()[self.name]
+                block_size = (data.encoding.get('chunks') or data.shape)[0]
+                self.hot_mirror.rebuild(data, block_size=block_size)
+                return
+            coords = self.get_coords_index().coords
+            for data in new_data if isinstance(new_data, list) else [new_data]:
+                self.hot_mirror.write(data, coords)
+
+    def read_last_valid(self, **kwargs) -> xarray.Dataset:
+        """
+        Last valid value of every series along last_valid_dim (value) and its label (label),
+        the label is missing for the series that does not have any valid value
+        """
+        if self.last_valid_state is None:
+            raise ValueError(f"The tensor {self.path} does not maintain the last valid values, use last_valid_dim")
+        self.exist(raise_error_missing_backup=True, **kwargs)
+        if not self.last_valid_state.exist(zarr.open_group(self.journal_store, path=self.group, mode='r')):
+            # the tensor was stored before maintaining the state
+            with self.tensor_lock(exclusive=False):
+                self._update_last_valid()
+
+        state = xarray.open_zarr(
+            self.journal_store,
+            group=os.path.join(self.group or '', LastValidState.group_name).replace('\\', '/').lstrip('/'),
+            consolidated=False
+        ).load()
+        # the positions are read without decoding, xarray would mask the -1 of the series without valid values
+        positions, _ = self.last_valid_state.read(zarr.open_group(self.journal_store, path=self.group, mode='r'))
+        coords_index = self.get_coords_index()
+        dims = state['value'].dims
+        series_coords = {dim: coords_index.coords[dim] for dim in dims if dim in coords_index.coords}
+        labels = coords_index.coords[self.last_valid_dim][np.maximum(positions, 0)]
+        state = xarray.Dataset({
+            'value': state['value'],
+            'label': xarray.DataArray(labels, dims=dims).where(positions >= 0),
+        }).assign_coords(series_coords)
+        if LastValidState.single_series_dim in state.dims:
+            state = state.isel({LastValidState.single_series_dim: 0})
+        return state
+
+    @property
+    def metadata_key(self) -> str:
+        return os.path.join(self.group or '', '.zmetadata').replace('\\', '/').lstrip('/')
+
+    def _has_consolidated_metadata(self, store: zarr.storage.BaseStore) -> bool:
+        return self.metadata_key in store
+
+    def _consolidate_metadata(self, store: zarr.storage.BaseStore):
+        """
+        Rewrite the consolidated metadata, only if the data was stored using it
+        """
+        if self._has_consolidated_metadata(store):
+            zarr.consolidate_metadata(store, path=self.group or '')
 
     def _transform_to_dataset(self, new_data) -> xarray.Dataset:
 
@@ -174,9 +743,8 @@ class ZarrStorage(BaseStorage):
 
     def backup(self, overwrite_backup: bool = False, **kwargs) -> bool:
         """
-            TODO:
-                1) Add the synchronizer option for this method, this will prevent from uploading a file that
-                    is being wrote by another process or thread
+        The tensor is locked only while the backup is prepared and completed, the writers can continue during
+        the upload and the keys that they modify are kept on the journal for the next backup
         """
 
         if self.s3_handler is None:
@@ -185,14 +753,52 @@ class ZarrStorage(BaseStorage):
         if not overwrite_backup and not self.check_modification:
             return False
 
-        self.check_modification = False
+        files_modified = self.get_backup_files(overwrite_backup=overwrite_backup, **kwargs)
+        if len(files_modified) > 0:
+            # uploading all the files in parallel
+            self.s3_handler.upload_files(files_modified)
+            self.complete_backup()
+
+        return True
+
+    def get_backup_files(self, overwrite_backup: bool = False, **kwargs) -> List[Dict]:
+        """
+        Prepare the backup and return the files that must be uploaded, this allow to upload the files of
+        multiple tensors in a single batch, after uploading them complete_backup must be called.
+
+        Only the keys of the journal are uploaded, with overwrite_backup all the keys of the store are uploaded
+        """
+        if self.s3_handler is None:
+            return []
+
+        with self.tensor_lock(), metrics.timer('backup_files'):
+            return self._get_backup_files(overwrite_backup, **kwargs)
+
+    def _get_backup_files(self, overwrite_backup: bool, **kwargs) -> List[Dict]:
+        dirty_keys, generation = self.journal_store.checkpoint()
+        if not overwrite_backup and not dirty_keys:
+            return []
+
+        self._backup_generation = generation
         arr_store = zarr.open(self.local_path, mode='a')
+        keys = arr_store.chunk_store.keys() if overwrite_backup else sorted(dirty_keys)
+        self._backup_keys = list(dirty_keys)
+        if self.backup_format == 'bundles':
+            return self._get_bundles_backup_files(keys, **kwargs)
+
         files_modified = []
+        deleted_s3_paths = []
 
-        for chunk_name in arr_store.chunk_store.keys():
+        for chunk_name in keys:
             total_path = os.path.join(self.local_path, chunk_name)
-            modified_date = pd.to_datetime(datetime.fromtimestamp(os.path.getmtime(total_path)))
-            if not overwrite_backup and self.chunks_modified_dates.get(total_path, '') == modified_date:
+            # the deleted keys are kept on the journal but there is nothing to upload
+            if chunk_name in self.local_only_files:
+                continue
+            if not os.path.exists(total_path):
+                deleted_s3_paths.append(os.path.join(self.path, chunk_name).replace('\\', '/'))
+                continue
+            # the backup metadata is always uploaded at the end
+            if chunk_name in self.backup_metadata_files:
                 continue
 
             files_modified.append(dict(
@@ -202,44 +808,95 @@ class ZarrStorage(BaseStorage):
                 **kwargs
             ))
 
-        if len(files_modified) > 0:
-            backup_date = str(pd.Timestamp.now())
-
-            # adding data about the backup, this is useful to avoid download all the information again and again
-            with open(os.path.join(self.local_path, 'zbackup_date.json'), 'w') as json_file:
-                json.dump({'backup_date': backup_date}, json_file)
+        # the modifications of the attributes also generate a backup
+        if len(files_modified) > 0 or '.zattrs' in keys:
+            backup_date = self._write_backup_date()
 
+            # the consolidated metadata of the root contains the attributes, so it is rewritten after them
+            consolidated = self.group is None and self._has_consolidated_metadata(arr_store.store)
             zchunks_backup_metadata = arr_store.attrs.get('zchunks_backup_metadata', {})
             zchunks_backup_metadata.update({
                 file_modified['s3_path']: backup_date
                 for file_modified in files_modified
             })
+            # the deleted keys are not downloaded anymore by the restores
+            for s3_path in deleted_s3_paths:
+                zchunks_backup_metadata.pop(s3_path, None)
+            if consolidated:
+                zchunks_backup_metadata[os.path.join(self.path, '.zmetadata').replace('\\', '/')] = backup_date
             arr_store.attrs['zchunks_backup_metadata'] = zchunks_backup_metadata
+            if consolidated:
+                self._consolidate_metadata(arr_store.store)
 
-            for name in ['zbackup_date.json', '.zattrs']:
+            for name in ['zbackup_date.json', '.zattrs'] + (['.zmetadata'] if consolidated else []):
                 files_modified.append(dict(
                     local_path=os.path.join(self.local_path, name),
                     s3_path=os.path.join(self.path, name).replace('\\', '/'),
                     bucket_name=self.bucket_name,
                     **kwargs
                 ))
+        else:
+            # only deleted keys, so there is nothing to upload
+            self.complete_backup()
 
-            # uploading all the files in parallel
-            self.s3_handler.upload_files(files_modified)
+        return files_modified
 
-            # update the chunks modified dates
-            self.chunks_modified_dates = self.get_chunks_modified_dates()
+    def _get_bundles_backup_files(self, keys: List[str], **kwargs) -> List[Dict]:
+        keys = [key for key in keys if key not in self.local_only_files and key != 'zbackup_date.json']
+        files_modified = self.chunk_bundles.pack(self.s3_handler, self.bucket_name, keys, **kwargs)
+        self._write_backup_date()
+        if len(files_modified) == 0:
+            # only deleted keys, so the index is the only thing that has to be uploaded
+            self.complete_backup()
+        return files_modified
 
-        return True
+    def _write_backup_date(self, backup_date: str = None) -> str:
+        backup_date = str(pd.Timestamp.now()) if backup_date is None else backup_date
+        # adding data about the backup, this is useful to avoid download all the information again and again
+        with open(os.path.join(self.local_path, 'zbackup_date.json'), 'w') as json_file:
+            json.dump({'backup_date': backup_date}, json_file)
+        return backup_date
+
+    def get_backup_version(self) -> str:
+        """
+        Version (date) of the last backup made or restored by the local copy
+        """
+        if not os.path.exists(os.path.join(self.local_path, 'zbackup_date.json')):
+            return None
+        with open(os.path.join(self.local_path, 'zbackup_date.json'), 'r') as json_file:
+            return json.load(json_file)['backup_date']
+
+    def complete_backup(self, update_manifest: bool = True, **kwargs):
+        """
+        update_manifest=False allow to update the manifest of multiple tensors with a single write
+        """
+        if self.backup_format == 'bundles':
+            # the index and the date are published after the bundles, so the readers never see a partial backup
+            self.chunk_bundles.commit(self.s3_handler, self.bucket_name)
+            self.s3_handler.upload_file(
+                bucket_name=self.bucket_name,
+                local_path=os.path.join(self.local_path, 'zbackup_date.json'),
+                s3_path=os.path.join(self.path, 'zbackup_date.json').replace('\\', '/'),
+                max_concurrency=1
+            )
+        if self.backup_manifest is not None and update_manifest:
+            self.backup_manifest.set_versions({self.path: self.get_backup_version()})
+        # the keys that were written during the upload have a greater generation, so they are kept
+        # on the journal for the next backup
+        with self.tensor_lock():
+            self.journal_store.clear_journal(self._backup_keys, self._backup_generation)
+        self._backup_keys = []
+        self._backup_generation = None
 
     def equal_to_backup(self, **kwargs) -> str:
         if self.bucket_name is None:
             return "not backup"
 
-        backup_date = {}
-        if os.path.exists(os.path.join(self.local_path, 'zbackup_date.json')):
-            with open(os.path.join(self.local_path, 'zbackup_date.json'), 'r') as json_file:
-                backup_date = json.load(json_file)['backup_date']
+        backup_date = self.get_backup_version()
+
+        backup_date_s3 = self._get_manifest_version()
+        if backup_date_s3 is not None:
+            return "equal" if backup_date == backup_date_s3 else "not equal"
 
         try:
             self.s3_handler.download_file(
@@ -262,17 +919,25 @@ class ZarrStorage(BaseStorage):
             return "equal"
         return "not equal"
 
+    def _get_manifest_version(self) -> str:
+        # the tensors that were not backed up using the manifest are not on it
+        if self.backup_manifest is None:
+            return None
+        return self.backup_manifest.get_version(self.path)
+
     def update_from_backup(self,
                            force_update_from_backup: bool = False,
                            **kwargs) -> bool:
         """
-            TODO:
-                1) Add the synchronizer option for this method, this will prevent from overwriting a file that
-                    is being used by another process or thread
+        The tensor is locked during the restore, so the files are never overwritten while other process writes
         """
         if self.s3_handler is None:
             return False
 
+        with self.tensor_lock():
+            return self._update_from_backup(force_update_from_backup, **kwargs)
+
+    def _update_from_backup(self, force_update_from_backup: bool, **kwargs) -> bool:
         force_update_from_backup = force_update_from_backup | (not os.path.exists(self.local_path))
 
         is_equal = self.equal_to_backup()
@@ -281,6 +946,38 @@ class ZarrStorage(BaseStorage):
         if not force_update_from_backup and is_equal == 'equal':
             return False
 
+        updated = self._restore_from_backup(force_update_from_backup, **kwargs)
+        if updated and self.hot_mirror is not None:
+            # the data could have changed, so the mirror is built again the next time that it is used
+            self.hot_mirror.drop()
+        # the manifest does not download the zbackup_date.json, so the version must be written after restoring
+        manifest_version = self._get_manifest_version()
+        if manifest_version is not None and os.path.exists(self.local_path):
+            self._write_backup_date(manifest_version)
+        return updated
+
+    def _restore_from_backup(self, force_update_from_backup: bool, **kwargs) -> bool:
+        if self.backup_format == 'bundles':
+            pending_keys = {}
+
+            def on_lazy_key(key, entry):
+                if self.lazy_restore and self._is_lazy_key(key):
+                    pending_keys[key] = entry
+                    return True
+                return False
+
+            if not self.chunk_bundles.restore(
+                    self.s3_handler,
+                    self.bucket_name,
+                    force=force_update_from_backup,
+                    on_lazy_key=on_lazy_key
+            ):
+                return False
+            if self.lazy_restore:
+                self.journal_store.add_pending_keys(pending_keys)
+            self.coords_index.drop()
+            return True
+
         last_backup_dates = {}
         if not force_update_from_backup and os.path.exists(os.path.join(self.local_path, '.zattrs')):
             with open(os.path.join(self.local_path, '.zattrs'), mode='r') as json_file:
@@ -311,10 +1008,38 @@ class ZarrStorage(BaseStorage):
         if len(files_to_download) == 0:
             return False
 
+        if self.lazy_restore:
+            # the data is downloaded on demand, the old local copies are deleted because they are outdated
+            self.journal_store.add_pending_keys({
+                self._get_backup_key(file['s3_path']): None
+                for file in files_to_download
+                if self._is_lazy_key(self._get_backup_key(file['s3_path']))
+            })
+            files_to_download = [
+                file for file in files_to_download if not self._is_lazy_key(self._get_backup_key(file['s3_path']))
+            ]
+
         self.s3_handler.download_files(files_to_download)
+        # the coords could have changed, so the index is rebuilt the next time that it is used
+        self.coords_index.drop()
 
         return True
 
+    def _is_lazy_key(self, key: str) -> bool:
+        # only the chunks of the data are downloaded on demand, the metadata and the coords are always downloaded
+        return not os.path.basename(key).startswith('.z') and os.path.basename(os.path.dirname(key)) == self.name
+
+    def _get_backup_key(self, s3_path: str) -> str:
+        return s3_path[len(self.path.replace('\\', '/')) + 1:]
+
+    def _fetch_backup_key(self, key: str, entry: List = None) -> bytes:
+        if entry is not None:
+            return self.chunk_bundles.fetch_entry(self.s3_handler, self.bucket_name, entry)
+        return self.s3_handler.get_object(
+            bucket_name=self.bucket_name,
+            s3_path=os.path.join(self.path, key).replace('\\', '/')
+        )
+
     def exist(self, raise_error_missing_backup: bool = False, **kwargs):
         if os.path.exists(os.path.join(self.local_path, '.zattrs')):
             return True
@@ -331,3 +1056,5 @@ class ZarrStorage(BaseStorage):
 
     def close(self, **kwargs):
         self.backup(**kwargs)
+        if self._own_s3_handler:
+            self.s3_handler.close()
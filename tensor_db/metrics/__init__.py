@@ -0,0 +1,2 @@
+from tensor_db.metrics.metrics import Metrics, InMemoryMetrics, timer, increment, copy_context_run
+from tensor_db.metrics.prometheus import PrometheusExporter
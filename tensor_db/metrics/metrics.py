@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import contextvars
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Tuple, Any, ContextManager
+
+
+# metrics and labels (tensor and action) of the action that is being executed, the handlers and the S3Handler
+# record their measures on them without receiving the metrics as a parameter
+_current_action: contextvars.ContextVar = contextvars.ContextVar('tensor_db_current_action', default=None)
+
+_null_context = nullcontext()
+
+
+class Metrics:
+    """
+        Metrics
+        ----------
+        Hook that receive the measures of the actions of TensorDB (read, append, update, backup, etc) and of
+        the operations that they execute inside (handler creation, coords reads, zarr writes, S3 requests, etc).
+
+        Every measure is labeled with the tensor and the action that was being executed, track set them for the
+        current thread (and the threads used by the S3 transfers of the action).
+
+        This class is the disabled mode, it does not record anything and track does not set the current action,
+        so the instrumented code only pays the lookup of a context variable.
+        Subclass it and override observe and increment to send the measures to other systems (see InMemoryMetrics).
+    """
+
+    enabled = False
+
+    def track(self, tensor: str, action: str) -> ContextManager:
+        """
+        Set the labels of the current action and record its total latency as the 'total' operation
+        """
+        if not self.enabled:
+            return _null_context
+        return self._track(tensor, action)
+
+    @contextmanager
+    def _track(self, tensor: str, action: str):
+        labels = (tensor, action)
+        token = _current_action.set((self, labels))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('total', time.perf_counter() - start, labels)
+            _current_action.reset(token)
+
+    def observe(self, operation: str, seconds: float, labels: Tuple[str, str]):
+        pass
+
+    def increment(self, counter: str, value: float, labels: Tuple[str, str]):
+        pass
+
+
+@contextmanager
+def _timer(metrics: Metrics, operation: str, labels: Tuple[str, str]):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(operation, time.perf_counter() - start, labels)
+
+
+def timer(operation: str) -> ContextManager:
+    """
+    Record the latency of an operation on the metrics of the current action, if there is not an action
+    tracked by enabled metrics nothing is recorded
+    """
+    current = _current_action.get()
+    if current is None:
+        return _null_context
+    return _timer(current[0], operation, current[1])
+
+
+def increment(counter: str, value: float = 1):
+    """
+    Add value to a counter (bytes_read, chunks_written, s3_requests, etc) of the current action
+    """
+    current = _current_action.get()
+    if current is not None:
+        current[0].increment(counter, value, current[1])
+
+
+def copy_context_run(func):
+    """
+    Wrap func to be executed on other thread using the current action, the executors do not copy
+    the context variables of the thread that submit the tasks
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+class InMemoryMetrics(Metrics):
+    """
+        InMemoryMetrics
+        ----------
+        Aggregate the measures in memory, the latencies are saved as histograms (buckets are the upper bounds
+        in seconds, like the histograms of Prometheus) and the rest of the measures as counters, both indexed
+        by the name of the operation or counter, the tensor and the action.
+
+        summary return the latencies (with percentiles estimated from the buckets) and get_counter
+        the value of a counter, the PrometheusExporter can be used to export them in the text format.
+    """
+
+    enabled = True
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., np.inf)
+
+    def __init__(self, buckets: Tuple[float, ...] = None):
+        buckets = self.default_buckets if buckets is None else tuple(buckets)
+        self.buckets = np.array(buckets if buckets[-1] == np.inf else buckets + (np.inf,))
+        self.histograms: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.counters: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation: str, seconds: float, labels: Tuple[str, str]):
+        key = (operation, *labels)
+        bucket = int(np.searchsorted(self.buckets, seconds))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': np.zeros(len(self.buckets), dtype=int), 'sum': 0., 'count': 0}
+            histogram = self.histograms[key]
+            histogram['buckets'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def increment(self, counter: str, value: float, labels: Tuple[str, str]):
+        key = (counter, *labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def get_counter(self, counter: str, tensor: str = None, action: str = None) -> float:
+        """
+        Value of the counter, the labels that are not sent are aggregated
+        """
+        with self._lock:
+            return sum(
+                value for (name, key_tensor, key_action), value in self.counters.items()
+                if name == counter and tensor in (None, key_tensor) and action in (None, key_action)
+            )
+
+    def get_histogram(self, operation: str, tensor: str = None, action: str = None) -> Dict[str, Any]:
+        """
+        Histogram of the latencies of the operation, the labels that are not sent are aggregated
+        """
+        result = {'buckets': np.zeros(len(self.buckets), dtype=int), 'sum': 0., 'count': 0}
+        with self._lock:
+            for (name, key_tensor, key_action), histogram in self.histograms.items():
+                if name == operation and tensor in (None, key_tensor) and action in (None, key_action):
+                    result['buckets'] += histogram['buckets']
+                    result['sum'] += histogram['sum']
+                    result['count'] += histogram['count']
+        return result
+
+    def _quantile(self, buckets: np.ndarray, quantile: float) -> float:
+        # upper bound of the bucket that contains the quantile, the last finite bound is used for the infinite one
+        position = int(np.searchsorted(np.cumsum(buckets), quantile * buckets.sum()))
+        return float(self.buckets[min(position, len(self.buckets) - 2)])
+
+    def summary(self) -> pd.DataFrame:
+        with self._lock:
+            histograms = {key: {**value, 'buckets': value['buckets'].copy()} for key, value in self.histograms.items()}
+        rows = [
+            {
+                'operation': operation,
+                'tensor': tensor,
+                'action': action,
+                'count': histogram['count'],
+                'total_seconds': histogram['sum'],
+                'mean_seconds': histogram['sum'] / histogram['count'],
+                'p50_seconds': self._quantile(histogram['buckets'], 0.5),
+                'p99_seconds': self._quantile(histogram['buckets'], 0.99),
+            }
+            for (operation, tensor, action), histogram in histograms.items()
+        ]
+        columns = [
+            'operation', 'tensor', 'action', 'count', 'total_seconds', 'mean_seconds', 'p50_seconds', 'p99_seconds'
+        ]
+        return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,69 @@
+import numpy as np
+import os
+import threading
+
+from typing import Dict
+
+from tensor_db.metrics.metrics import InMemoryMetrics
+
+
+class PrometheusExporter:
+    """
+        PrometheusExporter
+        ----------
+        Export the measures of an InMemoryMetrics using the text format of Prometheus, the latencies are exported
+        as the histogram {prefix}_operation_seconds and every counter as {prefix}_{counter}_total.
+
+        render return the text, so it can be served by any http endpoint, and write save it in a file
+        (for example for the textfile collector of the node exporter).
+    """
+
+    def __init__(self, metrics: InMemoryMetrics, prefix: str = 'tensor_db'):
+        self.metrics = metrics
+        self.prefix = prefix
+
+    @staticmethod
+    def _format_labels(labels: Dict[str, str]) -> str:
+        escaped = {
+            name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            for name, value in labels.items() if value is not None
+        }
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+    @staticmethod
+    def _format_bound(bound: float) -> str:
+        return '+Inf' if bound == np.inf else repr(float(bound))
+
+    def render(self) -> str:
+        with self.metrics._lock:
+            histograms = {
+                key: {**value, 'buckets': value['buckets'].copy()} for key, value in self.metrics.histograms.items()
+            }
+            counters = dict(self.metrics.counters)
+
+        lines = []
+        name = f'{self.prefix}_operation_seconds'
+        lines.append(f'# HELP {name} Latency of the actions (operation="total") and the operations inside them')
+        lines.append(f'# TYPE {name} histogram')
+        for (operation, tensor, action), histogram in sorted(histograms.items(), key=lambda item: str(item[0])):
+            labels = {'operation': operation, 'tensor': tensor, 'action': action}
+            for bound, count in zip(self.metrics.buckets, np.cumsum(histogram['buckets'])):
+                bucket_labels = self._format_labels({**labels, 'le': self._format_bound(bound)})
+                lines.append(f'{name}_bucket{bucket_labels} {count}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {histogram["sum"]!r}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {histogram["count"]}')
+
+        for counter in sorted({key[0] for key in counters}):
+            name = f'{self.prefix}_{counter}_total'
+            lines.append(f'# TYPE {name} counter')
+            for (key_counter, tensor, action), value in sorted(counters.items(), key=lambda item: str(item[0])):
+                if key_counter == counter:
+                    lines.append(f'{name}{self._format_labels({"tensor": tensor, "action": action})} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        # the file is replaced atomically, so the collector never read a partial file
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, mode='w') as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
@@ -0,0 +1,70 @@
+import os
+import time
+import tempfile
+
+from tensor_db.metrics import Metrics, InMemoryMetrics, PrometheusExporter, timer, increment
+
+
+class TestMetrics:
+
+    def test_disabled(self):
+        metrics = Metrics()
+        with metrics.track(tensor='data_one', action='read'):
+            # there is not an action tracked, so the measures are ignored
+            with timer('zarr_write'):
+                increment('bytes_read', 10)
+        assert metrics.track(tensor='data_one', action='read') is metrics.track(tensor='data_two', action='update')
+
+    def test_in_memory(self):
+        metrics = InMemoryMetrics(buckets=[0.001, 0.1])
+        with metrics.track(tensor='data_one', action='read'):
+            with timer('coords_read'):
+                time.sleep(0.002)
+            increment('bytes_read', 10)
+            with metrics.track(tensor='data_two', action='read'):
+                increment('bytes_read', 5)
+        with metrics.track(tensor='data_one', action='update'):
+            increment('bytes_read', 1)
+
+        assert metrics.get_counter('bytes_read') == 16
+        assert metrics.get_counter('bytes_read', tensor='data_one') == 11
+        assert metrics.get_counter('bytes_read', tensor='data_one', action='read') == 10
+        histogram = metrics.get_histogram('coords_read', tensor='data_one')
+        assert histogram['count'] == 1 and list(histogram['buckets']) == [0, 1, 0]
+        assert metrics.get_histogram('total')['count'] == 3
+
+        summary = metrics.summary()
+        row = summary[summary['operation'] == 'coords_read'].iloc[0]
+        assert row['p50_seconds'] == 0.1 and row['total_seconds'] >= 0.002
+
+        metrics.reset()
+        assert metrics.get_counter('bytes_read') == 0 and len(metrics.summary()) == 0
+
+    def test_prometheus(self):
+        metrics = InMemoryMetrics(buckets=[0.5])
+        metrics.observe('total', 0.1, ('data_one', 'read'))
+        metrics.observe('total', 1., ('data_one', 'read'))
+        metrics.increment('s3_requests', 2, ('data_one', 'backup'))
+        metrics.increment('s3_requests', 1, (None, 'backup'))
+
+        exporter = PrometheusExporter(metrics)
+        text = exporter.render()
+        assert '# TYPE tensor_db_operation_seconds histogram' in text
+        labels = 'operation="total",tensor="data_one",action="read"'
+        assert f'tensor_db_operation_seconds_bucket{{{labels},le="0.5"}} 1' in text
+        assert f'tensor_db_operation_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+        assert 'tensor_db_operation_seconds_count{operation="total",tensor="data_one",action="read"} 2' in text
+        assert 'tensor_db_s3_requests_total{tensor="data_one",action="backup"} 2' in text
+        assert 'tensor_db_s3_requests_total{action="backup"} 1' in text
+
+        with tempfile.TemporaryDirectory() as path:
+            exporter.write(os.path.join(path, 'tensor_db.prom'))
+            with open(os.path.join(path, 'tensor_db.prom')) as file:
+                assert file.read() == text
+
+
+if __name__ == "__main__":
+    test = TestMetrics()
+    test.test_disabled()
+    # test.test_in_memory()
+    # test.test_prometheus()
@@ -1,7 +1,9 @@
 import os
 import json
+import asyncio
+import pytest
 
-from tensor_db.backup_handlers import S3Handler
+from tensor_db.backup_handlers import S3Handler, S3TransferError
 from tensor_db.config.config_root_dir import TEST_DIR_S3
 
 
@@ -42,6 +44,53 @@ class TestS3Handler:
 
         assert TestS3Handler.data == data_s3
 
+    def test_upload_download_files_async(self, mock_s3):
+        s3_handler = get_default_s3_handler()
+        self._write_json()
+        files_settings = [dict(
+            bucket_name='test.bitacore.data.2.0',
+            local_path=os.path.join(TEST_DIR_S3, 'test.json'),
+            s3_path=os.path.join('test_s3', 'test.json')
+        )]
+
+        async def upload_and_download():
+            await s3_handler.upload_files_async(files_settings)
+            await s3_handler.download_files_async(files_settings)
+
+        asyncio.run(upload_and_download())
+        with open(os.path.join(TEST_DIR_S3, 'test.json'), mode='r') as json_file:
+            assert TestS3Handler.data == json.load(json_file)
+
+    def test_transfer_errors(self, mock_s3):
+        s3_handler = get_default_s3_handler()
+        self._write_json()
+        files_settings = [
+            dict(
+                bucket_name='test.bitacore.data.2.0',
+                local_path=os.path.join(TEST_DIR_S3, name),
+                s3_path=os.path.join('test_s3', name)
+            )
+            for name in ['test.json', 'missing.json']
+        ]
+        # the failed file must not stop the transfer of the rest of the files
+        with pytest.raises(S3TransferError) as error:
+            s3_handler.upload_files(files_settings)
+        assert list(error.value.errors) == [os.path.join('test_s3', 'missing.json')]
+
+        results = {
+            file_settings['local_path']: error
+            for file_settings, error in s3_handler.iter_download_files(files_settings)
+        }
+        assert results[files_settings[0]['local_path']] is None
+        assert results[files_settings[1]['local_path']] is not None
+
+        executor = s3_handler.executor
+        s3_handler.close()
+        assert executor._shutdown and s3_handler._executor is None
+        # the handler can be used after closing it
+        assert s3_handler.download_files(files_settings[:1]) == {}
+        s3_handler.close()
+
     def test_get_head_object(self):
         self.test_upload_file()
         s3_handler = get_default_s3_handler()
@@ -65,6 +114,7 @@ if __name__ == "__main__":
     test = TestS3Handler()
     test.test_upload_file()
     # test.test_download_file()
+    # test.test_transfer_errors(mock_s3=None)
     # test.test_get_head_object()
 
 
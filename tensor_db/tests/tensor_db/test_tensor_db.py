@@ -1,9 +1,14 @@
 import xarray
 import numpy as np
+import os
+import asyncio
+import shutil
+import threading
 
-from tensor_db import TensorDB
+from tensor_db import TensorDB, AsyncTensorDB
 from tensor_db.core.utils import create_dummy_array
 from tensor_db.file_handlers import ZarrStorage
+from tensor_db.metrics import InMemoryMetrics
 from tensor_db.config.config_root_dir import TEST_DIR_TENSOR_DB
 
 
@@ -82,6 +87,21 @@ def get_default_tensor_db():
                 'method_fill_value': 'ffill'
             }
         },
+        'data_clean': {
+            **default_settings,
+            'store': {
+                'data_methods': ['ffill', 'fillna'],
+            },
+            'append': {
+                'data_methods': ['ffill', 'fillna'],
+            },
+            'ffill': {
+                'dim': 'index'
+            },
+            'fillna': {
+                'value': 0
+            }
+        },
         'overwrite_append_data': {
             'store': {
                 'data_methods': ['read_from_formula'],
@@ -209,12 +229,125 @@ class TestTensorDB:
         data_two = tensor_db.read(path='data_two')
         assert data_four.equals((data_one * data_two).rolling({'index': 3}).sum())
 
+    def test_compiled_formula(self):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        data_four = tensor_db.read(path='data_four')
+        # the formula must be evaluated lazily and compiled only once
+        assert data_four.chunks is not None
+        tensor_db.read(path='data_four', sel={'index': [3, 4]})
+        assert list(tensor_db.formulas_cache.keys()) == ["(`data_one` * `data_two`).rolling({'index': 3}).sum()"]
+
+        # the rolling is not element wise, so the selection must be applied after evaluating the formula
+        assert tensor_db.read(path='data_four', sel={'index': [3, 4]}).equals(data_four.sel(index=[3, 4]))
+        assert not tensor_db.get_formula("`data_one`.rolling({'index': 3}).sum()").is_elementwise
+
+        formula = tensor_db.get_formula("(`data_one` * `data_two`).fillna(0) + `data_one` > 3")
+        assert formula.is_elementwise
+        data_fields = {'data_one': TestTensorDB.arr, 'data_two': TestTensorDB.arr2}
+        assert formula.evaluate(data_fields, sel={'index': [1, 2]}).equals(
+            ((TestTensorDB.arr * TestTensorDB.arr2).fillna(0) + TestTensorDB.arr > 3).sel(index=[1, 2])
+        )
+
     def test_ffill(self):
         self.test_store()
         tensor_db = get_default_tensor_db()
         tensor_db.store(path='data_ffill')
         assert tensor_db.read(path='data_ffill').equals(tensor_db.read(path='data_one').ffill('index'))
 
+    def test_ffill_incremental(self):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        tensor_db.store(path='data_ffill')
+        tensor_db.auto_update_dependants = True
+
+        # a gap of many labels without values, the last valid values are taken from the state of data_ffill
+        for index, values in [([5, 6, 7], [np.nan] * 5), ([8], [np.nan, 3, np.nan, np.nan, 4])]:
+            new_data = xarray.DataArray(
+                data=np.array([values] * len(index), dtype=float),
+                dims=['index', 'columns'],
+                coords={'index': index, 'columns': [0, 1, 2, 3, 4]},
+            )
+            tensor_db.append(new_data=new_data, path='data_one')
+            assert tensor_db.read(path='data_ffill').equals(tensor_db.read(path='data_one').ffill('index'))
+
+        last_valid = tensor_db._get_handler('data_ffill').read_last_valid()
+        assert last_valid['value'].equals(tensor_db.read(path='data_ffill').isel(index=-1, drop=True).rename('value'))
+        # restore the tensors used by the other tests
+        self.test_ffill()
+
+    def test_ffill_limit(self):
+        tensor_db = get_default_tensor_db()
+        data = xarray.DataArray(
+            data=np.array([
+                [1, 1, np.nan, 3],
+                [1, 2, np.nan, np.nan],
+                [np.nan, 3, np.nan, np.nan],
+                [np.nan, np.nan, np.nan, np.nan],
+            ], dtype=float),
+            dims=['index', 'columns'],
+            coords={'index': [0, 1, 2, 3], 'columns': [0, 1, 2, 3]},
+        )
+        new_data = xarray.DataArray(
+            data=np.array([[np.nan] * 4] * 2 + [[np.nan, 5, np.nan, np.nan]] + [[np.nan] * 4]),
+            dims=['index', 'columns'],
+            coords={'index': [4, 5, 6, 7], 'columns': [0, 1, 2, 3]},
+        )
+        # data_one reads the stored data and data_clean use its state of the last valid values
+        for path in ['data_one', 'data_clean']:
+            handler = tensor_db._get_handler(path)
+            for limit in [None, 1, 2]:
+                # the stored data was filled with the same limit, so the filled values must not restart the limit
+                handler.store(data.ffill('index', limit=limit))
+                expected = xarray.concat([data, new_data], dim='index').ffill('index', limit=limit)
+                result = tensor_db.ffill(
+                    handler=handler, new_data=new_data, dim='index', action_type='append', limit=limit
+                )
+                assert result.equals(expected.sel(index=new_data.index))
+
+        # restore the tensors used by the other tests
+        self.test_store()
+
+    def test_data_methods_pipeline(self):
+        tensor_db = get_default_tensor_db()
+        tensor_db.data_methods_chunks = {'index': 2}
+        arr = TestTensorDB.arr.isel(index=[0, 1, 2])
+
+        # the pipeline is lazy and it is computed once at the end, so the handler receives the data in memory
+        new_data = tensor_db._apply_data_methods(
+            data_methods=['ffill', 'fillna'],
+            tensor_definition=tensor_db.get_tensor_definition('data_clean'),
+            handler=tensor_db._get_handler('data_clean'),
+            new_data=arr,
+            action_type='store'
+        )
+        assert new_data.chunks is None
+        assert new_data.equals(arr.ffill('index').fillna(0))
+
+        tensor_db.store(path='data_clean', new_data=arr)
+        tensor_db.append(path='data_clean', new_data=TestTensorDB.arr.isel(index=[3, 4]))
+        assert tensor_db.read(path='data_clean').equals(TestTensorDB.arr.ffill('index').fillna(0))
+
+        # without data_methods_chunks the methods are applied eagerly with the same result
+        tensor_db.data_methods_chunks = None
+        tensor_db.store(path='data_clean', new_data=TestTensorDB.arr)
+        assert tensor_db.read(path='data_clean').equals(TestTensorDB.arr.ffill('index').fillna(0))
+
+        # dask can not chunk automatically the object dtype, so the methods are applied eagerly over it
+        tensor_db.data_methods_chunks = 'auto'
+        names = xarray.DataArray(
+            data=np.array([['a', None], [None, 'b']], dtype=object),
+            dims=['index', 'columns'],
+            coords={'index': [0, 1], 'columns': [0, 1]},
+        )
+        new_data = tensor_db._apply_data_methods(
+            data_methods=['fillna'],
+            tensor_definition={'fillna': {'value': 'missing'}},
+            new_data=names,
+            action_type='store'
+        )
+        assert new_data.equals(names.fillna('missing'))
+
     def test_last_valid_index(self):
         self.test_store()
         tensor_db = get_default_tensor_db()
@@ -237,6 +370,275 @@ class TestTensorDB:
         data_reindex = tensor_db.read(path='data_reindex')
         assert data_reindex.sel(index=5, drop=True).equals(data_reindex.sel(index=4, drop=True))
 
+    def test_metrics(self, mock_s3):
+        tensor_db = get_default_tensor_db()
+        tensor_db.metrics = InMemoryMetrics()
+        tensor_db.store(new_data=TestTensorDB.arr, path='data_one')
+        tensor_db.read(path='data_one').load()
+        tensor_db.update(new_data=TestTensorDB.arr.isel(index=[0]) * 2, path='data_one')
+        tensor_db.backup(path='data_one')
+        metrics = tensor_db.metrics
+
+        for action in ['store', 'read', 'update', 'backup']:
+            assert metrics.get_histogram('total', tensor='data_one', action=action)['count'] == 1
+        assert metrics.get_histogram('handler_creation', tensor='data_one', action='store')['count'] == 1
+        assert metrics.get_histogram('zarr_write', tensor='data_one', action='update')['count'] == 1
+        assert metrics.get_histogram('coords_read', tensor='data_one', action='update')['count'] > 0
+        assert metrics.get_counter('chunks_written', tensor='data_one', action='update') == 1
+        assert metrics.get_counter('bytes_written', tensor='data_one', action='store') > 0
+        assert metrics.get_counter('chunks_read', tensor='data_one', action='read') > 0
+        assert metrics.get_counter('s3_requests', tensor='data_one', action='backup') > 0
+        assert metrics.get_counter('s3_bytes_uploaded', tensor='data_one', action='backup') > 0
+
+        # the hits of the read cache are also tracked
+        metrics.reset()
+        tensor_db.read_cache_bytes = 10 ** 6
+        for _ in range(3):
+            tensor_db.read(path='data_one')
+        assert metrics.get_histogram('total', tensor='data_one', action='read')['count'] == 3
+        assert metrics.get_counter('read_cache_misses', tensor='data_one', action='read') == 1
+        assert metrics.get_counter('read_cache_hits', tensor='data_one', action='read') == 2
+
+    def test_handlers_eviction(self, mock_s3):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        tensor_db.max_open_handlers = 2
+        for path in ['data_one', 'data_two', 'data_one', 'data_three']:
+            tensor_db.read(path=path)
+
+        stats = tensor_db.get_handlers_stats()
+        assert stats['open_handlers'] == 2
+        assert stats['evictions'] == 1
+        assert stats['hits'] == 1 and stats['misses'] == 3
+        assert list(tensor_db.open_base_store.keys()) == [
+            tensor_db._complete_path({}, 'data_one'), tensor_db._complete_path({}, 'data_three')
+        ]
+
+        # the handlers that can not be closed are kept open and the action that evicted them does not fail
+        def close(**kwargs):
+            raise ConnectionError('The backup failed')
+
+        tensor_db.open_base_store[tensor_db._complete_path({}, 'data_one')]['data_handler'].close = close
+        tensor_db.read(path='data_two')
+        assert tensor_db.get_handlers_stats()['evictions'] == 2
+        assert list(tensor_db.open_base_store.keys()) == [
+            tensor_db._complete_path({}, 'data_one'), tensor_db._complete_path({}, 'data_two')
+        ]
+
+        # the evicted handlers are closed out of the lock, so the other threads are not blocked by their backups
+        lock_free = []
+
+        def acquire_lock():
+            if tensor_db._lock.acquire(timeout=5):
+                tensor_db._lock.release()
+                lock_free.append(True)
+
+        def close_from_other_thread(**kwargs):
+            thread = threading.Thread(target=acquire_lock)
+            thread.start()
+            thread.join()
+
+        handler = tensor_db.open_base_store[tensor_db._complete_path({}, 'data_two')]['data_handler']
+        handler.close = close_from_other_thread
+        tensor_db.read(path='data_three')
+        assert lock_free == [True]
+        assert tensor_db._complete_path({}, 'data_two') not in tensor_db.open_base_store
+
+    def test_local_files_eviction(self, mock_s3):
+        tensor_db = get_default_tensor_db()
+        tensor_db.max_files_on_disk = 1
+        tensor_db.store(new_data=TestTensorDB.arr, path='data_one')
+        tensor_db.store(new_data=TestTensorDB.arr2, path='data_two')
+
+        assert not os.path.exists(tensor_db._complete_path({}, 'data_one'))
+        assert tensor_db.get_handlers_stats()['disk_evictions'] == 1
+
+        # the evicted tensor was backed up before deleting it, so it can be restored
+        assert tensor_db.read(path='data_one').equals(TestTensorDB.arr)
+        assert not os.path.exists(tensor_db._complete_path({}, 'data_two'))
+
+        # the tensors without a bucket can not be restored, so their files are never deleted
+        tensor_db.store(path='overwrite_append_data')
+        tensor_db.read(path='data_two')
+        assert os.path.exists(tensor_db._complete_path({}, 'overwrite_append_data'))
+
+        # the files are kept if the backup fails
+        tensor_db.update(new_data=TestTensorDB.arr2 * 2, path='data_two')
+        tensor_db._get_handler('data_two').backup = lambda *args, **kwargs: False
+        disk_evictions = tensor_db.get_handlers_stats()['disk_evictions']
+        tensor_db.read(path='data_one')
+        assert os.path.exists(tensor_db._complete_path({}, 'data_two'))
+        assert tensor_db.get_handlers_stats()['disk_evictions'] == disk_evictions
+
+    def test_read_cache(self):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        tensor_db.read_cache_bytes = 10 ** 6
+
+        data_one = tensor_db.read(path='data_one')
+        data_one.loc[0, 0] = -1
+        assert tensor_db.read(path='data_one').equals(TestTensorDB.arr)
+        assert tensor_db.read_cache_stats['hits'] == 1
+
+        # the formulas are not cached but they use the cache of the tensors that they read
+        tensor_db.read(path='data_four')
+        assert tensor_db.read_cache_stats['hits'] == 2
+
+        tensor_db.update(new_data=TestTensorDB.arr2, path='data_one')
+        assert tensor_db.read_cache_stats['invalidations'] == 1
+        assert tensor_db.read(path='data_one').equals(TestTensorDB.arr2)
+
+        tensor_db.read_cache_bytes = TestTensorDB.arr.nbytes * 2
+        tensor_db.read(path='data_three')
+        assert tensor_db.read_cache_stats['evictions'] == 2
+        assert list(tensor_db.read_cache.keys()) == [('data_three', ())]
+
+        # the data that does not fit on the cache is not loaded
+        tensor_db.read_cache_bytes = 1
+        assert tensor_db.read(path='data_two', chunks={}).chunks is not None
+
+        # the data of a read that was running during a write is not cached because it can be stale
+        tensor_db.read_cache_bytes = 10 ** 6
+        track_handler_action = tensor_db._track_handler_action
+
+        def read_during_write(path, action_type, **kwargs):
+            result = track_handler_action(path=path, action_type=action_type, **kwargs)
+            if action_type == 'read':
+                tensor_db._track_handler_action = track_handler_action
+                tensor_db.update(new_data=TestTensorDB.arr2 + 1, path='data_one')
+            return result
+
+        tensor_db._track_handler_action = read_during_write
+        tensor_db.read(path='data_one')
+        assert ('data_one', ()) not in tensor_db.read_cache
+        assert tensor_db.read(path='data_one').equals(TestTensorDB.arr2 + 1)
+
+    def test_update_dependants(self):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        for path in ['data_ffill', 'last_valid_index', 'data_replace_last_valid_dim', 'data_reindex']:
+            tensor_db.store(path=path)
+
+        assert tensor_db.get_dependants_levels('data_one') == [
+            ['data_four', 'data_ffill', 'last_valid_index', 'data_reindex', 'overwrite_append_data'],
+            ['data_replace_last_valid_dim']
+        ]
+
+        tensor_db.auto_update_dependants = True
+        new_data = xarray.DataArray(
+            data=np.array([[np.nan, 1, np.nan, 2, np.nan]], dtype=float),
+            dims=['index', 'columns'],
+            coords={'index': [5], 'columns': [0, 1, 2, 3, 4]},
+        )
+        tensor_db.append(new_data=new_data, path='data_one')
+        tensor_db.update(new_data=new_data.assign_coords(index=[1]) * 10, path='data_one')
+
+        data_one = tensor_db.read(path='data_one')
+        assert tensor_db.read(path='data_ffill').equals(data_one.ffill('index'))
+        assert np.array_equal(tensor_db.read(path='last_valid_index').values, [2, 5, 4, 5, 4])
+        data_replace_last_valid_dim = data_one.ffill('index')
+        data_replace_last_valid_dim.loc[[3, 4, 5], 0] = np.nan
+        data_replace_last_valid_dim.loc[5, [2, 4]] = np.nan
+        assert tensor_db.read(path='data_replace_last_valid_dim').equals(data_replace_last_valid_dim)
+
+        # only the dim of the ffill is extended after the modified labels, the other dims keep the modified labels
+        modified_coords = tensor_db._update_dependant(
+            path='data_ffill',
+            modified_coords={'data_one': {'index': [1], 'columns': [2]}},
+            action_type='update'
+        )
+        assert np.array_equal(modified_coords['index'], [1, 2, 3, 4, 5])
+        assert np.array_equal(modified_coords['columns'], [2])
+
+    def test_last_valid_index_removed(self):
+        self.test_store()
+        tensor_db = get_default_tensor_db()
+        for path in ['data_ffill', 'last_valid_index', 'data_replace_last_valid_dim']:
+            tensor_db.store(path=path)
+        tensor_db.auto_update_dependants = True
+
+        # the last valid value of the first column is removed, so the previous one must be used
+        new_data = TestTensorDB.arr.sel(index=[2], columns=[0]) * np.nan
+        tensor_db.update(new_data=new_data, path='data_one')
+        assert np.array_equal(tensor_db.read(path='last_valid_index').values, [0, 4, 4, 4, 4])
+
+        data_ffill = tensor_db.read(path='data_ffill')
+        assert bool((data_ffill.sel(columns=0) == 1).all())
+        data_ffill.loc[[1, 2, 3, 4], 0] = np.nan
+        assert tensor_db.read(path='data_replace_last_valid_dim').equals(data_ffill)
+
+    def test_many(self, mock_s3):
+        tensor_db = get_default_tensor_db()
+        arrays = {'data_one': TestTensorDB.arr, 'data_two': TestTensorDB.arr2, 'data_three': TestTensorDB.arr3}
+        results, errors = tensor_db.store_many({**arrays, 'data_not_defined': TestTensorDB.arr}, backup=True)
+        assert list(errors.keys()) == ['data_not_defined']
+        assert set(results.keys()) == set(arrays.keys())
+        assert all(not tensor_db._get_handler(path).check_modification for path in arrays)
+
+        results, errors = tensor_db.read_many(list(arrays.keys()))
+        assert len(errors) == 0
+        assert all(results[path].equals(arr) for path, arr in arrays.items())
+
+        new_data = {path: arr.isel(index=[0]) * 10 for path, arr in arrays.items()}
+        results, errors = tensor_db.upsert_many(new_data)
+        assert len(errors) == 0
+        assert all(tensor_db.read(path).isel(index=[0]).equals(arr) for path, arr in new_data.items())
+
+        # the updates are not in the backup until backup_many is called
+        results, errors = tensor_db.backup_many(list(arrays.keys()))
+        assert len(errors) == 0 and all(results.values())
+
+    def test_backup_manifest(self, mock_s3):
+        tensor_db = get_default_tensor_db()
+        tensor_db.use_backup_manifest = True
+        arrays = {'data_one': TestTensorDB.arr, 'data_two': TestTensorDB.arr2}
+        tensor_db.store_many(arrays)
+        results, errors = tensor_db.backup_many(list(arrays.keys()))
+        assert len(errors) == 0
+        manifest = tensor_db.get_backup_manifest('test.bitacore.data.2.0')
+        assert set(manifest.get_versions().keys()) == set(arrays.keys())
+
+        # the freshness of all the tensors is checked using only one request
+        other_tensor_db = TensorDB(
+            base_path=os.path.join(TEST_DIR_TENSOR_DB, 'other_tensor_db'),
+            tensors_definition=tensor_db._tensors_definition,
+            s3_handler=tensor_db.s3_handler,
+            use_backup_manifest=True
+        )
+        if os.path.exists(other_tensor_db.base_path):
+            shutil.rmtree(other_tensor_db.base_path)
+        assert all(other_tensor_db.read(path).equals(arr) for path, arr in arrays.items())
+        other_manifest = other_tensor_db.get_backup_manifest('test.bitacore.data.2.0')
+        assert all(other_tensor_db._get_handler(path).equal_to_backup() == 'equal' for path in arrays)
+        assert other_manifest.stats['requests'] == 1
+
+        # the manifest is read again after the ttl, but only downloaded if it was modified
+        other_manifest.ttl = 0
+        assert other_tensor_db._get_handler('data_one').equal_to_backup() == 'equal'
+        assert other_manifest.stats['downloads'] == 1
+        tensor_db.update(new_data=TestTensorDB.arr.isel(index=[0]) * 10, path='data_one')
+        tensor_db.backup(path='data_one')
+        assert other_tensor_db._get_handler('data_one').equal_to_backup() == 'not equal'
+        assert other_tensor_db.update_from_backup(path='data_one')
+        assert other_tensor_db._get_handler('data_one').equal_to_backup() == 'equal'
+        assert other_tensor_db.read('data_one').equals(tensor_db.read('data_one'))
+        shutil.rmtree(other_tensor_db.base_path)
+
+    def test_async_tensor_db(self, mock_s3):
+        async_tensor_db = AsyncTensorDB(tensor_db=get_default_tensor_db(), max_concurrency=4)
+        arrays = {'data_one': TestTensorDB.arr, 'data_two': TestTensorDB.arr2, 'data_three': TestTensorDB.arr3}
+
+        async def store_and_read():
+            await asyncio.gather(*[async_tensor_db.store(path, new_data=arr) for path, arr in arrays.items()])
+            await asyncio.gather(*[async_tensor_db.backup(path) for path in arrays])
+            handler = async_tensor_db.tensor_db._get_handler('data_one')
+            return await async_tensor_db.read_many(list(arrays.keys())), await handler.read_async()
+
+        results, data_one = asyncio.run(store_and_read())
+        async_tensor_db.shutdown()
+        assert all(results[path].equals(arr) for path, arr in arrays.items())
+        assert data_one.equals(TestTensorDB.arr)
+
     def test_overwrite_append_data(self):
         self.test_store()
         tensor_db = get_default_tensor_db()
@@ -250,10 +652,23 @@ if __name__ == "__main__":
     # test.test_append()
     # test.test_backup()
     # test.test_read_from_formula()
+    # test.test_compiled_formula()
     # test.test_ffill()
+    # test.test_ffill_incremental()
+    # test.test_ffill_limit()
+    # test.test_data_methods_pipeline()
     # test.test_replace_last_valid_dim()
     # test.test_last_valid_index()
     # test.test_reindex()
+    # test.test_metrics(mock_s3=None)
+    # test.test_handlers_eviction(mock_s3=None)
+    # test.test_update_dependants()
+    # test.test_last_valid_index_removed()
+    # test.test_many(mock_s3=None)
+    # test.test_backup_manifest(mock_s3=None)
+    # test.test_async_tensor_db(mock_s3=None)
+    # test.test_read_cache()
+    # test.test_local_files_eviction(mock_s3=None)
     test.test_overwrite_append_data()
 
 